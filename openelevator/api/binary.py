@@ -0,0 +1,109 @@
+'''
+Copyright (C) Predly Technologies - All Rights Reserved
+Marvin Gabler <m.gabler@predly.com> 2021
+'''
+import numpy as np
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+BINARY  = "application/octet-stream"
+MSGPACK = "application/msgpack"
+# little endian float64 lon, lat pairs in, float32 elevations out
+LOCATION_DTYPE  = np.dtype("<f8")
+ELEVATION_DTYPE = np.dtype("<f4")
+LOCATION_SIZE   = 2 * LOCATION_DTYPE.itemsize
+
+def content_format(content_type:str):
+    '''
+    Returns format of given Content-Type or Accept header
+
+    Args:
+        content_type:str >> header value
+
+    Returns:
+        format:str >> "binary", "msgpack" or "json"
+    '''
+    if content_type:
+        if BINARY in content_type:
+            return "binary"
+        if "msgpack" in content_type:
+            return "msgpack"
+    return "json"
+
+def response_format(accept:str, default:str):
+    '''
+    Returns format of the response, as requested by the Accept
+    header or the format of the request
+    '''
+    if accept and (BINARY in accept or "msgpack" in accept):
+        return content_format(accept)
+    return default
+
+def parse_binary(body:bytes):
+    '''
+    Parses packed little endian float64 lon, lat pairs, zero-copy
+
+    Args:
+        body:bytes >> request body, 16 bytes per location
+
+    Returns:
+        lons:np.array >> longitudes
+        lats:np.array >> latitudes
+            OR
+        error:dict    >> object with error message
+    '''
+    if len(body) % LOCATION_SIZE != 0:
+        return {"error":f"body must consist of {LOCATION_SIZE} byte lon, lat float64 pairs"}
+    locations = np.frombuffer(body, dtype=LOCATION_DTYPE).reshape(-1, 2)
+    return locations[:, 0], locations[:, 1]
+
+def encode_binary(elevations):
+    '''
+    Returns elevations as packed little endian float32
+    '''
+    return np.asarray(elevations, dtype=ELEVATION_DTYPE).tobytes()
+
+def parse_msgpack(body:bytes):
+    '''
+    Parses a msgpack map {"locations":[[lon, lat], ...], "interpolation":str,
+    "level":int}, locations may also be packed float64 pairs as in parse_binary
+
+    Args:
+        body:bytes >> request body
+
+    Returns:
+        lons:np.array     >> longitudes
+        lats:np.array     >> latitudes
+        interpolation:str >> interpolation method or None
+        level:int         >> resolution level or None
+            OR
+        error:dict        >> object with error message
+    '''
+    if msgpack is None:
+        return {"error":"msgpack is not available on this server"}
+    try:
+        content = msgpack.unpackb(body)
+        locations = content["locations"]
+        interpolation = content.get("interpolation")
+        level = content.get("level")
+    except Exception as e:
+        return {"error":"body must be a msgpack map with locations"}
+    if isinstance(locations, bytes):
+        parsed = parse_binary(locations)
+        if isinstance(parsed, dict):
+            return parsed
+        return parsed[0], parsed[1], interpolation, level
+    try:
+        locations = np.array(locations, dtype=np.float64).reshape(-1, 2)
+    except ValueError:
+        return {"error":"every location array must contain exactly 2 values"}
+    return locations[:, 0], locations[:, 1], interpolation, level
+
+def encode_msgpack(elevations):
+    '''
+    Returns elevations as msgpack map {"elevations":[...]}
+    '''
+    return msgpack.packb({"elevations":np.asarray(elevations, dtype=np.float64).tolist()})
@@ -0,0 +1,229 @@
+'''
+Rate limiting in process memory, synchronized with Redis in batches
+
+fastapi_limiter runs a Redis script on every request. In the local
+mode, every process keeps a token bucket per client and only sends
+the requests counted since the last sync to Redis every few seconds,
+learning the requests other processes counted for the same clients
+in return. Limits are global approximately, a client can exceed them
+by the requests the other processes let through within one interval.
+
+Copyright (C) Predly Technologies - All Rights Reserved
+Marvin Gabler <m.gabler@predly.com> 2021
+'''
+import time
+import asyncio
+from math import ceil
+
+from fastapi import HTTPException
+from fastapi_limiter.depends import RateLimiter
+from starlette.requests import Request
+from starlette.responses import Response
+from starlette.status import HTTP_429_TOO_MANY_REQUESTS
+
+from api import util
+
+async def client_identifier(request:Request):
+    '''
+    Returns client ip and path of a request, like the default
+    identifier of fastapi_limiter
+    '''
+    forwarded = request.headers.get("X-Forwarded-For")
+    if forwarded:
+        ip = forwarded.split(",")[0]
+    else:
+        ip = request.client.host
+    return ip + ":" + request.scope["path"]
+
+async def too_many_requests(request:Request, response:Response, pexpire:int):
+    '''
+    Rejects a request, pexpire are the milliseconds until the next
+    request is allowed
+    '''
+    raise HTTPException(
+        HTTP_429_TOO_MANY_REQUESTS,
+        "Too Many Requests",
+        headers={"Retry-After":str(ceil(pexpire / 1000))}
+        )
+
+def rate_limiter(times:int, seconds:int):
+    '''
+    Returns the rate limiting dependency of the configured mode
+
+    Args:
+        times:int   >> allowed requests per seconds and client
+        seconds:int >> length of the period
+
+    Returns:
+        limiter:object >> LocalRateLimiter for ratelimitmode local,
+                          otherwise fastapi_limiter's RateLimiter
+    '''
+    if util.rate_limit_mode == "local":
+        return LocalRateLimiter(times=times, seconds=seconds)
+    return RateLimiter(times=times, seconds=seconds)
+
+
+class TokenBucket():
+    __slots__ = ("times", "seconds", "tokens", "updated", "pending", "seen")
+
+    def __init__(self, times, seconds, now):
+        '''
+        Bucket of times tokens, refilled continuously within seconds
+
+        Args:
+            times:int     >> capacity of the bucket
+            seconds:float >> seconds to refill an empty bucket
+            now:float     >> time.monotonic()
+        '''
+        self.times   = times
+        self.seconds = seconds
+        self.tokens  = float(times)
+        self.updated = now
+        # requests not sent to redis yet, redis count after the last sync
+        self.pending = 0
+        self.seen    = None
+
+    def refill(self, now):
+        self.tokens  = min(self.times, self.tokens + (now - self.updated) * self.times / self.seconds)
+        self.updated = now
+
+    def take(self, now):
+        '''
+        Takes a token
+
+        Returns:
+            wait:float >> 0 if a token was taken, otherwise seconds
+                          until the next token
+        '''
+        self.refill(now)
+        if self.tokens >= 1:
+            self.tokens  -= 1
+            self.pending += 1
+            return 0
+        return (1 - self.tokens) * self.seconds / self.times
+
+
+class LocalLimiter():
+    '''
+    Token buckets of all LocalRateLimiters of a process, initialized
+    on startup like FastAPILimiter, see LocalLimiter.init()
+    '''
+    redis  = None
+    prefix = "local-limiter"
+    interval = 1.0
+    identifier    = client_identifier
+    http_callback = too_many_requests
+    buckets = {}
+    syncs   = 0
+    errors  = 0
+    _task   = None
+
+    @classmethod
+    async def init(cls, redis, prefix="local-limiter", interval=1.0,
+                   identifier=client_identifier, http_callback=too_many_requests):
+        '''
+        Starts the periodic sync of the buckets
+
+        Args:
+            redis:object        >> aioredis client, None limits per process only
+            prefix:str          >> prefix of the redis keys
+            interval:float      >> seconds between two syncs
+            identifier:func     >> returns the client key of a request
+            http_callback:func  >> called with request, response and
+                                   milliseconds to wait for rejected requests
+        '''
+        await cls.close()
+        cls.redis  = redis
+        cls.prefix = prefix
+        cls.interval = interval
+        cls.identifier    = identifier
+        cls.http_callback = http_callback
+        cls._task = asyncio.create_task(cls._run())
+
+    @classmethod
+    async def close(cls):
+        '''
+        Stops the periodic sync, pending requests are sent first
+        '''
+        if cls._task is not None:
+            cls._task.cancel()
+            cls._task = None
+            await cls.sync()
+
+    @classmethod
+    async def _run(cls):
+        while True:
+            await asyncio.sleep(cls.interval)
+            await cls.sync()
+
+    @classmethod
+    async def sync(cls):
+        '''
+        Sends the requests counted since the last sync to redis and
+        takes the tokens other processes used meanwhile from the
+        buckets. Full buckets without pending requests are dropped,
+        they start full again on the next request.
+        '''
+        now = time.monotonic()
+        buckets = []
+        for key, bucket in list(cls.buckets.items()):
+            bucket.refill(now)
+            if bucket.pending == 0 and bucket.tokens >= bucket.times:
+                del cls.buckets[key]
+            else:
+                buckets.append((key, bucket, bucket.pending))
+                bucket.pending = 0
+        if cls.redis is None or not buckets:
+            return
+
+        try:
+            pipe = cls.redis.pipeline(transaction=False)
+            for key, bucket, pending in buckets:
+                pipe.incrby(f"{cls.prefix}:{key}", pending)
+                # counts of idle clients expire
+                pipe.expire(f"{cls.prefix}:{key}", ceil(bucket.seconds) * 2)
+            totals = (await pipe.execute())[::2]
+        except Exception as e:
+            if cls.errors == 0:
+                print(f"Rate limits could not be synchronized, limiting per process: {e}")
+            cls.errors += 1
+            for key, bucket, pending in buckets:
+                bucket.pending += pending
+            return
+
+        for (key, bucket, pending), total in zip(buckets, totals):
+            before = int(total) - pending
+            if bucket.seen is None:
+                others = 0
+            elif before >= bucket.seen:
+                others = before - bucket.seen
+            else:
+                # the count expired meanwhile
+                others = before
+            bucket.seen   = int(total)
+            bucket.tokens = max(0.0, bucket.tokens - others)
+        cls.syncs += 1
+
+
+class LocalRateLimiter():
+    def __init__(self, times:int=1, seconds:int=1):
+        '''
+        Rate limiting dependency like fastapi_limiter's RateLimiter,
+        checked against the token buckets of LocalLimiter
+
+        Args:
+            times:int   >> allowed requests per seconds and client
+            seconds:int >> seconds to refill the bucket of a client
+        '''
+        self.times   = times
+        self.seconds = seconds
+
+    async def __call__(self, request:Request, response:Response):
+        key = f"{await LocalLimiter.identifier(request)}:{self.times}:{self.seconds}"
+        now = time.monotonic()
+        bucket = LocalLimiter.buckets.get(key)
+        if bucket is None:
+            bucket = LocalLimiter.buckets[key] = TokenBucket(self.times, self.seconds, now)
+        wait = bucket.take(now)
+        if wait:
+            return await LocalLimiter.http_callback(request, response, int(wait * 1000))
@@ -3,31 +3,58 @@ Copyright (C) Predly Technologies - All Rights Reserved
 Marvin Gabler <m.gabler@predly.com> 2021
 '''
 
+import numpy as np
 from fastapi import APIRouter, Depends
-from fastapi_cache.decorator import cache
-from fastapi_limiter.depends import RateLimiter
+from pydantic import ValidationError
 
 from starlette.responses import StreamingResponse, Response
 from starlette.requests import Request
 
 from openelevator import OpenElevator
-from api import schemas, util
+import render
+from api import schemas, util, streaming, binary, ratelimit
+import geo
 
 router = APIRouter()
-elevator = OpenElevator(initialized=True, cache=True)
+elevator = OpenElevator(
+    initialized=True, 
+    cache=True,
+    tile_pool_size=util.tile_pool_size,
+    tile_cache_mb=util.tile_cache_mb,
+    chunk_cache_mb=util.chunk_cache_mb,
+    cache_ttl=util.cache_ttl,
+    cache_precision=util.cache_precision,
+    cache_maxmemory=util.cache_maxmemory,
+    cache_policy=util.cache_policy,
+    cache_l1_entries=util.cache_l1_entries,
+    cache_l1_ttl=util.cache_l1_ttl,
+    cache_negative_ttl=util.cache_negative_ttl,
+    render_cache_entries=util.render_cache_entries,
+    io_workers=util.io_workers,
+    cpu_workers=util.cpu_workers,
+    max_pending=util.max_pending,
+    fetch_source=util.fetch_source,
+    fetch_endpoint_url=util.fetch_endpoint_url,
+    fetch_max_gb=util.fetch_max_gb,
+    fetch_workers=util.fetch_workers,
+    fetch_negative_ttl=util.fetch_negative_ttl,
+    heatmap_interval=util.heatmap_interval,
+    prewarm_tiles=util.prewarm_tiles,
+    batch_window_us=util.batch_window_us
+    )
 
 @router.get("/json", response_model=schemas.SingleElevationResponse,
-                     dependencies=[Depends(RateLimiter(
+                     dependencies=[Depends(ratelimit.rate_limiter(
                         times=util.rate_limit, 
                         seconds=util.rate_reset,
                         ))])
-@cache()
 async def get_elevation_single(
     request: Request,
     response: Response,
     lat:float,
     lon:float,
-    interpolation:str="cubic"
+    interpolation:str="cubic",
+    level:int=0
     ):
     '''
     Returns elevation for given lat, lon, interpolation method
@@ -35,18 +62,21 @@ async def get_elevation_single(
 
     Not found value: -32768
 
-    More information: https://docs.scipy.org/doc/scipy/reference/generated/scipy.interpolate.griddata.html
+    linear is bilinear, cubic is bicubic (Catmull-Rom) interpolation on the raster
     
     Args:
         lat:float  >> Latitude (y axis), number between -90 and 90
         lon:float  >> Longitude(x axis), number between -180 and 180
         interpolation:str >> Interpolation method (none, linear, nearest, cubic)
+        level:int  >> Resolution level, 0 is full resolution, see /levels
 
     Returns:
         response:object >> json object with elevation data
     '''
+    if level not in elevator.overview_levels():
+        return util.error_response(f"level must be in {elevator.overview_levels()}")
     if interpolation not in elevator.INTERPOLATION_METHODS:
-        return {"error":f"interpolation must be in {elevator.INTERPOLATION_METHODS}"}
+        return util.error_response(f"interpolation must be in {elevator.INTERPOLATION_METHODS}")
     else:    
         check = util.check_lat_lon(lat, lon)
         if check == True:
@@ -54,7 +84,8 @@ async def get_elevation_single(
                     "elevation":await elevator.get_elevation(
                                         lat, 
                                         lon, 
-                                        interpolation=interpolation
+                                        interpolation=interpolation,
+                                        level=level
                                         ),
                     "location":{
                         "lat":lat, 
@@ -63,17 +94,18 @@ async def get_elevation_single(
                     }
             return resp
         else:   
-            return check    
+            return util.error_response(check)    
 
 @router.post("/json", response_model=schemas.MultiElevationResponse,
-                      dependencies=[Depends(RateLimiter(
+                      dependencies=[Depends(ratelimit.rate_limiter(
                         times=util.rate_limit, 
                         seconds=util.rate_reset
                         ))])
 async def get_elevation_list(
-    locations:schemas.Locations,
     request: Request,
-    response: Response
+    response: Response,
+    interpolation:str=None,
+    level:int=None
     ):
     '''
     Returns elevations for given location array of [[lon,lat], [lon,lat], ...] and interpolation method
@@ -81,59 +113,360 @@ async def get_elevation_list(
 
     Interpolation methods available: none, linear, nearest, cubic
 
-    More information: https://docs.scipy.org/doc/scipy/reference/generated/scipy.interpolate.griddata.html
+    linear is bilinear, cubic is bicubic (Catmull-Rom) interpolation on the raster
+
+    Request formats (Content-Type):
+        application/json         >> {"locations":[[lon,lat], ...], "interpolation":"cubic", "level":0}
+        application/octet-stream >> packed little endian float64 lon,lat pairs,
+                                    interpolation and level as query parameters
+        application/msgpack      >> msgpack map as the json body, locations may
+                                    also be packed float64 pairs as above
+
+    Response formats (Accept, defaults to the request format):
+        application/json         >> json object with elevation data
+        application/octet-stream >> packed little endian float32 elevations,
+                                    in the order of the request
+        application/msgpack      >> msgpack map {"elevations":[...]}
     
     Post Args:
         locations:2D array/list of
             lat:float  >> Latitude (y axis), number between -90 and 90
             lon:float  >> Longitude(x axis), number between -180 and 180
         interpolation:str >> Interpolation method (none, linear, nearest, cubic)
+        level:int         >> Resolution level, 0 is full resolution, see /levels
 
     Returns:
         response:object >> json object with elevation data
     
     '''
+    request_format  = binary.content_format(request.headers.get("content-type"))
+    response_format = binary.response_format(
+        request.headers.get("accept"), 
+        request_format
+        )
+    if "msgpack" in (request_format, response_format) and binary.msgpack is None:
+        return util.error_response("msgpack is not available on this server", 415)
+    body = await request.body()
 
-    interpolation = locations.interpolation
-    locations = locations.locations
+    if request_format == "json":
+        try:
+            locations = schemas.Locations.parse_raw(body or b"{}")
+        except ValidationError as e:
+            return util.error_response("body must be an object with a locations array", 422)
+        interpolation = interpolation or locations.interpolation
+        level = locations.level if level is None else level
+        locations = locations.locations
+        for i in locations:
+            if len(i) != 2:
+                return util.error_response(f"'{i}': every location array must contain exactly 2 values")
+    else:
+        if request_format == "binary":
+            parsed = binary.parse_binary(body)
+        else:
+            parsed = binary.parse_msgpack(body)
+        if isinstance(parsed, dict):
+            return util.error_response(parsed)
+        if len(parsed) == 4:
+            interpolation = interpolation or parsed[2]
+            level = parsed[3] if level is None else level
+        interpolation = interpolation or "cubic"
+        level = 0 if level is None else level
+        locations = np.stack(parsed[:2], axis=-1)
     
+    if level not in elevator.overview_levels():
+        return util.error_response(f"level must be in {elevator.overview_levels()}")
     if interpolation not in elevator.INTERPOLATION_METHODS:
-        return {"error":f"interpolation must be in {elevator.INTERPOLATION_METHODS}"}
+        return util.error_response(f"interpolation must be in {elevator.INTERPOLATION_METHODS}")
     else:
         if len(locations) > 100:
-            return {"error":"max 100 locations allowed per request"}
+            return util.error_response("max 100 locations allowed per request")
         else:
-            all_elevations = []
-            for i in locations:
-                if len(i) != 2:
-                    return {"error":f"'{i}': every location array must contain exactly 2 values"}
-                else: 
-                    check = util.check_lat_lon(i[1],i[0])
-                    if check == True:
-                        all_elevations.append({
-                            "elevation": await elevator.get_elevation(
-                                i[1], 
-                                i[0], 
-                                interpolation=interpolation
-                                ),
-                            "location":{
-                                "lat":i[0],
-                                "lon":i[1]
-                                }
-                            }
-                        )
-                    else:   
-                        return check
+            lons, lats = np.array(locations, dtype=np.float64).reshape(-1, 2).T
+            # NaN fails every comparison, so it is out of range as well
+            invalid = ~((np.abs(lats) <= 90) & (np.abs(lons) <= 180))
+            if invalid.any():
+                i = int(np.argmax(invalid))
+                return util.error_response(f"location {i}: lat must be between -90 and 90, lon must be between -180 and 180")
+
+            # one vectorized lookup, every tile is read only once
+            elevations = await elevator.get_elevations(
+                lats, 
+                lons, 
+                interpolation=interpolation,
+                level=level
+                )
+            if response_format == "binary":
+                return Response(binary.encode_binary(elevations), media_type=binary.BINARY)
+            if response_format == "msgpack":
+                return Response(binary.encode_msgpack(elevations), media_type=binary.MSGPACK)
+            all_elevations = [
+                {
+                    "elevation":elevation,
+                    "location":{
+                        "lat":i[0],
+                        "lon":i[1]
+                        }
+                    }
+                for elevation, i in zip(elevations.tolist(), np.stack([lons, lats], axis=-1).tolist())
+                ]
             
             resp = {"results":all_elevations}
             return resp
 
+@router.post("/bulk", dependencies=[Depends(ratelimit.rate_limiter(
+                        times=util.rate_limit, 
+                        seconds=util.rate_reset
+                        ))])
+async def get_elevation_bulk(
+    request: Request,
+    interpolation:str="cubic",
+    format:str=None,
+    level:int=0
+    ):
+    '''
+    Returns elevations for a streamed list of locations of any size
+
+    The request body is read incrementally and processed in chunks of
+    locations, results are streamed back while the body is still
+    being uploaded, so there is no limit of locations per request.
+
+    Request formats (Content-Type):
+        application/x-ndjson >> one location per line, [lon, lat] or
+                                {"lon":8.22, "lat":53.232}
+        text/csv             >> one location per line, lon,lat, an
+                                optional header line names the columns
+        application/octet-stream >> packed little endian float64 lon,lat pairs
+
+    Response formats (format or Accept, defaults to the request format):
+        ndjson >> {"elevation":112.435, "location":{"lat":53.232, "lon":8.22}}
+        csv    >> lon,lat,elevation
+        binary >> packed little endian float32 elevations
+
+    Unparseable locations and locations out of range return an error
+    line ({"error":..., "line":n}, n counts the locations from 1 without
+    header and empty lines) or an empty csv line (-32768 in binary),
+    results keep the order of the request.
+
+    Args:
+        interpolation:str >> Interpolation method (none, linear, nearest, cubic)
+        format:str        >> Response format (ndjson, csv, binary)
+        level:int         >> Resolution level, 0 is full resolution, see /levels
+
+    Returns:
+        response:stream >> ndjson, csv or binary elevation data
+    '''
+    if interpolation not in elevator.INTERPOLATION_METHODS:
+        return util.error_response(f"interpolation must be in {elevator.INTERPOLATION_METHODS}")
+    if level not in elevator.overview_levels():
+        return util.error_response(f"level must be in {elevator.overview_levels()}")
+    if format is not None and format not in streaming.FORMATS:
+        return util.error_response(f"format must be in {list(streaming.FORMATS)}")
+
+    input_format  = streaming.input_format(request.headers.get("content-type"))
+    output_format = format or streaming.output_format(
+        request.headers.get("accept"), 
+        input_format
+        )
+
+    async def results():
+        header = True
+        async for lons, lats, first in streaming.iter_locations(
+                request.stream(), 
+                input_format, 
+                util.bulk_chunk_size,
+                util.bulk_max_line_bytes
+                ):
+            elevations = await elevator.get_elevations(
+                lats, 
+                lons, 
+                interpolation=interpolation,
+                level=level
+                )
+            yield streaming.format_results(
+                lons, lats, elevations, 
+                output_format, 
+                first=first, 
+                header=header
+                )
+            header = False
+
+    return streaming.DuplexStreamingResponse(
+        results(), 
+        media_type=streaming.FORMATS[output_format]
+        )
+
+@router.get("/levels")
+async def get_levels():
+    '''
+    Returns the available resolution levels
+
+    Level 0 is the full resolution (1 arcsecond, 30 meter), level n
+    keeps every 2**n-th sample, the highest level is a single global
+    raster with 15 samples per degree (4 arcminutes).
+
+    Returns:
+        response:object >> json object with levels and their resolution
+    '''
+    levels = []
+    for level in elevator.overview_levels():
+        if level == elevator.GLOBAL_LEVEL:
+            arcseconds = 3600 // ((elevator.global_overview.shape[0] - 1) // 180)
+        else:
+            arcseconds = 2 ** level
+        levels.append({"level":level, "arcseconds":arcseconds, "meter":30 * arcseconds})
+    return {"levels":levels}
+
+@router.post("/profile", response_model=schemas.ProfileResponse,
+                         dependencies=[Depends(ratelimit.rate_limiter(
+                            times=util.rate_limit, 
+                            seconds=util.rate_reset
+                            ))])
+async def get_elevation_profile(
+    profile:schemas.Profile,
+    request: Request,
+    response: Response
+    ):
+    '''
+    Returns elevation profile along a GeoJSON LineString or MultiLineString
+
+    The line is sampled every spacing meters along the great circle,
+    the end of every line is always included. Parts of a MultiLineString
+    are joined, distances continue from the end of the previous part.
+
+    Not found value: -32768, such samples are not counted in ascent/descent
+
+    Post Args:
+        line:dict          >> GeoJSON LineString, MultiLineString or Feature
+                              with [lon, lat] positions
+        spacing:float      >> distance between samples in meters, default 30
+        interpolation:str  >> Interpolation method (none, linear, nearest, cubic)
+
+    Returns:
+        response:object >> json object with length, ascent, descent in meters
+                           and distances, elevations, locations of the samples
+    '''
+    if profile.interpolation not in elevator.INTERPOLATION_METHODS:
+        return util.error_response(f"interpolation must be in {elevator.INTERPOLATION_METHODS}")
+    if not profile.spacing > 0:
+        return util.error_response("spacing must be greater than 0")
+    parts = geo.line_parts(profile.line)
+    if isinstance(parts, dict):
+        return util.error_response(parts)
+    positions = np.concatenate(parts)
+    if not ((np.abs(positions[:, 1]) <= 90) & (np.abs(positions[:, 0]) <= 180)).all():
+        return util.error_response("lat must be between -90 and 90, lon must be between -180 and 180")
+    length = sum(float(geo.haversine(i[:-1, 1], i[:-1, 0], i[1:, 1], i[1:, 0]).sum()) for i in parts)
+    if length / profile.spacing + len(parts) > util.profile_max_samples:
+        return util.error_response(f"max {util.profile_max_samples} samples allowed per request, increase spacing")
+
+    result = await elevator.get_profile(
+        profile.line, 
+        spacing_m=profile.spacing, 
+        interpolation=profile.interpolation
+        )
+    return {
+        "length":result["length"],
+        "ascent":result["ascent"],
+        "descent":result["descent"],
+        "distances":result["distances"].tolist(),
+        "elevations":result["elevations"].tolist(),
+        "locations":np.stack([result["lons"], result["lats"]], axis=-1).tolist()
+        }
+
+@router.post("/area", response_model=schemas.AreaResponse,
+                      dependencies=[Depends(ratelimit.rate_limiter(
+                        times=util.rate_limit, 
+                        seconds=util.rate_reset
+                        ))])
+async def get_elevation_area(
+    area:schemas.Area,
+    request: Request,
+    response: Response
+    ):
+    '''
+    Returns elevation and slope statistics of a bounding box or polygon
+
+    All cells of the raster inside the area are evaluated, data voids
+    are counted but not part of the statistics. Slope is in degrees,
+    aspect is the share of cells facing each compass sector.
+
+    Post Args:
+        area:list|dict     >> bbox [min_lon, min_lat, max_lon, max_lat] or
+                              GeoJSON Polygon, MultiPolygon or Feature
+        percentiles:list   >> percentiles of elevation and slope
+
+    Returns:
+        response:object >> json object with elevation, slope and aspect statistics
+    '''
+    if not all(0 <= i <= 100 for i in area.percentiles):
+        return util.error_response("percentiles must be between 0 and 100")
+    parsed = geo.area_polygons(area.area)
+    if isinstance(parsed, dict):
+        return util.error_response(parsed)
+    min_lon, min_lat, max_lon, max_lat = parsed[1]
+    if not (abs(min_lat) <= 90 and abs(max_lat) <= 90 and abs(min_lon) <= 180 and abs(max_lon) <= 180):
+        return util.error_response("lat must be between -90 and 90, lon must be between -180 and 180")
+    tiles = (max(np.ceil(max_lat) - np.floor(min_lat), 1) 
+             * max(np.ceil(max_lon) - np.floor(min_lon), 1))
+    if tiles > util.area_max_tiles:
+        return util.error_response(f"area must not cover more than {util.area_max_tiles} tiles (1x1 degree)")
+
+    return await elevator.get_area_stats(
+        area.area, 
+        percentiles=tuple(area.percentiles),
+        max_tiles=util.area_max_tiles
+        )
+
+@router.get("/tiles/{z}/{x}/{y}.png", dependencies=[Depends(ratelimit.rate_limiter(
+                                        times=util.tile_rate_limit, 
+                                        seconds=util.rate_reset
+                                        ))])
+async def get_elevation_tile(
+    z:int,
+    x:int,
+    y:int,
+    colormap:str="terrain",
+    hillshade:bool=False,
+    vmin:float=-100,
+    vmax:float=4000
+    ):
+    '''
+    Returns a 256x256 png map tile of the elevation (slippy map scheme,
+    web mercator), e.g. for Leaflet or OpenLayers:
+
+        /v1/elevation/tiles/{z}/{x}/{y}.png?colormap=terrain&hillshade=true
+
+    Data voids are transparent. Low zoom levels are rendered from the
+    overviews if they are built.
+
+    Args:
+        z:int          >> Zoom level, 0 to 20
+        x:int          >> Tile column
+        y:int          >> Tile row
+        colormap:str   >> Colormap of the image
+        hillshade:bool >> Shade the terrain
+        vmin:float     >> Elevation of the first color of the colormap
+        vmax:float     >> Elevation of the last color of the colormap
+
+    Returns:
+        response:image/png >> png image
+    '''
+    if colormap not in elevator.COLORMAPS:
+        return util.error_response(f"colormap must be in {elevator.COLORMAPS}")
+    if not (0 <= z <= render.MAX_ZOOM and 0 <= x < 2 ** z and 0 <= y < 2 ** z):
+        return util.error_response(f"tile {z}/{x}/{y} does not exist, z must be between 0 and {render.MAX_ZOOM}", 404)
+    if not vmin < vmax:
+        return util.error_response("vmin must be smaller than vmax")
+    png = await elevator.render_tile(z, x, y, colormap=colormap, hillshade=hillshade, vmin=vmin, vmax=vmax)
+    return Response(png, media_type="image/png", headers={"Cache-Control":"public, max-age=86400"})
+
 if util.viz_active:
     @router.get("/viz")
     async def get_elevation_viz(
         lat:float,
         lon:float,
-        colormap:str="terrain"
+        colormap:str="terrain",
+        level:int=0
         ):
         '''
         Returns elevation png image of area arround given location
@@ -152,18 +485,29 @@ if util.viz_active:
         Args:
             lat:float  >> Latitude (y axis), number between -90 and 90
             lon:float  >> Longitude(x axis), number between -180 and 180
-            interpolation:str >> Interpolation method (none, linear, nearest, cubic)
+            colormap:str >> Colormap of the image
+            level:int  >> Resolution level, 0 is full resolution, see /levels
 
         Returns:
             response:image/png >> streamed response
         
         '''
+        if level not in elevator.overview_levels():
+            return util.error_response(f"level must be in {elevator.overview_levels()}")
         check = util.check_lat_lon(lat, lon)
         if check == True:
             if colormap in elevator.COLORMAPS:
-                image = elevator.plot_elevation(lat, lon, colormap=colormap)
+                # pyplot runs in the CPU pool, not on the event loop
+                image = await elevator.plot(
+                    lat, 
+                    lon, 
+                    colormap=colormap, 
+                    level=level
+                    )
+                if image is None:
+                    return util.error_response(f"no elevation data at level {level} for this location", 404)
                 return StreamingResponse(image, media_type="image/png")
             else:
-                return {"error":f"colormap must be in {elevator.COLORMAPS}"}
+                return util.error_response(f"colormap must be in {elevator.COLORMAPS}")
         else:
-            return check
\ No newline at end of file
+            return util.error_response(check)
\ No newline at end of file
@@ -4,16 +4,99 @@ Marvin Gabler <m.gabler@predly.com> 2021
 '''
 
 from pydantic import BaseModel
-from typing import Optional, List
+from typing import Optional, List, Union
 
 class Locations(BaseModel):
-    locations: List[List[float]] = [[12.423,52.1333],[8.22, 53.232]]
+    locations: List[List[float]]
     interpolation: str = "linear"
+    level: int = 0
 
+    class Config:
+        schema_extra = {"example":{
+            "locations":[[12.423,52.1333],[8.22, 53.232]],
+            "interpolation":"linear",
+            "level":0
+            }}
+
+# examples are documentation only, a default would be returned in
+# place of missing fields, e.g. of an error object
 class SingleElevationResponse(BaseModel):
-    elevation: float = 112.435
-    location: dict = {"lat":52.44, "lon":8.54}
+    elevation: Optional[float]
+    location: dict
+
+    class Config:
+        schema_extra = {"example":{
+            "elevation":112.435,
+            "location":{"lat":52.44, "lon":8.54}
+            }}
 
 class MultiElevationResponse(BaseModel):
-    results: list = [{"elevation":112.435, "location":{"lat":52.44, "lon":8.54}},
-                     {"elevation":112.435, "location":{"lat":52.44, "lon":8.54}}]
\ No newline at end of file
+    results: list
+
+    class Config:
+        schema_extra = {"example":{
+            "results":[{"elevation":112.435, "location":{"lat":52.44, "lon":8.54}},
+                       {"elevation":112.435, "location":{"lat":52.44, "lon":8.54}}]
+            }}
+
+class Profile(BaseModel):
+    line: dict
+    spacing: float = 30
+    interpolation: str = "linear"
+
+    class Config:
+        schema_extra = {"example":{
+            "line":{"type":"LineString", "coordinates":[[8.22, 53.232],[8.54, 52.44]]},
+            "spacing":30,
+            "interpolation":"linear"
+            }}
+
+class ProfileResponse(BaseModel):
+    length: float
+    ascent: float
+    descent: float
+    distances: list
+    elevations: list
+    locations: list
+
+    class Config:
+        schema_extra = {"example":{
+            "length":89012.3,
+            "ascent":120.5,
+            "descent":112.0,
+            "distances":[0.0, 30.0],
+            "elevations":[112.435, 113.1],
+            "locations":[[8.22, 53.232], [8.2204, 53.2317]]
+            }}
+
+class Area(BaseModel):
+    area: Union[List[float], dict]
+    percentiles: List[float] = [5, 25, 50, 75, 95]
+
+    class Config:
+        schema_extra = {"example":{
+            "area":[8.1, 50.1, 8.3, 50.2],
+            "percentiles":[5, 25, 50, 75, 95]
+            }}
+
+class AreaResponse(BaseModel):
+    bbox: list
+    tiles: int
+    missing_tiles: int
+    voids: int
+    elevation: dict
+    slope: dict
+    aspect: dict
+
+    class Config:
+        schema_extra = {"example":{
+            "bbox":[8.1, 50.1, 8.3, 50.2],
+            "tiles":1,
+            "missing_tiles":0,
+            "voids":0,
+            "elevation":{"count":259560, "min":98.0, "max":412.0, "mean":187.3,
+                         "percentiles":{"5":110.0, "25":142.0, "50":181.0, "75":226.0, "95":310.0}},
+            "slope":{"count":259560, "min":0.0, "max":38.2, "mean":4.1,
+                     "percentiles":{"5":0.4, "25":1.3, "50":2.9, "75":5.6, "95":12.4}},
+            "aspect":{"N":0.12, "NE":0.13, "E":0.12, "SE":0.13, "S":0.12, "SW":0.13, "W":0.12, "NW":0.13}
+            }}
@@ -0,0 +1,233 @@
+'''
+Copyright (C) Predly Technologies - All Rights Reserved
+Marvin Gabler <m.gabler@predly.com> 2021
+'''
+import json
+import numpy as np
+
+from starlette.responses import StreamingResponse
+
+from api import binary
+
+FORMATS = {
+    "ndjson":"application/x-ndjson",
+    "csv":"text/csv",
+    "binary":binary.BINARY
+    }
+
+def input_format(content_type:str):
+    '''
+    Returns bulk format of given request content type
+
+    Args:
+        content_type:str >> Content-Type header of the request
+
+    Returns:
+        format:str >> "csv" for text/csv, "binary" for
+                      application/octet-stream, otherwise "ndjson"
+    '''
+    if content_type and "csv" in content_type:
+        return "csv"
+    if content_type and binary.BINARY in content_type:
+        return "binary"
+    return "ndjson"
+
+def output_format(accept:str, default:str):
+    '''
+    Returns bulk format requested by given accept header
+
+    Args:
+        accept:str  >> Accept header of the request
+        default:str >> format if accept does not name one
+
+    Returns:
+        format:str >> "csv", "ndjson" or "binary"
+    '''
+    if accept:
+        for name, media_type in FORMATS.items():
+            if media_type in accept:
+                return name
+    return default
+
+def _parse_line(line:bytes, fmt:str, columns:tuple):
+    '''
+    Returns lon, lat of a single ndjson or csv line, nan if the
+    line can not be parsed
+    '''
+    try:
+        if fmt == "csv":
+            values = line.split(b",")
+            return float(values[columns[0]]), float(values[columns[1]])
+        location = json.loads(line)
+        if isinstance(location, dict):
+            return float(location["lon"]), float(location["lat"])
+        lon, lat = location
+        return float(lon), float(lat)
+    except (ValueError, KeyError, TypeError, IndexError):
+        return np.nan, np.nan
+
+def _check_range(lons, lats):
+    '''
+    Sets locations outside -180..180, -90..90 to nan, so they are
+    reported as invalid like unparseable lines
+    '''
+    invalid = ~((np.abs(lats) <= 90) & (np.abs(lons) <= 180))
+    if invalid.any():
+        lons, lats = lons.copy(), lats.copy()
+        lons[invalid] = np.nan
+        lats[invalid] = np.nan
+    return lons, lats
+
+async def iter_binary_locations(stream, chunk_size:int=10000):
+    '''
+    Parses packed little endian float64 lon, lat pairs from a
+    streamed request body, see iter_locations. A trailing
+    incomplete pair is ignored.
+    '''
+    chunk_bytes = chunk_size * binary.LOCATION_SIZE
+    buffer = bytearray()
+    first  = 1
+    async for data in stream:
+        buffer += data
+        while len(buffer) >= chunk_bytes:
+            lons, lats = binary.parse_binary(bytes(buffer[:chunk_bytes]))
+            del buffer[:chunk_bytes]
+            yield (*_check_range(lons, lats), first)
+            first += chunk_size
+    size = len(buffer) - len(buffer) % binary.LOCATION_SIZE
+    if size:
+        lons, lats = binary.parse_binary(bytes(buffer[:size]))
+        yield (*_check_range(lons, lats), first)
+
+async def iter_locations(stream, fmt:str="ndjson", chunk_size:int=10000, max_line_bytes:int=4096):
+    '''
+    Parses locations from a streamed request body chunk by chunk,
+    so memory is bounded by chunk_size and max_line_bytes no matter
+    how large the body is
+
+    Every ndjson line is a location [lon, lat] or {"lon":.., "lat":..},
+    every csv line is lon,lat. A csv header line naming the columns
+    lat and lon is used to find them. A binary body consists of
+    packed little endian float64 lon, lat pairs. Lines longer than
+    max_line_bytes are skipped without buffering them and count as
+    invalid locations, as locations out of range do.
+
+    Args:
+        stream:async iterator >> request body, e.g. request.stream()
+        fmt:str               >> "ndjson", "csv" or "binary"
+        chunk_size:int        >> locations per yielded chunk
+        max_line_bytes:int    >> max length of a line
+
+    Returns:
+        async iterator of
+            lons:np.array >> longitudes, nan for invalid locations
+            lats:np.array >> latitudes, nan for invalid locations
+            first:int     >> number of the first location, counted
+                             from 1 without header and empty lines
+    '''
+    if fmt == "binary":
+        async for chunk in iter_binary_locations(stream, chunk_size):
+            yield chunk
+        return
+
+    buffer  = b""
+    columns = (0, 1)
+    header  = fmt == "csv"
+    locations = []
+    first = 1
+
+    async def lines():
+        # None for lines longer than max_line_bytes
+        nonlocal buffer
+        skipping = False
+        async for data in stream:
+            buffer += data
+            *complete, buffer = buffer.split(b"\n")
+            for line in complete:
+                if skipping or len(line) > max_line_bytes:
+                    skipping = False
+                    yield None
+                else:
+                    yield line
+            if len(buffer) > max_line_bytes:
+                buffer = b""
+                skipping = True
+        if skipping:
+            yield None
+        elif buffer:
+            yield buffer
+
+    async for line in lines():
+        if line is None:
+            header = False
+            location = (np.nan, np.nan)
+        else:
+            line = line.strip()
+            if not line:
+                continue
+            if header:
+                header = False
+                names = [i.strip().lower() for i in line.split(b",")]
+                if b"lat" in names and b"lon" in names:
+                    columns = (names.index(b"lon"), names.index(b"lat"))
+                    continue
+            location = _parse_line(line, fmt, columns)
+        locations.append(location)
+        if len(locations) >= chunk_size:
+            lons, lats = np.array(locations, dtype=np.float64).T
+            yield (*_check_range(lons, lats), first)
+            first += len(locations)
+            locations = []
+    if locations:
+        lons, lats = np.array(locations, dtype=np.float64).reshape(-1, 2).T
+        yield (*_check_range(lons, lats), first)
+
+def format_results(lons, lats, elevations, fmt:str="ndjson", first:int=1, header:bool=False):
+    '''
+    Formats a chunk of results
+
+    Args:
+        lons:np.array       >> longitudes
+        lats:np.array       >> latitudes
+        elevations:np.array >> elevations
+        fmt:str             >> "ndjson", "csv" or "binary"
+        first:int           >> number of the first location
+        header:bool         >> prepend the csv header
+
+    Returns:
+        data:bytes >> one line per location, invalid locations
+                      have an error instead of an elevation,
+                      packed little endian float32 elevations for
+                      binary
+    '''
+    if fmt == "binary":
+        return binary.encode_binary(elevations)
+    lines = ["lon,lat,elevation"] if header and fmt == "csv" else []
+    for i, (lon, lat, elevation) in enumerate(zip(lons.tolist(), lats.tolist(), elevations.tolist())):
+        if np.isnan(lon) or np.isnan(lat):
+            if fmt == "csv":
+                lines.append(",,")
+            else:
+                lines.append(json.dumps({"error":"invalid location", "line":first + i}))
+        elif fmt == "csv":
+            lines.append(f"{lon},{lat},{elevation}")
+        else:
+            lines.append(json.dumps({"elevation":elevation, "location":{"lat":lat, "lon":lon}}))
+    return ("\n".join(lines) + "\n").encode()
+
+class DuplexStreamingResponse(StreamingResponse):
+    '''
+    StreamingResponse whose body iterator is still reading the
+    request body while results are sent
+
+    Newer starlette versions listen for client disconnects on
+    receive() while streaming, which would take body chunks away
+    from the iterator. Disconnects are noticed by the iterator
+    reading request.stream() instead.
+    '''
+    async def __call__(self, scope, receive, send):
+        if not hasattr(self, "stream_response"):
+            return await super().__call__(scope, receive, send)
+        await self.stream_response(send)
+        if self.background is not None:
+            await self.background()
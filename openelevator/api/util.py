@@ -4,6 +4,7 @@ Marvin Gabler <m.gabler@predly.com> 2021
 '''
 import os
 import yaml
+from fastapi.responses import JSONResponse
 
 def check_lat_lon(lat:float,lon:float):
     '''
@@ -20,11 +21,28 @@ def check_lat_lon(lat:float,lon:float):
         True:bool  >> book True, if check successfull
         error:dict >> object with error code, if check failed
     '''
-    if not ((90>=lat>=-90) or (180>=lon>=-180)):
+    if not ((90>=lat>=-90) and (180>=lon>=-180)):
         return {"error":"lat must be between -90 and 90, lon must be between -180 and 180"}
     else:
         return True
 
+def error_response(error, status_code:int=400):
+    '''
+    Returns an error as json response with an error status, routes
+    with a response_model must not return error objects, they would
+    be validated against the model
+
+    Args:
+        error:str|dict   >> error message or object with error message
+        status_code:int  >> http status, 400 by default
+
+    Returns:
+        response:JSONResponse >> {"error":...}
+    '''
+    if not isinstance(error, dict):
+        error = {"error":error}
+    return JSONResponse(error, status_code=status_code)
+
 # load config and provide global vars that 
 # are imported by server and routes
 dir_path = os.path.dirname(os.path.realpath(__file__))
@@ -38,7 +56,40 @@ server_host = config_content["server"]["host"]
 server_port = config_content["server"]["port"]
 rate_limit  = config_content["server"]["ratelimit"]
 rate_reset  = config_content["server"]["ratereset"]
+rate_limit_mode    = config_content["server"]["ratelimitmode"]
+rate_sync_interval = config_content["server"]["ratesyncinterval"]
 viz_active  = config_content["server"]["vizactive"]
+bulk_chunk_size = config_content["server"]["bulkchunksize"]
+bulk_max_line_bytes = config_content["server"]["bulkmaxlinebytes"]
+profile_max_samples = config_content["server"]["profilemaxsamples"]
+area_max_tiles      = config_content["server"]["areamaxtiles"]
+tile_rate_limit     = config_content["server"]["tileratelimit"]
+metrics_active  = config_content["server"]["metricsactive"]
+slow_request_ms = config_content["server"]["slowrequestms"]
+workers         = config_content["server"]["workers"]
+
+tile_pool_size = config_content["elevator"]["tilepoolsize"]
+tile_cache_mb  = config_content["elevator"]["tilecachemb"]
+chunk_cache_mb = config_content["elevator"]["chunkcachemb"]
+cache_ttl       = config_content["elevator"]["cachettl"]
+cache_precision = config_content["elevator"]["cacheprecision"]
+cache_maxmemory = config_content["elevator"]["cachemaxmemory"]
+cache_policy    = config_content["elevator"]["cachepolicy"]
+cache_l1_entries   = config_content["elevator"]["cachel1entries"]
+cache_l1_ttl       = config_content["elevator"]["cachel1ttl"]
+cache_negative_ttl = config_content["elevator"]["cachenegativettl"]
+render_cache_entries = config_content["elevator"]["rendercacheentries"]
+io_workers  = config_content["elevator"]["ioworkers"]
+cpu_workers = config_content["elevator"]["cpuworkers"]
+max_pending = config_content["elevator"]["maxpending"]
+fetch_source       = config_content["elevator"]["fetchsource"]
+fetch_endpoint_url = config_content["elevator"]["fetchendpointurl"]
+fetch_max_gb       = config_content["elevator"]["fetchmaxgb"]
+fetch_workers      = config_content["elevator"]["fetchworkers"]
+fetch_negative_ttl = config_content["elevator"]["fetchnegativettl"]
+heatmap_interval = config_content["elevator"]["heatmapinterval"]
+prewarm_tiles    = config_content["elevator"]["prewarmtiles"]
+batch_window_us  = config_content["elevator"]["batchwindowus"]
 
 if config_content["ssl"]["ssl"] == True:
     ssl_key  = config_content["ssl"]["certkey"]
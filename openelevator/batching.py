@@ -0,0 +1,152 @@
+'''
+Coalescing and micro-batching of concurrent single point lookups
+
+Copyright (C) Predly Technologies - All Rights Reserved
+Marvin Gabler <m.gabler@predly.com> 2021
+'''
+
+import asyncio
+import numpy as np
+
+
+def _retrieve(future):
+    if not future.cancelled():
+        future.exception()
+
+
+class PointBatcher():
+    def __init__(self, lookup, window_us=300, max_points=4096):
+        '''
+        Collects concurrent single point lookups and answers them with
+        one vectorized lookup per interpolation and level
+
+        While another batch is looked up, the first point of a batch
+        waits window_us microseconds for further points, a full batch
+        is looked up right away. Otherwise the batch is looked up in the
+        next iteration of the event loop, so a single request does not
+        wait for the window (timers of the event loop are as coarse as
+        a millisecond). Lookups of a location already waiting or in
+        flight share its result (single-flight) instead of adding it
+        again.
+
+        Args:
+            lookup:func     >> coroutine function taking lats, lons,
+                               interpolation and level, returning an
+                               array of elevations, e.g.
+                               OpenElevator.get_elevations
+            window_us:int   >> microseconds the first point waits under
+                               load, 0 collects the points arriving
+                               within the same iteration of the event
+                               loop only
+            max_points:int  >> points per batch
+        '''
+        self.lookup     = lookup
+        self.window     = window_us / 1e6
+        self.max_points = max_points
+        self.batches    = 0
+        self.points     = 0
+        self.coalesced  = 0
+        self._running  = 0
+        self._loop     = None
+        self._inflight = {}
+        self._pending  = {}
+        # the loop keeps weak references to tasks only
+        self._tasks    = set()
+
+    def __getstate__(self):
+        # waiting lookups are bound to the event loop of this process
+        state = self.__dict__.copy()
+        state["_loop"] = None
+        state["_running"] = 0
+        state["_inflight"] = {}
+        state["_pending"]  = {}
+        state["_tasks"]    = set()
+        return state
+
+    async def get(self, lat, lon, interpolation="cubic", level=0):
+        '''
+        Looks up a single point as part of the next batch
+
+        Returns:
+            elevation:float >> elevation of the point, None if the
+                               lookup returned None
+        '''
+        loop = asyncio.get_running_loop()
+        if loop is not self._loop:
+            # batches of a closed loop never complete
+            self._loop = loop
+            self._running  = 0
+            self._inflight = {}
+            self._pending  = {}
+            self._tasks    = set()
+
+        key = (lat, lon, interpolation, level)
+        future = self._inflight.get(key)
+        if future is not None:
+            self.coalesced += 1
+        else:
+            future = self._inflight[key] = loop.create_future()
+            # the error of a failed batch is retrieved even if every
+            # request waiting for it was cancelled meanwhile
+            future.add_done_callback(_retrieve)
+            group = (interpolation, level)
+            batch = self._pending.get(group)
+            if batch is None:
+                batch = self._pending[group] = []
+                if self.window > 0 and self._running:
+                    loop.call_later(self.window, self._flush, group, batch)
+                else:
+                    loop.call_soon(self._flush, group, batch)
+            batch.append((key, future))
+            if len(batch) >= self.max_points:
+                self._flush(group, batch)
+        # a cancelled request must not cancel the lookup of the others
+        return await asyncio.shield(future)
+
+    def _flush(self, group, batch):
+        '''
+        Starts the lookup of a batch, unless it was started already
+        '''
+        if self._pending.get(group) is not batch:
+            return
+        del self._pending[group]
+        task = asyncio.ensure_future(self._run(group, batch))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _run(self, group, batch):
+        interpolation, level = group
+        lats = np.array([key[0] for key, _ in batch], dtype=np.float64)
+        lons = np.array([key[1] for key, _ in batch], dtype=np.float64)
+        self.batches += 1
+        self.points  += len(batch)
+        self._running += 1
+        try:
+            elevations = await self.lookup(lats, lons, interpolation=interpolation, level=level)
+        except Exception as e:
+            for key, future in batch:
+                self._inflight.pop(key, None)
+                if not future.done():
+                    future.set_exception(e)
+            return
+        finally:
+            self._running -= 1
+        for i, (key, future) in enumerate(batch):
+            self._inflight.pop(key, None)
+            if not future.done():
+                future.set_result(None if elevations is None else float(elevations[i]))
+
+    def stats(self):
+        '''
+        Returns batching counters
+
+        Returns:
+            stats:dict >> batches, points looked up, lookups coalesced
+                          with a waiting one and points per batch
+        '''
+        return {
+            "batches":self.batches,
+            "points":self.points,
+            "coalesced":self.coalesced,
+            "points_per_batch":self.points / self.batches if self.batches else 0.0
+            }
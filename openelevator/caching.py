@@ -0,0 +1,313 @@
+'''
+Caching of elevation lookup results
+
+Copyright (C) Predly Technologies - All Rights Reserved
+Marvin Gabler <m.gabler@predly.com> 2021
+'''
+
+import time
+import threading
+import numpy as np
+from collections import OrderedDict
+
+# data void as in SRTM documentation
+VOID = -32768
+
+
+class LRUCache():
+    def __init__(self, max_entries=100000, ttl=300):
+        '''
+        Bounded in-process least-recently-used cache with time to live
+
+        Args:
+            max_entries:int >> max amount of entries, 0 disables the cache
+            ttl:float       >> default time to live of entries in seconds
+        '''
+        self.max_entries = max_entries
+        self.ttl         = ttl
+        self.hits      = 0
+        self.misses    = 0
+        self.evictions = 0
+        self.expirations = 0
+        self._entries = OrderedDict()
+        self._lock    = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __getstate__(self):
+        # open handles and locks are not passed to worker processes
+        state = self.__dict__.copy()
+        state["_entries"] = OrderedDict()
+        del state["_lock"]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        '''
+        Returns value of given key or default if absent or expired
+        '''
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return default
+            value, expires = entry
+            if expires < time.monotonic():
+                del self._entries[key]
+                self.expirations += 1
+                self.misses += 1
+                return default
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def set(self, key, value, ttl=None):
+        '''
+        Stores value for ttl seconds, evicts least recently used
+        entries if the cache is full
+        '''
+        if self.max_entries <= 0:
+            return
+        expires = time.monotonic() + (self.ttl if ttl is None else ttl)
+        with self._lock:
+            self._entries[key] = (value, expires)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def get_many(self, keys):
+        '''
+        Looks up keys
+
+        Args:
+            keys:list >> str keys
+
+        Returns:
+            values:np.array >> cached values, nan for misses
+        '''
+        return np.array([self.get(key, np.nan) for key in keys], dtype=np.float64)
+
+    def set_many(self, keys, values, ttl=None):
+        for key, value in zip(keys, np.ravel(values).tolist()):
+            self.set(key, value, ttl=ttl)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        '''
+        Returns cache counters
+
+        Returns:
+            stats:dict >> hits, misses, evictions, expirations,
+                          hit_ratio and entries
+        '''
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "hits":self.hits,
+                "misses":self.misses,
+                "evictions":self.evictions,
+                "expirations":self.expirations,
+                "hit_ratio":self.hits / lookups if lookups else 0.0,
+                "entries":len(self._entries)
+                }
+
+
+class ResultCache():
+    def __init__(self, redis, prefix="elevation", ttl=86400, precision=8,
+                 maxmemory=None, maxmemory_policy=None, l1_entries=100000,
+                 l1_ttl=300, negative_ttl=3600):
+        '''
+        Two tier cache for elevation lookup results
+
+        A bounded in-process LRUCache (L1) is kept in front of redis
+        (L2), which is shared between processes, so hot locations are
+        served without a network hop. L2 hits are copied to L1.
+
+        Keys are quantized to the dataset grid instead of the raw
+        float coordinates, so nearby lookups share entries: nearest
+        lookups are keyed by the grid cell, interpolated lookups by
+        1/precision of a grid cell (about 30/precision meters). Batch
+        lookups are served by a single MGET and stored by a single
+        pipeline, so a batch costs two round trips at most.
+
+        Data voids (-32768) are cached as well (negative caching),
+        with their own time to live.
+
+        Args:
+            redis:object          >> aioredis client, None for L1 only
+            prefix:str            >> namespace of the cache keys
+            ttl:int               >> time to live of L2 entries in seconds,
+                                     0 or None keeps them forever
+            precision:int         >> subdivisions of a grid cell for
+                                     interpolated lookups
+            maxmemory:str         >> redis memory limit, e.g. "2gb",
+                                     applied via CONFIG SET if given
+            maxmemory_policy:str  >> redis eviction policy, e.g.
+                                     "allkeys-lru", applied if given
+            l1_entries:int        >> max entries of L1, 0 disables L1
+            l1_ttl:float          >> time to live of L1 entries in seconds
+            negative_ttl:int      >> time to live of data voids in seconds
+        '''
+        self.redis     = redis
+        self.prefix    = prefix
+        self.ttl       = ttl
+        self.precision = precision
+        self.maxmemory = maxmemory
+        self.maxmemory_policy = maxmemory_policy
+        self.negative_ttl = negative_ttl
+        self.l1 = LRUCache(max_entries=l1_entries, ttl=l1_ttl)
+        # L2 counters
+        self.l2_hits   = 0
+        self.l2_misses = 0
+        self.l2_errors = 0
+        self.negative_hits = 0
+        self._configured = False
+
+    async def configure(self):
+        '''
+        Applies the size policy to redis once, managed redis
+        instances might not allow CONFIG SET
+        '''
+        if self._configured or self.redis is None:
+            return
+        self._configured = True
+        try:
+            if self.maxmemory:
+                await self.redis.config_set("maxmemory", self.maxmemory)
+            if self.maxmemory_policy:
+                await self.redis.config_set("maxmemory-policy", self.maxmemory_policy)
+        except Exception as e:
+            print(f"Could not apply redis size policy: {e}")
+
+    def quantize(self, rows, cols, interpolation):
+        '''
+        Snaps fractional tile positions to the key grid
+
+        Args:
+            rows:np.array     >> fractional row positions on the tile
+            cols:np.array     >> fractional col positions on the tile
+            interpolation:str >> interpolation method
+
+        Returns:
+            key_rows:np.array >> integer row positions on the key grid
+            key_cols:np.array >> integer col positions on the key grid
+            rows:np.array     >> snapped fractional row positions
+            cols:np.array     >> snapped fractional col positions
+        '''
+        step = 1 if interpolation in ("none", "nearest") else self.precision
+        key_rows = np.rint(np.asarray(rows) * step).astype(np.int64)
+        key_cols = np.rint(np.asarray(cols) * step).astype(np.int64)
+        return key_rows, key_cols, key_rows / step, key_cols / step
+
+    def keys(self, tile_ids, key_rows, key_cols, interpolation):
+        '''
+        Returns cache keys of quantized positions
+
+        Args:
+            tile_ids:np.array >> integer tile ids
+            key_rows:np.array >> integer row positions on the key grid
+            key_cols:np.array >> integer col positions on the key grid
+            interpolation:str >> interpolation method
+
+        Returns:
+            keys:list >> str keys
+        '''
+        step = 1 if interpolation in ("none", "nearest") else self.precision
+        return [
+            f"{self.prefix}:{interpolation}:{step}:{tile_id}:{row}:{col}"
+            for tile_id, row, col in zip(
+                np.ravel(tile_ids).tolist(),
+                np.ravel(key_rows).tolist(),
+                np.ravel(key_cols).tolist()
+                )
+            ]
+
+    async def get_many(self, keys):
+        '''
+        Looks up keys in L1, the remaining ones with a single
+        MGET in L2. Redis errors are counted and treated as misses.
+
+        Args:
+            keys:list >> str keys
+
+        Returns:
+            values:np.array >> cached values, nan for misses
+        '''
+        values = self.l1.get_many(keys)
+        missing = np.nonzero(np.isnan(values))[0]
+        if missing.size and self.redis is not None:
+            await self.configure()
+            try:
+                l2_values = await self.redis.mget([keys[i] for i in missing])
+            except Exception as e:
+                self.l2_errors += 1
+                l2_values = [None] * missing.size
+            for i, value in zip(missing.tolist(), l2_values):
+                if value is None:
+                    self.l2_misses += 1
+                else:
+                    self.l2_hits += 1
+                    values[i] = float(value)
+                    self.l1.set(keys[i], values[i])
+        self.negative_hits += int(np.count_nonzero(values == VOID))
+        return values
+
+    async def set_many(self, keys, values):
+        '''
+        Stores keys in L1 and in L2 with their ttl in a single
+        pipeline, data voids with the negative ttl
+
+        Args:
+            keys:list        >> str keys
+            values:np.array  >> values to store
+        '''
+        if not keys:
+            return
+        values = np.ravel(values).tolist()
+        for key, value in zip(keys, values):
+            self.l1.set(key, value)
+        if self.redis is None:
+            return
+
+        pipe = self.redis.pipeline(transaction=False)
+        if self.ttl or self.negative_ttl:
+            for key, value in zip(keys, values):
+                ttl = self.negative_ttl if value == VOID else self.ttl
+                if ttl:
+                    pipe.set(key, value, ex=ttl)
+                else:
+                    pipe.set(key, value)
+        else:
+            pipe.mset(dict(zip(keys, values)))
+        try:
+            await pipe.execute()
+        except Exception as e:
+            self.l2_errors += 1
+
+    def stats(self):
+        '''
+        Returns counters per cache tier
+
+        Returns:
+            stats:dict >> l1 (see LRUCache.stats()), l2 hits, misses,
+                          errors and hit_ratio, negative_hits
+        '''
+        lookups = self.l2_hits + self.l2_misses
+        return {
+            "l1":self.l1.stats(),
+            "l2":{
+                "hits":self.l2_hits,
+                "misses":self.l2_misses,
+                "errors":self.l2_errors,
+                "hit_ratio":self.l2_hits / lookups if lookups else 0.0
+                },
+            "negative_hits":self.negative_hits
+            }
@@ -0,0 +1,185 @@
+'''
+Execution layer keeping blocking work off the asyncio event loop
+
+Copyright (C) Predly Technologies - All Rights Reserved
+Marvin Gabler <m.gabler@predly.com> 2021
+'''
+
+import asyncio
+import threading
+from functools import partial
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+
+# object of the process pool workers, see _init_worker()
+_worker = None
+
+
+def _init_worker(factory, kwargs):
+    '''
+    Creates the object of a process pool worker once at start
+    '''
+    global _worker
+    _worker = factory(**kwargs)
+
+
+def _call_worker(method, args, kwargs):
+    '''
+    Calls a method of the object of a process pool worker
+    '''
+    return getattr(_worker, method)(*args, **kwargs)
+
+
+class Executor():
+    def __init__(self, target, io_workers=16, cpu_workers=0, max_pending=256,
+                 worker_factory=None, worker_kwargs=None):
+        '''
+        Thread pool for blocking I/O and NumPy work and process pool
+        for heavy jobs like rendering, awaited by the async API
+
+        Memory-mapped reads page in from disk and NumPy releases the
+        GIL for most array operations, so both run well in threads.
+        Rendering holds the GIL much longer (and pyplot is not thread
+        safe), so it runs in worker processes, every worker creates its
+        own target object with worker_factory(**worker_kwargs) once.
+
+        Both pools accept at most max_pending jobs at once, further
+        callers wait on the event loop until a slot is free, so a burst
+        of slow requests queues up instead of piling up unbounded work.
+
+        Args:
+            target:object       >> object whose methods run_cpu calls
+                                   in threads without a process pool
+            io_workers:int      >> threads of the I/O pool, 0 runs jobs
+                                   inline on the event loop
+            cpu_workers:int     >> processes of the CPU pool, 0 runs CPU
+                                   jobs in the I/O pool
+            max_pending:int     >> max jobs submitted per pool at once
+            worker_factory:func >> creates the target of a worker process
+            worker_kwargs:dict  >> keyword arguments of worker_factory
+        '''
+        self.target      = target
+        self.io_workers  = io_workers
+        self.cpu_workers = cpu_workers if worker_factory is not None else 0
+        self.max_pending = max_pending
+        self.worker_factory = worker_factory
+        self.worker_kwargs  = worker_kwargs or {}
+        self.pending = {"io":0, "cpu":0}
+        self._threads   = None
+        self._processes = None
+        self._limits = {}
+        self._lock   = threading.Lock()
+
+    def __getstate__(self):
+        # pools and locks are not passed to worker processes
+        state = self.__dict__.copy()
+        state["_threads"]   = None
+        state["_processes"] = None
+        state["_limits"]    = {}
+        state["pending"]    = {"io":0, "cpu":0}
+        del state["_lock"]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+    def _pool(self, kind):
+        '''
+        Returns the pool of given kind, pools are started on first use
+        '''
+        with self._lock:
+            if kind == "cpu" and self.cpu_workers > 0:
+                if self._processes is None:
+                    self._processes = ProcessPoolExecutor(
+                        max_workers=self.cpu_workers,
+                        initializer=_init_worker,
+                        initargs=(self.worker_factory, self.worker_kwargs)
+                        )
+                return self._processes
+            if self.io_workers > 0:
+                if self._threads is None:
+                    self._threads = ThreadPoolExecutor(
+                        max_workers=self.io_workers,
+                        thread_name_prefix="openelevator"
+                        )
+                return self._threads
+            return None
+
+    def _limit(self, kind):
+        '''
+        Returns the semaphore bounding the jobs of given kind on
+        the running event loop
+        '''
+        loop = asyncio.get_running_loop()
+        limit = self._limits.get((kind, loop))
+        if limit is None:
+            limit = asyncio.Semaphore(self.max_pending)
+            self._limits = {(kind, loop):limit, **{
+                key:value for key, value in self._limits.items() if not key[1].is_closed()
+                }}
+        return limit
+
+    async def _run(self, kind, pool, func):
+        async with self._limit(kind):
+            self.pending[kind] += 1
+            try:
+                return await asyncio.get_running_loop().run_in_executor(pool, func)
+            finally:
+                self.pending[kind] -= 1
+
+    async def run_io(self, func, *args, **kwargs):
+        '''
+        Runs func(*args, **kwargs) in the I/O thread pool
+
+        Returns:
+            result:object >> return value of func
+        '''
+        pool = self._pool("io")
+        if pool is None:
+            return func(*args, **kwargs)
+        return await self._run("io", pool, partial(func, *args, **kwargs))
+
+    async def run_cpu(self, method, *args, **kwargs):
+        '''
+        Runs the method of given name in the CPU process pool, on the
+        target of the worker, or on self.target in the I/O pool without
+        a process pool. Arguments and return value must be picklable.
+
+        Args:
+            method:str >> method name of the target
+
+        Returns:
+            result:object >> return value of the method
+        '''
+        pool = self._pool("cpu")
+        if pool is None:
+            return getattr(self.target, method)(*args, **kwargs)
+        if pool is self._threads:
+            return await self._run("io", pool, partial(getattr(self.target, method), *args, **kwargs))
+        return await self._run("cpu", pool, partial(_call_worker, method, args, kwargs))
+
+    def stats(self):
+        '''
+        Returns the configuration and the jobs currently submitted
+
+        Returns:
+            stats:dict >> io_workers, cpu_workers, max_pending and
+                          pending jobs per pool
+        '''
+        return {
+            "io_workers":self.io_workers,
+            "cpu_workers":self.cpu_workers,
+            "max_pending":self.max_pending,
+            "pending":dict(self.pending)
+            }
+
+    def shutdown(self, wait=True):
+        '''
+        Stops the pools, they are started again on next use
+        '''
+        with self._lock:
+            for pool in (self._threads, self._processes):
+                if pool is not None:
+                    pool.shutdown(wait=wait)
+            self._threads   = None
+            self._processes = None
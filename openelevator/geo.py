@@ -0,0 +1,247 @@
+'''
+Geodesic helpers for GeoJSON geometries
+
+All distances are great circle distances on a sphere with the
+mean earth radius, which is accurate to about 0.5% and far below
+the resolution of the dataset for the short segments of tracks.
+Coordinates follow GeoJSON, [lon, lat] in degrees.
+
+Copyright (C) Predly Technologies - All Rights Reserved
+Marvin Gabler <m.gabler@predly.com> 2021
+'''
+
+import numpy as np
+
+# mean earth radius in meters (IUGG)
+EARTH_RADIUS = 6371008.8
+
+
+def haversine(lats1, lons1, lats2, lons2):
+    '''
+    Great circle distance between points, vectorized
+
+    Args:
+        lats1:np.array >> latitudes of the start points
+        lons1:np.array >> longitudes of the start points
+        lats2:np.array >> latitudes of the end points
+        lons2:np.array >> longitudes of the end points
+
+    Returns:
+        distances:np.array >> distances in meters
+    '''
+    lats1, lons1, lats2, lons2 = map(np.radians, (lats1, lons1, lats2, lons2))
+    a = np.sin((lats2 - lats1) / 2) ** 2 \
+        + np.cos(lats1) * np.cos(lats2) * np.sin((lons2 - lons1) / 2) ** 2
+    return 2 * EARTH_RADIUS * np.arcsin(np.sqrt(np.clip(a, 0, 1)))
+
+
+def _to_vectors(lats, lons):
+    '''
+    Returns unit vectors of given lats, lons in degrees
+    '''
+    lats, lons = np.radians(lats), np.radians(lons)
+    return np.stack([
+        np.cos(lats) * np.cos(lons),
+        np.cos(lats) * np.sin(lons),
+        np.sin(lats)
+        ], axis=-1)
+
+
+def _from_vectors(vectors):
+    '''
+    Returns lats, lons in degrees of given unit vectors
+    '''
+    lats = np.degrees(np.arctan2(vectors[..., 2], np.hypot(vectors[..., 0], vectors[..., 1])))
+    lons = np.degrees(np.arctan2(vectors[..., 1], vectors[..., 0]))
+    return lats, lons
+
+
+def line_parts(geometry):
+    '''
+    Returns the parts of a GeoJSON LineString or MultiLineString
+
+    Args:
+        geometry:dict >> GeoJSON geometry or Feature with a
+                         LineString or MultiLineString geometry
+
+    Returns:
+        parts:list >> np.array of [lon, lat] per part
+            OR
+        error:dict >> object with error message
+    '''
+    if not isinstance(geometry, dict):
+        return {"error":"line must be a GeoJSON object"}
+    if geometry.get("type") == "Feature":
+        geometry = geometry.get("geometry") or {}
+    kind = geometry.get("type")
+    coordinates = geometry.get("coordinates")
+    if kind == "LineString":
+        coordinates = [coordinates]
+    elif kind != "MultiLineString":
+        return {"error":"line must be a GeoJSON LineString or MultiLineString"}
+
+    parts = []
+    try:
+        for part in coordinates:
+            # altitudes as third value are dropped
+            part = np.array([point[:2] for point in part], dtype=np.float64).reshape(-1, 2)
+            if len(part) < 2:
+                return {"error":"every line must consist of at least 2 positions"}
+            parts.append(part)
+    except (TypeError, ValueError):
+        return {"error":"positions must be arrays of [lon, lat]"}
+    if not parts:
+        return {"error":"line must not be empty"}
+    return parts
+
+
+def densify(part, spacing):
+    '''
+    Samples a line at fixed geodesic spacing, vectorized
+
+    Samples are placed every spacing meters along the line, on the
+    great circle of their segment, the end of the line is always
+    included. Positions of the line are not kept unless they fall
+    on the spacing.
+
+    Args:
+        part:np.array  >> [lon, lat] positions of the line
+        spacing:float  >> distance between samples in meters
+
+    Returns:
+        lons:np.array      >> longitudes of the samples
+        lats:np.array      >> latitudes of the samples
+        distances:np.array >> distance of the samples from the start
+                              of the line in meters
+    '''
+    lons, lats = part[:, 0], part[:, 1]
+    segments = haversine(lats[:-1], lons[:-1], lats[1:], lons[1:])
+    cumulative = np.concatenate([[0.0], np.cumsum(segments)])
+    length = cumulative[-1]
+
+    distances = np.arange(0.0, length, spacing)
+    distances = np.append(distances, length)
+
+    # segment of every sample and fraction along it
+    segment = np.clip(np.searchsorted(cumulative, distances, side="right") - 1, 0, len(segments) - 1)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        fraction = np.where(
+            segments[segment] > 0,
+            (distances - cumulative[segment]) / segments[segment],
+            0.0
+            )
+    fraction = np.clip(fraction, 0.0, 1.0)
+
+    # spherical linear interpolation between the segment ends
+    start = _to_vectors(lats[segment], lons[segment])
+    end   = _to_vectors(lats[segment + 1], lons[segment + 1])
+    omega = segments[segment] / EARTH_RADIUS
+    sin_omega = np.sin(omega)
+    short = sin_omega < 1e-12
+    with np.errstate(invalid="ignore", divide="ignore"):
+        w_start = np.where(short, 1.0 - fraction, np.sin((1.0 - fraction) * omega) / sin_omega)
+        w_end   = np.where(short, fraction, np.sin(fraction * omega) / sin_omega)
+    vectors = w_start[:, None] * start + w_end[:, None] * end
+    sample_lats, sample_lons = _from_vectors(vectors)
+    return sample_lons, sample_lats, distances
+
+
+def area_polygons(area):
+    '''
+    Returns the polygons of a bbox or GeoJSON Polygon or MultiPolygon
+
+    Args:
+        area:list|dict >> bbox [min_lon, min_lat, max_lon, max_lat] or
+                          GeoJSON geometry or Feature with a Polygon or
+                          MultiPolygon geometry
+
+    Returns:
+        polygons:list >> list of rings (np.array of [lon, lat]) per
+                         polygon, the first ring is the outer one,
+                         None for a bbox
+        bbox:tuple    >> min_lon, min_lat, max_lon, max_lat
+            OR
+        error:dict    >> object with error message
+    '''
+    if isinstance(area, (list, tuple)):
+        try:
+            min_lon, min_lat, max_lon, max_lat = [float(i) for i in area]
+        except (TypeError, ValueError):
+            return {"error":"bbox must be [min_lon, min_lat, max_lon, max_lat]"}
+        if not (min_lon < max_lon and min_lat < max_lat):
+            return {"error":"bbox must be [min_lon, min_lat, max_lon, max_lat]"}
+        return None, (min_lon, min_lat, max_lon, max_lat)
+
+    if not isinstance(area, dict):
+        return {"error":"area must be a bbox or a GeoJSON object"}
+    if area.get("type") == "Feature":
+        area = area.get("geometry") or {}
+    kind = area.get("type")
+    coordinates = area.get("coordinates")
+    if kind == "Polygon":
+        coordinates = [coordinates]
+    elif kind != "MultiPolygon":
+        return {"error":"area must be a GeoJSON Polygon or MultiPolygon"}
+
+    polygons = []
+    try:
+        for polygon in coordinates:
+            rings = [
+                np.array([point[:2] for point in ring], dtype=np.float64).reshape(-1, 2)
+                for ring in polygon
+                ]
+            if not rings or any(len(ring) < 3 for ring in rings):
+                return {"error":"every polygon ring must consist of at least 3 positions"}
+            polygons.append(rings)
+    except (TypeError, ValueError):
+        return {"error":"positions must be arrays of [lon, lat]"}
+    if not polygons:
+        return {"error":"area must not be empty"}
+    points = np.concatenate([ring for polygon in polygons for ring in polygon])
+    bbox = (points[:, 0].min(), points[:, 1].min(), points[:, 0].max(), points[:, 1].max())
+    return polygons, tuple(float(i) for i in bbox)
+
+
+def polygon_mask(polygons, lats, lons):
+    '''
+    Rasterizes polygons on a grid by scanline, vectorized
+
+    For every row, the crossings of all polygon edges with the row
+    latitude are sorted, the cells between pairs of crossings are
+    inside (even-odd rule, so holes are excluded).
+
+    Args:
+        polygons:list  >> list of rings per polygon, see area_polygons
+        lats:np.array  >> latitudes of the grid rows
+        lons:np.array  >> ascending longitudes of the grid cols
+
+    Returns:
+        mask:np.array >> bool (rows, cols), True inside the polygons
+    '''
+    lats = np.asarray(lats, dtype=np.float64)
+    mask = np.zeros((len(lats), len(lons)), dtype=bool)
+    for polygon in polygons:
+        edges = np.concatenate([
+            np.stack([ring, np.roll(ring, -1, axis=0)], axis=1) for ring in polygon
+            ])
+        (x0, y0), (x1, y1) = edges[:, 0].T, edges[:, 1].T
+        # rows x edges crossings, in blocks to bound memory
+        block = max(1, 2**22 // len(edges))
+        for first in range(0, len(lats), block):
+            y = lats[first:first + block, None]
+            # half open rule, so vertices are not counted twice
+            crosses = (y0 <= y) != (y1 <= y)
+            with np.errstate(invalid="ignore", divide="ignore"):
+                x = np.where(crosses, x0 + (y - y0) * (x1 - x0) / (y1 - y0), np.nan)
+            x = np.sort(x, axis=1)
+            if x.shape[1] % 2:
+                x = np.pad(x, ((0, 0), (0, 1)), constant_values=np.nan)
+            valid  = ~np.isnan(x[:, 1::2].ravel())
+            starts = np.searchsorted(lons, x[:, 0::2].ravel()[valid])
+            ends   = np.searchsorted(lons, x[:, 1::2].ravel()[valid], side="right")
+            rows   = np.repeat(np.arange(len(y)), x.shape[1] // 2)[valid]
+            counts = np.zeros((len(y), len(lons) + 1), dtype=np.int32)
+            np.add.at(counts, (rows, starts), 1)
+            np.add.at(counts, (rows, ends), -1)
+            mask[first:first + block] |= np.cumsum(counts[:, :-1], axis=1) > 0
+    return mask
@@ -0,0 +1,589 @@
+'''
+Streaming ingestion of the gzipped SRTM tiles
+
+Every object is streamed from its source, decompressed on the fly
+and written straight to the data directory, so neither a temporary
+copy of the compressed dataset nor a second extraction pass is
+needed. A manifest records size and sha256 of every ingested tile,
+interrupted runs resume from it and ingested tiles can be verified
+against it.
+
+Copyright (C) Predly Technologies - All Rights Reserved
+Marvin Gabler <m.gabler@predly.com> 2021
+'''
+
+import os
+import gzip
+import fcntl
+import json
+import time
+import hashlib
+import threading
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor, as_completed
+
+import numpy as np
+from tqdm import tqdm
+
+from tiles import TileIndex
+
+BLOCK_SIZE = 1024 * 1024
+
+
+class NotInSource(FileNotFoundError):
+    '''
+    The source does not have an object, unlike other FileNotFoundErrors
+    raised while writing the tile
+    '''
+
+
+def region_tiles(regions):
+    '''
+    Returns the names of all tiles covering given regions
+
+    Args:
+        regions:list >> bboxes [min_lon, min_lat, max_lon, max_lat]
+
+    Returns:
+        tiles:set >> tile names, e.g. N50E008.hgt
+            OR
+        error:dict >> object with error message
+    '''
+    tiles = set()
+    for bbox in regions:
+        if len(bbox) != 4 or not (bbox[0] <= bbox[2] and bbox[1] <= bbox[3]):
+            return {"error":"regions must be bboxes [min_lon, min_lat, max_lon, max_lat]"}
+        min_lon, min_lat = max(bbox[0], -180.0), max(bbox[1], -90.0)
+        max_lon, max_lat = min(bbox[2], 180.0), min(bbox[3], 90.0)
+        # SW corners, a border on full degrees belongs to the tile below/left
+        first_lat = min(int(np.floor(min_lat)), 89)
+        first_lon = min(int(np.floor(min_lon)), 179)
+        for lat in range(first_lat, max(min(int(np.ceil(max_lat)), 90), first_lat + 1)):
+            for lon in range(first_lon, max(min(int(np.ceil(max_lon)), 180), first_lon + 1)):
+                tiles.add(TileIndex.tile_name(lat, lon))
+    return tiles
+
+
+class LocalSource():
+    def __init__(self, directory):
+        '''
+        Gzipped hgt files in a local directory (any depth), e.g. a
+        copy of the bucket made with the aws cli
+
+        Args:
+            directory:str >> directory containing *.hgt.gz files
+        '''
+        self.directory = directory
+
+    def list(self, tiles=None):
+        '''
+        Returns the keys and sizes of all gzipped hgt files
+
+        Args:
+            tiles:set >> list only these tile names, None for all
+
+        Returns:
+            objects:list >> (key, size) tuples, keys relative to the directory
+        '''
+        objects = []
+        for root, _, files in os.walk(self.directory):
+            for name in files:
+                if name.endswith(".hgt.gz") and (tiles is None or name[:-3] in tiles):
+                    path = os.path.join(root, name)
+                    objects.append((os.path.relpath(path, self.directory), os.path.getsize(path)))
+        return sorted(objects)
+
+    def key(self, tile):
+        '''
+        Returns the key of given tile name, in the layout of the
+        bucket (N50/N50E008.hgt.gz) or directly in the directory
+        '''
+        key = os.path.join(tile[:3], tile + ".gz")
+        if os.path.isfile(os.path.join(self.directory, key)):
+            return key
+        return tile + ".gz"
+
+    def open(self, key):
+        '''
+        Returns a binary file object of given key, raises
+        FileNotFoundError if it does not exist
+        '''
+        return open(os.path.join(self.directory, key), "rb")
+
+
+class S3Source():
+    def __init__(self, bucket="elevation-tiles-prod", prefix="skadi", endpoint_url=None, signed=False):
+        '''
+        Gzipped hgt files in a s3 bucket
+
+        Args:
+            bucket:str        >> bucket name
+            prefix:str        >> key prefix of the tiles
+            endpoint_url:str  >> url of a s3 compatible server, e.g. a
+                                 local stand-in, None for AWS
+            signed:bool       >> sign requests with the configured
+                                 credentials, the public dataset needs none
+        '''
+        import boto3
+        from botocore import UNSIGNED
+        from botocore.config import Config
+
+        self.bucket = bucket
+        self.prefix = prefix
+        config = Config(max_pool_connections=64, retries={"max_attempts":5})
+        if not signed:
+            config = config.merge(Config(signature_version=UNSIGNED))
+        # clients are thread safe, one is shared by all workers
+        self.client = boto3.client("s3", endpoint_url=endpoint_url, config=config)
+
+    def list(self, tiles=None):
+        '''
+        Returns the keys and sizes of all gzipped hgt files
+
+        Args:
+            tiles:set >> list only these tile names, None for all,
+                         only their latitude folders are listed
+
+        Returns:
+            objects:list >> (key, size) tuples
+        '''
+        if tiles is None:
+            prefixes = [self.prefix]
+        else:
+            prefixes = sorted({f"{self.prefix}/{tile[:3]}/" for tile in tiles})
+        objects = []
+        paginator = self.client.get_paginator("list_objects_v2")
+        for prefix in prefixes:
+            for page in paginator.paginate(Bucket=self.bucket, Prefix=prefix):
+                for item in page.get("Contents", []):
+                    name = os.path.basename(item["Key"])
+                    if name.endswith(".hgt.gz") and (tiles is None or name[:-3] in tiles):
+                        objects.append((item["Key"], item["Size"]))
+        return objects
+
+    def key(self, tile):
+        '''
+        Returns the key of given tile name, e.g. skadi/N50/N50E008.hgt.gz
+        '''
+        return f"{self.prefix}/{tile[:3]}/{tile}.gz"
+
+    def open(self, key):
+        '''
+        Returns the streaming body of given key, raises
+        FileNotFoundError if it does not exist
+        '''
+        from botocore.exceptions import ClientError
+
+        try:
+            return self.client.get_object(Bucket=self.bucket, Key=key)["Body"]
+        except ClientError as e:
+            if e.response.get("Error", {}).get("Code") in ("NoSuchKey", "404"):
+                raise FileNotFoundError(key) from e
+            raise
+
+
+class Ingestor():
+    MANIFEST = "manifest.json"
+
+    def __init__(self, source, data_dir, samples=3601, workers=16, retries=3):
+        '''
+        Ingests tiles of a source into data_dir
+
+        Objects are handed to a pool of workers one at a time, so a
+        slow object only occupies its own worker while the others
+        keep taking the next ones. At most workers objects are
+        streamed at once.
+
+        Args:
+            source:object  >> LocalSource or S3Source
+            data_dir:str   >> directory of the hgt files
+            samples:int    >> raster col/row size of a tile
+            workers:int    >> objects streamed at once
+            retries:int    >> attempts per object
+        '''
+        self.source   = source
+        self.data_dir = data_dir
+        self.samples  = samples
+        self.workers  = workers
+        self.retries  = retries
+        self.manifest_path = os.path.join(data_dir, self.MANIFEST)
+        self.manifest = self.load_manifest()
+        self._removed = set()
+        self._lock    = threading.Lock()
+
+    def load_manifest(self):
+        '''
+        Returns the manifest of ingested tiles
+
+        Returns:
+            manifest:dict >> tile name to key, source_size, size and sha256
+        '''
+        try:
+            with open(self.manifest_path) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def save_manifest(self):
+        '''
+        Writes the manifest, entries written by other processes
+        meanwhile (workers of the API fetching tiles) are kept
+        '''
+        with self._lock:
+            manifest = dict(self.manifest)
+            removed  = set(self._removed)
+        os.makedirs(self.data_dir, exist_ok=True)
+        with open(self.manifest_path + ".lock", "w") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            merged = {
+                name:entry for name, entry in self.load_manifest().items() if name not in removed
+                }
+            merged.update(manifest)
+            tmp = f"{self.manifest_path}.{os.getpid()}.tmp"
+            with open(tmp, "w") as f:
+                json.dump(merged, f)
+            os.replace(tmp, self.manifest_path)
+
+    def remove_entry(self, name):
+        '''
+        Removes the manifest entry of a tile, see self.save_manifest()
+        '''
+        with self._lock:
+            self.manifest.pop(name, None)
+            self._removed.add(name)
+
+    @staticmethod
+    def tile_name(key):
+        return os.path.basename(key)[:-len(".gz")]
+
+    def _done(self, key, source_size):
+        '''
+        Returns True if the object was ingested completely before
+        '''
+        entry = self.manifest.get(self.tile_name(key))
+        if entry is None or entry.get("source_size") != source_size:
+            return False
+        path = os.path.join(self.data_dir, self.tile_name(key))
+        return os.path.isfile(path) and os.path.getsize(path) == entry["size"]
+
+    def ingest_single(self, key, source_size=None):
+        '''
+        Streams, decompresses and hashes a single object into data_dir
+
+        The tile is written to a temporary file and moved in place once
+        it is complete, so data_dir never contains partial tiles.
+
+        Args:
+            key:str          >> key of the object
+            source_size:int  >> size of the object
+
+        Returns:
+            entry:dict >> manifest entry of the tile
+
+        Raises:
+            NotInSource >> the source does not have the object, not retried
+        '''
+        name = self.tile_name(key)
+        path = os.path.join(self.data_dir, name)
+        tmp  = f"{path}.{os.getpid()}.tmp"
+        expected = self.samples * self.samples * 2
+
+        for attempt in range(1, self.retries + 1):
+            digest = hashlib.sha256()
+            size = 0
+            try:
+                try:
+                    body = self.source.open(key)
+                except FileNotFoundError as e:
+                    raise NotInSource(key) from e
+                try:
+                    with gzip.GzipFile(fileobj=body) as f_in, open(tmp, "wb") as f_out:
+                        while True:
+                            block = f_in.read(BLOCK_SIZE)
+                            if not block:
+                                break
+                            digest.update(block)
+                            f_out.write(block)
+                            size += len(block)
+                finally:
+                    body.close()
+                if size != expected:
+                    raise ValueError(f"{key} has {size} bytes, expected {expected}")
+                os.replace(tmp, path)
+                return {
+                    "key":key,
+                    "source_size":source_size,
+                    "size":size,
+                    "sha256":digest.hexdigest()
+                    }
+            except NotInSource:
+                raise
+            except Exception:
+                if os.path.exists(tmp):
+                    os.remove(tmp)
+                if attempt == self.retries:
+                    raise
+                time.sleep(attempt)
+
+    def run(self, resume=True, tiles=None, save_every=100):
+        '''
+        Ingests all objects of the source
+
+        Args:
+            resume:bool    >> skip objects ingested completely before
+            tiles:set      >> ingest only these tile names, None for all
+            save_every:int >> write the manifest every n tiles
+
+        Returns:
+            summary:dict >> ingested, skipped and failed keys (with error)
+        '''
+        os.makedirs(self.data_dir, exist_ok=True)
+        objects = self.source.list(tiles)
+        todo = [(key, size) for key, size in objects if not (resume and self._done(key, size))]
+        summary = {"ingested":0, "skipped":len(objects) - len(todo), "failed":{}}
+        print("Ingesting", len(todo), "tiles to", self.data_dir, "with", self.workers,
+              "workers, skipped", summary["skipped"], "already ingested.")
+
+        with ThreadPoolExecutor(max_workers=self.workers) as pool:
+            futures = {pool.submit(self.ingest_single, key, size):key for key, size in todo}
+            for future in tqdm(as_completed(futures), total=len(futures)):
+                key = futures[future]
+                try:
+                    entry = future.result()
+                except Exception as e:
+                    summary["failed"][key] = str(e)
+                    continue
+                with self._lock:
+                    self.manifest[self.tile_name(key)] = entry
+                summary["ingested"] += 1
+                if summary["ingested"] % save_every == 0:
+                    self.save_manifest()
+        self.save_manifest()
+        if summary["failed"]:
+            print(len(summary["failed"]), "tiles failed, run again to retry them.")
+        return summary
+
+    def verify_single(self, name):
+        '''
+        Returns True if the tile matches its manifest entry
+        '''
+        entry = self.manifest[name]
+        path = os.path.join(self.data_dir, name)
+        if not os.path.isfile(path) or os.path.getsize(path) != entry["size"]:
+            return False
+        digest = hashlib.sha256()
+        with open(path, "rb") as f:
+            for block in iter(lambda: f.read(BLOCK_SIZE), b""):
+                digest.update(block)
+        return digest.hexdigest() == entry["sha256"]
+
+    def verify(self, remove=True):
+        '''
+        Verifies all tiles of the manifest in parallel
+
+        Args:
+            remove:bool >> delete corrupted tiles and their manifest
+                           entries, so the next run ingests them again
+
+        Returns:
+            corrupted:list >> names of tiles not matching the manifest
+        '''
+        names = list(self.manifest)
+        with ThreadPoolExecutor(max_workers=self.workers) as pool:
+            valid = list(tqdm(pool.map(self.verify_single, names), total=len(names)))
+        corrupted = [name for name, ok in zip(names, valid) if not ok]
+        if remove and corrupted:
+            for name in corrupted:
+                path = os.path.join(self.data_dir, name)
+                if os.path.exists(path):
+                    os.remove(path)
+                self.remove_entry(name)
+            self.save_manifest()
+        return corrupted
+
+
+class FetchThrough():
+    def __init__(self, ingestor, max_gb=None, workers=4, negative_ttl=86400,
+                 min_idle=60, on_fetched=None, on_evict=None):
+        '''
+        Downloads single tiles on first access instead of requiring
+        the whole dataset in place
+
+        Concurrent requests of the same tile share one download. Tiles
+        the source does not have (oceans) are remembered for
+        negative_ttl seconds, so they are not requested again on every
+        lookup. Fetched tiles are kept up to max_gb on disk, beyond that
+        the least recently accessed fetched tiles are deleted again,
+        tiles ingested by a full or regional run are never deleted.
+        Tiles accessed within the last min_idle seconds are not deleted,
+        so lookups never lose a tile they resolved, the budget might be
+        exceeded meanwhile.
+
+        Args:
+            ingestor:Ingestor   >> ingests single tiles of its source
+            max_gb:float        >> disk budget of the fetched tiles,
+                                   None for no limit
+            workers:int         >> downloads at once
+            negative_ttl:int    >> seconds missing tiles are remembered
+            min_idle:float      >> seconds since the last access before a
+                                   fetched tile can be deleted
+            on_fetched:func     >> called with the name of a tile once it
+                                   is in place
+            on_evict:func       >> called with the name of a tile before
+                                   it is deleted
+        '''
+        self.ingestor     = ingestor
+        self.max_bytes    = int(max_gb * 1024 ** 3) if max_gb else None
+        self.workers      = workers
+        self.negative_ttl = negative_ttl
+        self.min_idle     = min_idle
+        self.on_fetched   = on_fetched
+        self.on_evict     = on_evict
+        self.fetches   = 0
+        self.misses    = 0
+        self.errors    = 0
+        self.evictions = 0
+        self.resident_bytes = 0
+        self._missing  = {}
+        self._inflight = {}
+        self._fetched  = OrderedDict()
+        self._pool     = None
+        self._lock     = threading.Lock()
+        # the api might start without any tiles in place
+        os.makedirs(ingestor.data_dir, exist_ok=True)
+
+        # fetched tiles of earlier runs, least recently written first,
+        # values are size and time of the last access
+        fetched = []
+        for name, entry in ingestor.manifest.items():
+            path = os.path.join(ingestor.data_dir, name)
+            if entry.get("fetched") and os.path.isfile(path):
+                fetched.append((os.path.getmtime(path), name, entry["size"]))
+        for _, name, size in sorted(fetched):
+            self._fetched[name] = [size, 0.0]
+            self.resident_bytes += size
+
+    def is_missing(self, tile):
+        '''
+        Returns True if the source did not have the tile recently
+        '''
+        expiry = self._missing.get(tile)
+        return expiry is not None and expiry > time.monotonic()
+
+    def fetch(self, tile):
+        '''
+        Starts the download of a tile, or joins the running download
+
+        Args:
+            tile:str >> tile name, e.g. N50E008.hgt
+
+        Returns:
+            future:Future >> resolves to True once the tile is in
+                             place, False if it is not available
+        '''
+        with self._lock:
+            future = self._inflight.get(tile)
+            if future is not None:
+                return future
+            if self.is_missing(tile):
+                future = Future()
+                future.set_result(False)
+                return future
+            if self._pool is None:
+                self._pool = ThreadPoolExecutor(
+                    max_workers=self.workers,
+                    thread_name_prefix="openelevator-fetch"
+                    )
+            future = self._pool.submit(self._fetch_single, tile)
+            self._inflight[tile] = future
+        return future
+
+    def _fetch_single(self, tile):
+        try:
+            entry = self.ingestor.ingest_single(self.ingestor.source.key(tile))
+        except NotInSource:
+            with self._lock:
+                self._missing[tile] = time.monotonic() + self.negative_ttl
+                self.misses += 1
+                self._inflight.pop(tile, None)
+            return False
+        except Exception as e:
+            print(f"Fetching {tile} failed: {e}")
+            with self._lock:
+                # retried after a short pause, not after negative_ttl
+                self._missing[tile] = time.monotonic() + min(60, self.negative_ttl)
+                self.errors += 1
+                self._inflight.pop(tile, None)
+            return False
+
+        entry["fetched"] = True
+        with self.ingestor._lock:
+            self.ingestor.manifest[tile] = entry
+        evicted = []
+        with self._lock:
+            self.fetches += 1
+            self._fetched[tile] = [entry["size"], time.monotonic()]
+            self.resident_bytes += entry["size"]
+            while self.max_bytes is not None and self.resident_bytes > self.max_bytes:
+                name, (size, accessed) = next(iter(self._fetched.items()))
+                if accessed > time.monotonic() - self.min_idle:
+                    break
+                del self._fetched[name]
+                self.resident_bytes -= size
+                self.evictions += 1
+                evicted.append(name)
+        for name in evicted:
+            self._evict(name)
+        self.ingestor.save_manifest()
+        if self.on_fetched is not None:
+            self.on_fetched(tile)
+        with self._lock:
+            self._inflight.pop(tile, None)
+        return True
+
+    def _evict(self, tile):
+        if self.on_evict is not None:
+            self.on_evict(tile)
+        path = os.path.join(self.ingestor.data_dir, tile)
+        # open memory-maps of running lookups stay valid after unlink
+        if os.path.exists(path):
+            os.remove(path)
+        self.ingestor.remove_entry(tile)
+
+    def touch(self, tiles):
+        '''
+        Marks fetched tiles as recently accessed
+        '''
+        now = time.monotonic()
+        with self._lock:
+            for tile in tiles:
+                if tile in self._fetched:
+                    self._fetched[tile][1] = now
+                    self._fetched.move_to_end(tile)
+
+    def stats(self):
+        '''
+        Returns fetch counters
+
+        Returns:
+            stats:dict >> fetches, misses (not in the source), errors,
+                          evictions, tiles, resident_bytes, max_bytes
+                          and inflight downloads
+        '''
+        with self._lock:
+            return {
+                "fetches":self.fetches,
+                "misses":self.misses,
+                "errors":self.errors,
+                "evictions":self.evictions,
+                "tiles":len(self._fetched),
+                "resident_bytes":self.resident_bytes,
+                "max_bytes":self.max_bytes,
+                "inflight":len(self._inflight)
+                }
+
+    def shutdown(self, wait=True):
+        with self._lock:
+            if self._pool is not None:
+                self._pool.shutdown(wait=wait)
+            self._pool = None
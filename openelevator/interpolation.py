@@ -0,0 +1,156 @@
+'''
+Raster interpolation kernels for gridded elevation data
+
+All kernels take a 2d elevation array and fractional row/col
+positions on it (row 0 is the northern edge, col 0 the western
+edge) and work on scalars and arrays alike. Indices outside of
+the array are clamped to its edges.
+
+Copyright (C) Predly Technologies - All Rights Reserved
+Marvin Gabler <m.gabler@predly.com> 2021
+'''
+
+import numpy as np
+
+# data void as in SRTM documentation
+VOID = -32768
+
+
+def _gather(data, rows, cols):
+    '''
+    Returns values at given integer rows, cols as float,
+    indices are clamped to the array bounds
+    '''
+    rows = np.clip(rows, 0, data.shape[0] - 1)
+    cols = np.clip(cols, 0, data.shape[1] - 1)
+    return data[rows, cols].astype(np.float64)
+
+
+def nearest(data, rows, cols):
+    '''
+    Nearest neighbour lookup
+
+    Args:
+        data:np.array >> 2d elevation array
+        rows:np.array >> fractional row positions
+        cols:np.array >> fractional col positions
+
+    Returns:
+        elevations:np.array >> value of the closest grid point
+    '''
+    rows = np.rint(rows).astype(np.intp)
+    cols = np.rint(cols).astype(np.intp)
+    return _gather(data, rows, cols)[()]
+
+
+def bilinear(data, rows, cols):
+    '''
+    Bilinear interpolation between the 4 surrounding grid points,
+    falls back to nearest neighbour if one of them is void
+
+    Args:
+        data:np.array >> 2d elevation array
+        rows:np.array >> fractional row positions
+        cols:np.array >> fractional col positions
+
+    Returns:
+        elevations:np.array >> interpolated values
+    '''
+    rows = np.asarray(rows, dtype=np.float64)
+    cols = np.asarray(cols, dtype=np.float64)
+    r0 = np.floor(rows).astype(np.intp)
+    c0 = np.floor(cols).astype(np.intp)
+    fr = rows - r0
+    fc = cols - c0
+
+    v00 = _gather(data, r0, c0)
+    v01 = _gather(data, r0, c0 + 1)
+    v10 = _gather(data, r0 + 1, c0)
+    v11 = _gather(data, r0 + 1, c0 + 1)
+
+    top    = v00 + (v01 - v00) * fc
+    bottom = v10 + (v11 - v10) * fc
+    result = top + (bottom - top) * fr
+
+    void = (v00 == VOID) | (v01 == VOID) | (v10 == VOID) | (v11 == VOID)
+    if void.any():
+        result = np.where(void, nearest(data, rows, cols), result)
+    return result[()]
+
+
+def _catmull_rom_weights(t):
+    '''
+    Returns the 4 Catmull-Rom (Keys, a=-0.5) weights for the
+    grid points at offsets -1, 0, 1, 2 of fractional position t,
+    stacked along the last axis
+    '''
+    t2 = t * t
+    t3 = t2 * t
+    return np.stack([
+        -0.5 * t3 + t2 - 0.5 * t,
+        1.5 * t3 - 2.5 * t2 + 1.0,
+        -1.5 * t3 + 2.0 * t2 + 0.5 * t,
+        0.5 * t3 - 0.5 * t2
+        ], axis=-1)
+
+
+def bicubic(data, rows, cols):
+    '''
+    Bicubic convolution (Catmull-Rom) over the surrounding 4x4
+    grid points, falls back to nearest neighbour if one of them
+    is void
+
+    Args:
+        data:np.array >> 2d elevation array
+        rows:np.array >> fractional row positions
+        cols:np.array >> fractional col positions
+
+    Returns:
+        elevations:np.array >> interpolated values
+    '''
+    rows = np.asarray(rows, dtype=np.float64)
+    cols = np.asarray(cols, dtype=np.float64)
+    r0 = np.floor(rows).astype(np.intp)
+    c0 = np.floor(cols).astype(np.intp)
+    offsets = np.arange(-1, 3)
+
+    # (..., 4, 4) neighbourhood of every point
+    window = _gather(
+        data,
+        (r0[..., None] + offsets)[..., :, None],
+        (c0[..., None] + offsets)[..., None, :]
+        )
+    row_weights = _catmull_rom_weights(rows - r0)
+    col_weights = _catmull_rom_weights(cols - c0)
+    result = np.einsum("...i,...ij,...j->...", row_weights, window, col_weights)
+
+    void = (window == VOID).any(axis=(-2, -1))
+    if void.any():
+        result = np.where(void, nearest(data, rows, cols), result)
+    return result[()]
+
+
+# kernels by the interpolation names of the API
+INTERPOLATORS = {
+    "none":nearest,
+    "nearest":nearest,
+    "linear":bilinear,
+    "cubic":bicubic
+    }
+
+
+def interpolate(data, rows, cols, method="cubic"):
+    '''
+    Interpolates data at given fractional positions
+
+    Args:
+        data:np.array >> 2d elevation array
+        rows:np.array >> fractional row positions
+        cols:np.array >> fractional col positions
+        method:str    >> one of INTERPOLATORS
+                         ["none","nearest","linear","cubic"]
+
+    Returns:
+        elevations:np.array >> interpolated values
+    '''
+    return INTERPOLATORS[method](data, rows, cols)
@@ -0,0 +1,537 @@
+'''
+In-process metrics in the Prometheus text format
+
+Counters, gauges and histograms are kept in a registry and rendered
+on request (see Registry.render()), lookups only add to in-memory
+counters. Shared metrics of the lookup stages are defined at the
+bottom, see STAGE_SECONDS.
+
+Copyright (C) Predly Technologies - All Rights Reserved
+Marvin Gabler <m.gabler@predly.com> 2021
+'''
+
+import os
+import sys
+import json
+import glob
+import time
+import bisect
+import logging
+import threading
+from collections import Counter as StackCounter
+
+# innermost frames of threads waiting for work, not sampled
+IDLE_FRAMES = {
+    ("thread.py", "_worker"),
+    ("threading.py", "wait"),
+    ("queue.py", "get"),
+    ("selectors.py", "select")
+    }
+
+# seconds, 50 microseconds to 10 seconds
+LATENCY_BUCKETS = (
+    0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005,
+    0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0
+    )
+
+
+def _format_labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ""
+    escape = lambda v: str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+    return "{" + ",".join(f'{name}="{escape(value)}"' for name, value in pairs) + "}"
+
+
+def _format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Metric():
+    kind = "untyped"
+    # how values of several processes are combined, see MultiProcessRegistry
+    multiprocess_mode = "sum"
+
+    def __init__(self, name, documentation, labels=()):
+        '''
+        Base of all metrics, values are kept per combination of
+        label values
+
+        Args:
+            name:str          >> metric name, e.g. openelevator_requests_total
+            documentation:str >> help text
+            labels:tuple      >> label names
+        '''
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def _key(self, labels):
+        return tuple(labels.get(name, "") for name in self.labels)
+
+    def samples(self):
+        '''
+        Returns (suffix, label string, value) tuples of all values
+        '''
+        with self._lock:
+            return [("", _format_labels(self.labels, key), value) for key, value in self._values.items()]
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        for suffix, labels, value in self.samples():
+            lines.append(f"{self.name}{suffix}{labels} {_format_value(value)}")
+        return "\n".join(lines)
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def inc(self, value=1, **labels):
+        '''
+        Increases the counter of given label values
+        '''
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + value
+
+
+class Gauge(Metric):
+    kind = "gauge"
+    multiprocess_mode = "livesum"
+
+    def set(self, value, **labels):
+        with self._lock:
+            self._values[self._key(labels)] = value
+
+    def inc(self, value=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + value
+
+    def dec(self, value=1, **labels):
+        self.inc(-value, **labels)
+
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name, documentation, labels=(), buckets=LATENCY_BUCKETS):
+        '''
+        Cumulative histogram of observed values
+
+        Args:
+            name:str          >> metric name, e.g. openelevator_stage_seconds
+            documentation:str >> help text
+            labels:tuple      >> label names
+            buckets:tuple     >> ascending upper bounds, +Inf is added
+        '''
+        super().__init__(name, documentation, labels)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, **labels):
+        '''
+        Adds a value to the histogram of given label values
+        '''
+        key = self._key(labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            state = self._values.get(key)
+            if state is None:
+                # counts per bucket (last is +Inf), sum
+                state = self._values[key] = [[0] * (len(self.buckets) + 1), 0.0]
+            state[0][index] += 1
+            state[1] += value
+
+    def time(self, **labels):
+        '''
+        Returns a context manager observing the seconds of its block
+        '''
+        return _Timer(self, labels)
+
+    def samples(self):
+        samples = []
+        with self._lock:
+            values = [(key, list(counts), total) for key, (counts, total) in self._values.items()]
+        for key, counts, total in values:
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += count
+                samples.append(("_bucket", _format_labels(self.labels, key, [("le", _format_value(bound))]), cumulative))
+            samples.append(("_sum", _format_labels(self.labels, key), total))
+            samples.append(("_count", _format_labels(self.labels, key), cumulative))
+        return samples
+
+
+class _Timer():
+    __slots__ = ("histogram", "labels", "start")
+
+    def __init__(self, histogram, labels):
+        self.histogram = histogram
+        self.labels = labels
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.histogram.observe(time.perf_counter() - self.start, **self.labels)
+
+
+class Collected(Metric):
+    def __init__(self, name, documentation, kind, collect, labels=(), multiprocess_mode=None):
+        '''
+        Metric read from a callback on every render, for values
+        already counted elsewhere, e.g. cache statistics
+
+        Args:
+            kind:str              >> counter or gauge
+            collect:callable      >> returns {label values tuple: value}
+            multiprocess_mode:str >> see MultiProcessRegistry, defaults
+                                     to sum for counters, livesum for gauges
+        '''
+        super().__init__(name, documentation, labels)
+        self.kind = kind
+        self.collect = collect
+        self.multiprocess_mode = multiprocess_mode or ("livesum" if kind == "gauge" else "sum")
+
+    def samples(self):
+        return [("", _format_labels(self.labels, key), value) for key, value in self.collect().items()]
+
+
+class Registry():
+    def __init__(self):
+        '''
+        Set of metrics rendered together
+        '''
+        self.metrics = []
+        self.logger = logging.getLogger("openelevator.metrics")
+        self._lock = threading.Lock()
+
+    def register(self, metric):
+        with self._lock:
+            self.metrics = [i for i in self.metrics if i.name != metric.name] + [metric]
+        return metric
+
+    def render(self):
+        '''
+        Returns all metrics in the Prometheus text format 0.0.4
+        '''
+        parts = []
+        for metric in list(self.metrics):
+            try:
+                parts.append(metric.render())
+            except Exception:
+                self.logger.exception("Could not collect metric %s", metric.name)
+        return "\n".join(parts) + "\n"
+
+
+def register_cache_metrics(stats, registry=None):
+    '''
+    Registers hits, misses and hit ratio of caches
+
+    Args:
+        stats:callable     >> returns {cache name: stats dict with hits
+                              and misses}, e.g. of TileCache.stats()
+        registry:Registry  >> defaults to REGISTRY
+    '''
+    registry = registry or REGISTRY
+
+    def collect(field):
+        def values():
+            result = {}
+            for cache, counters in stats().items():
+                if field == "hit_ratio":
+                    lookups = counters["hits"] + counters["misses"]
+                    result[(cache,)] = counters["hits"] / lookups if lookups else 0.0
+                else:
+                    result[(cache,)] = counters[field]
+            return result
+        return values
+
+    registry.register(Collected("openelevator_cache_hits_total", "Cache hits", "counter", collect("hits"), ("cache",)))
+    registry.register(Collected("openelevator_cache_misses_total", "Cache misses", "counter", collect("misses"), ("cache",)))
+    registry.register(Collected("openelevator_cache_hit_ratio", "Cache hits per lookup since start", "gauge", collect("hit_ratio"), ("cache",), "liveall"))
+
+
+def _alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+class MultiProcessRegistry():
+    def __init__(self, directory, registry=None, interval=1.0):
+        '''
+        Metrics of several worker processes serving the same socket,
+        see prefork.serve()
+
+        Every worker writes the samples of its registry to a file of
+        its own in directory, every interval seconds (see self.start())
+        and on every scrape. A scrape combines the files of all workers
+        by the multiprocess_mode of every metric:
+
+            sum     >> summed over all workers, exited ones included, so
+                       counters and histograms don't drop on a restart
+            livesum >> summed over the running workers, e.g. requests
+                       in flight
+            liveall >> one sample per running worker with a worker label
+                       (the pid), e.g. hit ratios
+
+        Values of other workers are up to interval seconds old.
+
+        Args:
+            directory:str      >> directory shared by the workers, empty
+                                  when they start
+            registry:Registry  >> registry of every worker, defaults to REGISTRY
+            interval:float     >> seconds between two writes
+        '''
+        self.directory = directory
+        self.registry  = registry or REGISTRY
+        self.interval  = interval
+        self.logger = logging.getLogger("openelevator.metrics")
+        self._stop   = threading.Event()
+        self._thread = None
+
+    def start(self):
+        '''
+        Starts writing the samples of this process periodically, to be
+        called in every worker after the fork
+        '''
+        if self._thread is None:
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._run, name="openelevator-metrics", daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        '''
+        Stops writing periodically, the samples are written a last time
+        '''
+        if self._thread is not None:
+            self._stop.set()
+            self._thread.join()
+            self._thread = None
+        self.write()
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self.write()
+
+    def write(self):
+        '''
+        Writes the samples of the registry of this process
+        '''
+        metrics = []
+        for metric in list(self.registry.metrics):
+            try:
+                samples = metric.samples()
+            except Exception:
+                self.logger.exception("Could not collect metric %s", metric.name)
+                continue
+            metrics.append({
+                "name":metric.name,
+                "help":metric.documentation,
+                "kind":metric.kind,
+                "mode":metric.multiprocess_mode,
+                "samples":samples
+                })
+        path = os.path.join(self.directory, f"{os.getpid()}.json")
+        try:
+            with open(path + ".tmp", "w") as f:
+                json.dump({"pid":os.getpid(), "metrics":metrics}, f)
+            os.replace(path + ".tmp", path)
+        except OSError:
+            self.logger.exception("Could not write metrics to %s", path)
+
+    def render(self):
+        '''
+        Returns the combined metrics of all workers in the Prometheus
+        text format 0.0.4
+        '''
+        self.write()
+        combined = {}
+        for path in sorted(glob.glob(os.path.join(self.directory, "*.json"))):
+            try:
+                with open(path) as f:
+                    content = json.load(f)
+            except (OSError, ValueError):
+                continue
+            pid = content["pid"]
+            live = pid == os.getpid() or _alive(pid)
+            for metric in content["metrics"]:
+                if metric["mode"] != "sum" and not live:
+                    continue
+                _, _, values = combined.setdefault(metric["name"], (metric["help"], metric["kind"], {}))
+                for suffix, labels, value in metric["samples"]:
+                    if metric["mode"] == "liveall":
+                        worker = f'worker="{pid}"'
+                        labels = labels[:-1] + "," + worker + "}" if labels else "{" + worker + "}"
+                    values[(suffix, labels)] = values.get((suffix, labels), 0) + value
+
+        lines = []
+        for name, (documentation, kind, values) in combined.items():
+            lines += [f"# HELP {name} {documentation}", f"# TYPE {name} {kind}"]
+            for (suffix, labels), value in values.items():
+                lines.append(f"{name}{suffix}{labels} {_format_value(value)}")
+        return "\n".join(lines) + "\n"
+
+
+class SlowRequestProfiler():
+    def __init__(self, threshold_ms=500, interval_ms=5, max_stacks=20, hook=None):
+        '''
+        Sampling profiler for slow requests
+
+        While a request runs longer than threshold_ms, the stacks of
+        all threads (event loop and worker pools) are sampled every
+        interval_ms. When it finishes, the most frequent stacks are
+        passed to hook, by default logged to the openelevator.profiler
+        logger in the collapsed format of flame graph tools. Requests
+        running at the same time share the samples, as they share the
+        threads, threads waiting for work are left out. Fast requests
+        cost a dict insert only.
+
+        Args:
+            threshold_ms:float >> duration from which requests are sampled
+            interval_ms:float  >> sampling interval
+            max_stacks:int     >> stacks reported per request
+            hook:callable      >> called with a report dict (handler,
+                                  seconds, samples, stacks)
+        '''
+        self.threshold = threshold_ms / 1000
+        self.interval  = interval_ms / 1000
+        self.max_stacks = max_stacks
+        self.hook = hook or self._log
+        self.logger = logging.getLogger("openelevator.profiler")
+        self._requests = {}
+        self._lock   = threading.Lock()
+        self._thread = None
+
+    def start(self, request_id):
+        '''
+        Registers a running request
+        '''
+        with self._lock:
+            self._requests[request_id] = [time.perf_counter(), StackCounter(), 0]
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="openelevator-profiler", daemon=True)
+                self._thread.start()
+
+    def stop(self, request_id, handler):
+        '''
+        Unregisters a request, slow requests are reported
+        '''
+        with self._lock:
+            started, stacks, samples = self._requests.pop(request_id)
+        seconds = time.perf_counter() - started
+        if seconds >= self.threshold:
+            SLOW_REQUESTS.inc(handler=handler)
+            if samples:
+                self.hook({
+                    "handler":handler,
+                    "seconds":seconds,
+                    "samples":samples,
+                    "stacks":stacks.most_common(self.max_stacks)
+                    })
+
+    def _run(self):
+        own = threading.get_ident()
+        while True:
+            time.sleep(self.interval)
+            now = time.perf_counter()
+            with self._lock:
+                slow = [i for i in self._requests.values() if now - i[0] >= self.threshold]
+            if not slow:
+                continue
+            stacks = []
+            for thread_id, frame in sys._current_frames().items():
+                code = frame.f_code
+                if thread_id == own or (code.co_filename.rsplit("/", 1)[-1], code.co_name) in IDLE_FRAMES:
+                    continue
+                stack = []
+                while frame is not None:
+                    stack.append(f"{frame.f_code.co_name} ({frame.f_code.co_filename.rsplit('/', 1)[-1]}:{frame.f_lineno})")
+                    frame = frame.f_back
+                stacks.append(";".join(reversed(stack)))
+            with self._lock:
+                for state in slow:
+                    state[1].update(stacks)
+                    state[2] += 1
+
+    def _log(self, report):
+        self.logger.warning(
+            "slow request %s took %.3f s, %d samples:\n%s",
+            report["handler"],
+            report["seconds"],
+            report["samples"],
+            "\n".join(f"{stack} {count}" for stack, count in report["stacks"])
+            )
+
+
+class MetricsMiddleware():
+    def __init__(self, app, profiler=None):
+        '''
+        ASGI middleware counting requests in flight and timing every
+        request by handler and status, the handler is the name of the
+        endpoint function, so path parameters add no labels
+
+        Args:
+            app:object                  >> ASGI app
+            profiler:SlowRequestProfiler >> samples slow requests, optional
+        '''
+        self.app = app
+        self.profiler = profiler
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        status = {"code":500}
+
+        async def send_status(message):
+            if message["type"] == "http.response.start":
+                status["code"] = message["status"]
+            await send(message)
+
+        start = time.perf_counter()
+        REQUESTS_IN_FLIGHT.inc()
+        if self.profiler is not None:
+            self.profiler.start(id(scope))
+        try:
+            await self.app(scope, receive, send_status)
+        finally:
+            REQUESTS_IN_FLIGHT.dec()
+            handler = getattr(scope.get("endpoint"), "__name__", "unmatched")
+            REQUEST_SECONDS.observe(time.perf_counter() - start, handler=handler, status=str(status["code"]))
+            if self.profiler is not None:
+                self.profiler.stop(id(scope), handler)
+
+
+REGISTRY = Registry()
+
+# lookup stages: resolve, read, interpolate, cache_get, cache_set,
+# fetch and render, see OpenElevator
+STAGE_SECONDS = REGISTRY.register(Histogram(
+    "openelevator_stage_seconds",
+    "Seconds spent per stage of a lookup",
+    labels=("stage",)
+    ))
+REQUEST_SECONDS = REGISTRY.register(Histogram(
+    "openelevator_request_seconds",
+    "Seconds per HTTP request",
+    labels=("handler", "status")
+    ))
+REQUESTS_IN_FLIGHT = REGISTRY.register(Gauge(
+    "openelevator_requests_in_flight",
+    "HTTP requests currently processed"
+    ))
+SLOW_REQUESTS = REGISTRY.register(Counter(
+    "openelevator_slow_requests_total",
+    "HTTP requests slower than the profiler threshold",
+    labels=("handler",)
+    ))
@@ -9,25 +9,44 @@ CREDIT: Code parts taken from: https://github.com/aatishnn/srtm-python
 '''
 
 import os
-import sys
-import gzip
 import time
 import numpy as np
 from io import BytesIO
-from shutil import copyfileobj
-from boto3 import resource
 from tqdm import tqdm
+from functools import partial
 from multiprocessing import Pool, cpu_count
-from botocore.handlers import disable_signing
-from scipy.interpolate import griddata
 import matplotlib.pyplot as plt
 
 import asyncio
 import aioredis
+import threading
+
+from tiles import TilePool, TileCache, HaloTile, TileIndex, TileHeatmap, halo_window
+from interpolation import interpolate
+from storage import PackedStore, ChunkedStore
+from caching import ResultCache, LRUCache
+import geo
+import terrain
+import overviews
+import render
+from executor import Executor
+from batching import PointBatcher
+from ingest import Ingestor, LocalSource, S3Source, FetchThrough, region_tiles
+from metrics import STAGE_SECONDS
+
+# pyplot keeps global state, plots are drawn one at a time per process
+_PLOT_LOCK = threading.Lock()
 
 
 class OpenElevator():
-    def __init__(self, initialized=False,cache=True):
+    def __init__(self, initialized=False,cache=True, tile_pool_size=256, tile_cache_mb=1024,
+                 data_dir=None, chunk_cache_mb=256, cache_ttl=86400, cache_precision=8,
+                 cache_maxmemory=None, cache_policy=None, cache_l1_entries=100000,
+                 cache_l1_ttl=300, cache_negative_ttl=3600, render_cache_entries=4096,
+                 io_workers=16, cpu_workers=0, max_pending=256, fetch_source=None,
+                 fetch_endpoint_url=None, fetch_max_gb=None, fetch_workers=4,
+                 fetch_negative_ttl=86400, heatmap_interval=300, prewarm_tiles=64,
+                 batch_window_us=None):
         '''
         OpenElevator class for accessing elevation
         data programmatically
@@ -51,18 +70,23 @@ class OpenElevator():
 
             # get elevation for specific location
             lat,lon = 0.44454, 12.34334
-            print(elevator.get_elevation(lat,lon))
+            print(asyncio.run(elevator.get_elevation(lat,lon)))
         '''
         # CONST
         self.AWS_ELEVATION_BUCKET="elevation-tiles-prod"
         self.AWS_HGT_DIR="skadi"
         self.SAMPLES=3601 # raster col/row size of dataset       
+        self.HALO=2 # border cells copied from neighbour tiles for interpolation
+        self.OVERVIEW_LEVELS=4 # downsampled levels, 2**level samples per overview sample
+        self.GLOBAL_LEVEL=5 # level of the global overview raster
+        self.GLOBAL_SAMPLES=15 # samples per degree of the global overview (4 arcminutes)
+        self.RENDER_FETCH_TILES=4 # max tiles fetched for a map tile, see self.render_tile()
         self.INTERPOLATION_METHODS = [
             "none",
             "nearest",
             "linear",
             "cubic"
-        ] # as available in skipy.interpolate.griddata
+        ] # nearest, nearest, bilinear, bicubic, see interpolation.py
         self.COLORMAPS = [
             "terrain",
             "gist_earth",
@@ -77,8 +101,11 @@ class OpenElevator():
 
         # DIRS
         self.current_dir = os.path.dirname(os.path.abspath(__file__))
-        self.data_dir    = os.path.join(self.current_dir, "data")
+        self.data_dir    = data_dir or os.path.join(self.current_dir, "data")
         self.temp_dir    = os.path.join(self.current_dir, "tmp")
+        self.packed_dir  = os.path.join(self.data_dir, "packed")
+        self.chunked_dir = os.path.join(self.data_dir, "chunked")
+        self.overview_dir = os.path.join(self.data_dir, "overviews")
         self.debug       = False
 
         # SYSTEM
@@ -88,153 +115,460 @@ class OpenElevator():
         # CACHE
         self.cache_active = cache
 
+        # TILES
+        # memory-mapped tile handles, point queries only page in
+        # the parts of a tile that are actually read
+        self.tiles = TilePool(
+            self.data_dir,
+            samples=self.SAMPLES,
+            max_open=tile_pool_size
+            )
+        # decoded tiles kept in memory, traffic is clustered over
+        # few tiles so most lookups never touch the disk
+        self.tile_cache = TileCache(max_mb=tile_cache_mb)
+        # presence bitmap of all tiles in data_dir, resolves
+        # locations to tiles without touching the filesystem
+        self.tile_index = TileIndex(self.data_dir)
+
+        self.chunk_cache_mb = chunk_cache_mb
+
+        # blocking reads and NumPy work run in a thread pool, rendering
+        # in worker processes with their own uncached OpenElevator
+        self.executor = Executor(
+            self,
+            io_workers=io_workers,
+            cpu_workers=cpu_workers,
+            max_pending=max_pending,
+            worker_factory=OpenElevator,
+            worker_kwargs={
+                "initialized":True,
+                "cache":False,
+                "data_dir":self.data_dir,
+                "tile_pool_size":tile_pool_size,
+                "tile_cache_mb":0,
+                "chunk_cache_mb":chunk_cache_mb,
+                "render_cache_entries":0,
+                "io_workers":0,
+                "heatmap_interval":0,
+                "prewarm_tiles":0
+                }
+            )
+
+        # rendered map tiles, see self.render_tile()
+        self.render_cache = LRUCache(max_entries=render_cache_entries, ttl=86400)
+
+        # downsampled tiles by level and the global raster,
+        # see self.build_overviews()
+        self.overview_tiles  = {}
+        self.global_overview = None
+
+        # tiles missing in data_dir are downloaded on first access,
+        # see self._fetch_missing()
+        self.fetcher = None
+        if fetch_source:
+            if fetch_source == "s3":
+                source = S3Source(self.AWS_ELEVATION_BUCKET, self.AWS_HGT_DIR, endpoint_url=fetch_endpoint_url)
+            elif isinstance(fetch_source, str):
+                source = LocalSource(fetch_source)
+            else:
+                source = fetch_source
+            self.fetcher = FetchThrough(
+                Ingestor(source, self.data_dir, samples=self.SAMPLES),
+                max_gb=fetch_max_gb,
+                workers=fetch_workers,
+                negative_ttl=fetch_negative_ttl,
+                on_fetched=self._on_tile_fetched,
+                on_evict=self._on_tile_evicted
+                )
+
+        # tiles accessed per lookup call, the most accessed are warmed
+        # at startup, see self.prewarm()
+        self.heatmap = TileHeatmap(self.data_dir, interval=heatmap_interval) if heatmap_interval else None
+        self.prewarm_tiles = prewarm_tiles
+        self.warmup = {"state":"pending", "tiles":0, "total":0, "seconds":None}
+
+        # concurrent calls of self.get_elevation are looked up
+        # together, see batching.PointBatcher
+        self.batcher = None
+        if batch_window_us is not None:
+            self.batcher = PointBatcher(self.get_elevations, window_us=batch_window_us)
+
         # INIT
         if initialized:
+            self.tile_index.load_or_build()
+            self._load_stores()
+            self._load_overviews()
+            if self.heatmap is not None:
+                self.heatmap.load()
             if self.cache_active:
                 self.cache = aioredis.from_url("redis://localhost", encoding="iso-8859-1", decode_responses=True)
         else:
             print("Initialize with self.prepare_data() or init class with initialized=True")
+
+        # results keyed by position on the dataset grid, in-process
+        # L1 in front of redis as shared L2
+        if self.cache_active:
+            self.result_cache = ResultCache(
+                getattr(self, "cache", None),
+                ttl=cache_ttl,
+                precision=cache_precision,
+                maxmemory=cache_maxmemory,
+                maxmemory_policy=cache_policy,
+                l1_entries=cache_l1_entries,
+                l1_ttl=cache_l1_ttl,
+                negative_ttl=cache_negative_ttl
+                )
             
 
-    def prepare_data(self, download=True):
+    def __getstate__(self):
+        # worker processes of the multiprocessed methods work
+        # without the redis connection and the result cache
+        state = self.__dict__.copy()
+        state.pop("cache", None)
+        state.pop("result_cache", None)
+        state["cache_active"] = False
+        state["fetcher"] = None
+        state["heatmap"] = None
+        state["batcher"] = None
+        return state
+
+    def prepare_data(self, download=True, pack=False, overviews=False, source=None,
+                     endpoint_url=None, workers=None, resume=True, verify=False,
+                     bbox=None, regions=None):
         '''
-        Download and preprocesses the neccessary DEM data from remote 
-        s3:// repository to local tmp dir (self.temp_dir) with all available 
-        processor threads. You need about 1.6 TB free space for the whole 
-        extracted dataset.
+        Downloads and extracts the neccessary DEM data from the remote
+        s3:// repository to self.data_dir. You need about 1.6 TB free
+        space for the whole extracted dataset.
 
-        Workflow:
-            1. Download data multithreaded
-            2. Unzip data
-            3. Place all files in data dir and delete zip files
+        Every object is streamed, decompressed on the fly and written
+        straight to the data dir by a pool of workers, so there is no
+        temporary copy of the compressed dataset. Size and sha256 of
+        every tile are recorded in a manifest in the data dir, an
+        interrupted run continues where it stopped, see ingest.py.
 
         Args:
-            download:bool >> Specify if data needs to be downloaded or is
-                             already present in given self.temp_dir
+            download:bool  >> Specify if data needs to be downloaded or is
+                              already present in given self.temp_dir
 
-                             You might already have downloaded the dataset
-                             via s3 cli, so just place the data in a folder
-                             called "tmp" in the working directory and start
-                             with download=False to unzip the data and place
-                             it in the data dir
+                              You might already have downloaded the dataset
+                              via s3 cli, so just place the data in a folder
+                              called "tmp" in the working directory and start
+                              with download=False to extract the data into
+                              the data dir, the tmp dir can be deleted
+                              afterwards
 
-                             command for aws cli:  
+                              command for aws cli:  
                                 aws s3 cp --no-sign-request --recursive s3://elevation-tiles-prod/skadi /path/to/data/folder
+            pack:bool      >> Convert the extracted tiles to the packed
+                              layout afterwards, see self.pack_data()
+            overviews:bool >> Build the downsampled overview levels
+                              afterwards, see self.build_overviews()
+            source:object  >> Directory of gzipped hgt files or a source
+                              of ingest.py, overrides download
+            endpoint_url:str >> Url of a s3 compatible server holding the
+                              bucket, e.g. a local stand-in
+            workers:int    >> Objects streamed at once, defaults to
+                              self.download_threads
+            resume:bool    >> Skip tiles already in the manifest
+            verify:bool    >> Verify all tiles against the manifest
+                              afterwards, see self.verify_data()
+            bbox:list      >> Only prepare the tiles covering this bbox
+                              [min_lon, min_lat, max_lon, max_lat]
+            regions:list   >> Only prepare the tiles covering these bboxes,
+                              combined with bbox
 
         Returns:
-            None
+            summary:dict >> ingested, skipped and failed tiles
         '''
-        
-        if download:
-            print("Initializing data download.")
-            s3 = resource('s3')
-            s3.meta.client.meta.events.register('choose-signer.s3.*', disable_signing)
-            bucket = s3.Bucket(self.AWS_ELEVATION_BUCKET)
-            key_list = [i.key for i in bucket.objects.filter(Prefix=self.AWS_HGT_DIR).all()]
-
-            # create X download_threads times nested lists
-            nested_size = int(len(key_list) / self.download_threads)
-            download_list = [] 
-            for i in range(self.download_threads):
-                start = i * nested_size
-                stop  = (i+1) * nested_size
-                if i != (self.download_threads-1):  
-                    download_list.append(key_list[start:stop])
-                else:
-                    download_list.append(key_list[start:])
+        tiles = None
+        if bbox is not None or regions is not None:
+            tiles = region_tiles(([bbox] if bbox is not None else []) + list(regions or []))
+            if isinstance(tiles, dict):
+                print(tiles["error"])
+                return None
+            print("Preparing the", len(tiles), "tiles covering the given regions.")
+
+        if isinstance(source, str):
+            source = LocalSource(source)
+        elif source is None:
+            if download:
+                print("Initializing data download.")
+                source = S3Source(
+                    self.AWS_ELEVATION_BUCKET,
+                    self.AWS_HGT_DIR,
+                    endpoint_url=endpoint_url
+                    )
+            else:
+                source = LocalSource(self.temp_dir)
+
+        ingestor = Ingestor(
+            source,
+            self.data_dir,
+            samples=self.SAMPLES,
+            workers=workers or self.download_threads
+            )
+        summary = ingestor.run(resume=resume, tiles=tiles)
+        if verify:
+            summary["corrupted"] = ingestor.verify()
+
+        # index the extracted tiles for lookups
+        names, stamp = self.tile_index._listing()
+        self.tile_index.build(names)
+        self.tile_index.save(stamp)
+
+        if pack:
+            self.pack_data()
+        if overviews:
+            self.build_overviews()
+        return summary
+
+    def verify_data(self, remove=True, workers=None):
+        '''
+        Verifies the extracted tiles against the manifest written by
+        self.prepare_data() with parallel sha256 checks
 
-            p = Pool(self.download_threads)
-            print("Downloading",len(key_list), "files with", self.download_threads, "processes.\
-                   This might take several hours depending on your connection.")
-            p.map(self._download_single,download_list)
-            p.close()
+        Args:
+            remove:bool >> delete corrupted tiles, the next run of
+                           self.prepare_data() downloads them again
+            workers:int >> files checked at once
 
-        # verify download and delete corrupted files
-        data_subfolders = [os.path.join(self.temp_dir,i) for i in os.listdir(self.temp_dir)]
-        p = Pool(self.cpu_cores)
-        result_list_tqdm = []
-        print("\nVerfying download and extracting files, working on", len(data_subfolders), "folders.")
-        if not os.path.exists(self.data_dir):
-            os.makedirs(self.data_dir)
-        for result in tqdm(p.imap(func=self._verify_extract_single,
-                        iterable=data_subfolders), total=len(data_subfolders)):
-            result_list_tqdm.append(result) 
-        p.close()
-        # delete old folders
-        for i in os.listdir(self.temp_dir):
-            folder_path = os.path.join(self.temp_dir,i)
-            try:
-                os.rmdir(folder_path)
-            except Exception as e:
-                print(f"Directory {folder_path} not empty. Did not delete.")
+        Returns:
+            corrupted:list >> names of corrupted or missing tiles
+        '''
+        ingestor = Ingestor(
+            None,
+            self.data_dir,
+            samples=self.SAMPLES,
+            workers=workers or self.cpu_cores
+            )
+        corrupted = ingestor.verify(remove=remove)
+        if corrupted:
+            print(len(corrupted), "tiles are corrupted or missing.")
+        return corrupted
 
-    def _download_single(self, files):
+    def pack_data(self, tiles_per_shard=64, remove_hgt=False):
         '''
-        Downloads given s3 files from given AWS_ELEVATION_BUCKET
+        Converts the hgt files in self.data_dir to the packed layout
+        in self.packed_dir, which is detected and preferred for
+        lookups automatically.
 
-        This function is supposed to be multiprocessed and not
-        being called directly.
+        Hgt files are big endian, so every read of them needs a
+        byteswap, and every tile is a separate file. The packed
+        layout stores native endian int16 tiles concatenated into
+        few large memory-mappable shard files, see storage.PackedStore.
 
         Args:
-            files:list >> list of files with full path on AWS s3
-        
+            tiles_per_shard:int >> tiles per shard file, 1 writes
+                                   one file per tile
+            remove_hgt:bool     >> delete the hgt files after packing
+                                   to save disk space
+
         Returns:
             None
         '''
+        hgt_files = [
+            os.path.join(self.data_dir, i) for i in self.tile_index.names[self.tile_index.present]
+            if os.path.isfile(os.path.join(self.data_dir, i))
+            ]
+        print("Packing", len(hgt_files), "tiles to", self.packed_dir)
+        PackedStore.pack(
+            hgt_files,
+            self.packed_dir,
+            samples=self.SAMPLES,
+            tiles_per_shard=tiles_per_shard
+            )
+        if remove_hgt:
+            for hgt_file in hgt_files:
+                os.remove(hgt_file)
+        self.tiles.close()
+        self._load_stores()
+
+    def compress_data(self, chunk_size=256, codec="zlib", level=6, remove_hgt=False):
+        '''
+        Compresses the hgt files in self.data_dir to the chunked layout
+        in self.chunked_dir, multiprocessed with all available processor
+        threads. The layout is detected and used for lookups
+        automatically, see storage.ChunkedStore.
+
+        Every tile is split into chunk_size x chunk_size chunks which
+        are delta filtered and compressed independently, so lookups
+        only decompress the chunks they touch. Most of the dataset are
+        ocean voids and flat terrain, so it shrinks to a fraction of
+        the 1.6 TB, small enough for cheap disks or the page cache.
 
-        s3 = resource('s3')
-        s3.meta.client.meta.events.register('choose-signer.s3.*', disable_signing)
-        bucket = s3.Bucket(self.AWS_ELEVATION_BUCKET)
+        For lookups with chunk granularity, set tile_cache_mb to 0,
+        otherwise whole tiles are decompressed into the tile cache.
 
-        for idx, single_file in enumerate(files):
-            local_path = single_file.replace("skadi",self.temp_dir)
-            if not os.path.exists(os.path.dirname(local_path)):
-                os.makedirs(os.path.dirname(local_path), exist_ok=True)            
-            if not os.path.exists(local_path):
-                if self.debug:
-                    print(f"Downloading {single_file}")
-                bucket.download_file(single_file,local_path)
-            sys.stderr.write('\rdone {0:%} '.format(idx/len(files)))
+        Args:
+            chunk_size:int  >> col/row size of the chunks
+            codec:str       >> "zlib" (fast) or "lzma" (smaller)
+            level:int       >> compression level of the codec
+            remove_hgt:bool >> delete the hgt files after compressing
+                               to save disk space
 
-    def _verify_extract_single(self, single_folder):
+        Returns:
+            None
         '''
-        Verifies downloaded files and and extracts gzipped files
+        hgt_files = [
+            os.path.join(self.data_dir, i) for i in self.tile_index.names[self.tile_index.present]
+            if os.path.isfile(os.path.join(self.data_dir, i))
+            ]
+        print("Compressing", len(hgt_files), "tiles to", self.chunked_dir)
+        p = Pool(self.cpu_cores)
+        ratios = list(tqdm(p.imap_unordered(
+            partial(
+                ChunkedStore.compress,
+                chunked_dir=self.chunked_dir,
+                samples=self.SAMPLES,
+                chunk_size=chunk_size,
+                codec=codec,
+                level=level
+                ),
+            hgt_files
+            ), total=len(hgt_files)))
+        p.close()
+        if ratios:
+            print("Compressed to", round(100 * np.mean(ratios), 2), "% of the raw size.")
+        if remove_hgt:
+            for hgt_file in hgt_files:
+                os.remove(hgt_file)
+        self.tiles.close()
+        self._load_stores()
+
+    def build_overviews(self, global_overview=True):
+        '''
+        Builds downsampled overview levels of all tiles in
+        self.overview_dir, multiprocessed with all available processor
+        threads, see overviews.py. Works on any storage layout.
 
-        This function is to be multiprocessed and not being called
-        directly.
+        Levels 1 to self.OVERVIEW_LEVELS keep every 2**level-th sample
+        of a tile (level 4 is about 500 meters), coarse lookups and
+        plots read these small tiles instead of the full resolution
+        ones. The global overview (self.GLOBAL_LEVEL) is a single
+        raster of the earth with self.GLOBAL_SAMPLES samples per degree.
 
-        If the download has been stopped while in progress or any
-        other error occured, there might be corrupted files or 'half files'.
-        These wrong files are being deleted, while good files are being 
-        extracted and placed in data folder.
-        
         Args:
-            single_folder:str >> folder in temp_dir to be checked
-        
+            global_overview:bool >> build the global overview as well
+
         Returns:
             None
         '''
+        hgt_files = list(self.tile_index.names[self.tile_index.present])
+        os.makedirs(self.overview_dir, exist_ok=True)
+        samples_per_degree = self.GLOBAL_SAMPLES if global_overview else None
+        if global_overview:
+            global_path = os.path.join(self.overview_dir, overviews.GLOBAL)
+            raster = np.memmap(
+                global_path + ".tmp",
+                dtype=overviews.HGT_DTYPE,
+                mode="w+",
+                shape=overviews.global_shape(samples_per_degree)
+                )
+            raster[:] = overviews.VOID
+
+        print("Building overviews of", len(hgt_files), "tiles in", self.overview_dir)
+        p = Pool(self.cpu_cores)
+        for hgt_file, block in tqdm(p.imap_unordered(
+                partial(self._build_overview_single, samples_per_degree=samples_per_degree),
+                hgt_files,
+                chunksize=16
+                ), total=len(hgt_files)):
+            if global_overview:
+                overviews.place_global(raster, block, *TileIndex.tile_origin(hgt_file))
+        p.close()
+
+        if global_overview:
+            raster.flush()
+            del raster
+            os.replace(global_path + ".tmp", global_path)
+        overviews.write_index(
+            self.overview_dir,
+            self.SAMPLES,
+            self.OVERVIEW_LEVELS,
+            samples_per_degree
+            )
+        self._load_overviews()
+
+    def _build_overview_single(self, hgt_file, samples_per_degree=None):
+        '''
+        Builds the overview levels of a single tile, see self.build_overviews()
+
+        Returns:
+            hgt_file:str    >> file_name of hgt file
+            block:np.array  >> tile sampled for the global overview or None
+        '''
+        data = overviews.build_tile(
+            self.tiles.get(hgt_file),
+            hgt_file,
+            self.overview_dir,
+            levels=self.OVERVIEW_LEVELS
+            )
+        if samples_per_degree:
+            return hgt_file, overviews.global_block(data, samples_per_degree)
+        return hgt_file, None
 
-        for j in os.listdir(single_folder):
-            zip_file_path = os.path.join(single_folder,j)
-            raw_file_path = os.path.join(
-                self.data_dir, 
-                os.path.basename(zip_file_path.replace(".gz", ""))
+    def _load_overviews(self):
+        '''
+        Uses the overview levels for coarse lookups if present
+        '''
+        self.overview_tiles  = {}
+        self.global_overview = None
+        index = overviews.read_index(self.overview_dir)
+        if index is None:
+            return
+        for level, samples in index["levels"].items():
+            self.overview_tiles[int(level)] = TilePool(
+                overviews.level_dir(self.overview_dir, level),
+                samples=samples,
+                max_open=self.tiles.max_open
+                )
+        if index.get("global"):
+            self.global_overview = np.memmap(
+                os.path.join(self.overview_dir, overviews.GLOBAL),
+                dtype=overviews.HGT_DTYPE,
+                mode="r",
+                shape=tuple(index["global"]["shape"])
                 )
-            if ".gz." in j:
-                os.remove(zip_file_path)
-            else:
-                if ".gz" in j:
-                    with gzip.open(zip_file_path, "rb") as f_in:
-                        with open(raw_file_path, "wb") as f_out:
-                            copyfileobj(f_in, f_out)
-                            os.remove(zip_file_path)
+
+    def overview_levels(self):
+        '''
+        Returns the available resolution levels
+
+        Returns:
+            levels:list >> 0 (full resolution) and the built overview levels
+        '''
+        levels = [0] + sorted(self.overview_tiles)
+        if self.global_overview is not None:
+            levels.append(self.GLOBAL_LEVEL)
+        return levels
+
+    def _load_stores(self):
+        '''
+        Uses the packed and chunked layouts for lookups if present,
+        the packed layout is preferred as it is the fastest
+        '''
+        self.tiles.stores = []
+        if PackedStore.exists(self.packed_dir):
+            self.tiles.stores.append(PackedStore(self.packed_dir))
+        if ChunkedStore.exists(self.chunked_dir):
+            self.tiles.stores.append(ChunkedStore(
+                self.chunked_dir,
+                cache_mb=self.chunk_cache_mb
+                ))
+        for store in self.tiles.stores:
+            for name in store.names():
+                self.tile_index.add(name)
 
     def _get_file_name(self, lat, lon):
         """
         Returns filename such as N27E086.hgt, concatenated
         with HGTDIR as given by NASA's file syntax
 
+        The tile is resolved with self.tile_index, so no filesystem
+        call is made. Tiles are named after their south west corner,
+        lat/lon are floored accordingly (-0.5 is on S01). With
+        fetch-through active, a missing tile is downloaded first.
+
         CREDIT: https://github.com/aatishnn/srtm-python
         
         Args:
@@ -246,27 +580,10 @@ class OpenElevator():
                 OR
             None
         """
-        if lat >= 0:
-            ns = 'N'
-        elif lat < 0:
-            ns = 'S'
-
-        if lon >= 0:
-            ew = 'E'
-        elif lon < 0:
-            ew = 'W'
-
-        hgt_file = "%(ns)s%(lat)02d%(ew)s%(lon)03d.hgt" % \
-                {'lat': abs(lat), 'lon': abs(lon), 'ns': ns, 'ew': ew}
-        hgt_file_path = os.path.join(
-            self.data_dir,
-            hgt_file
-            )
-
-        if os.path.isfile(hgt_file_path):
-            return hgt_file_path
-        else:
-            return None    
+        tile_ids, _ = self.tile_index.resolve(lat, lon)
+        for future in self._fetch_missing(tile_ids):
+            future.result()
+        return self.tile_index.path(int(tile_ids))
 
     def get_data_from_hgt_file(self, hgt_file):
         '''
@@ -280,36 +597,369 @@ class OpenElevator():
         Every file contains 3601x3601 values with an equal distance of
         1 arc seconds (30 meter).
 
+        Kept for compatibility, the array is served memory-mapped
+        from self.tiles, so no data is read until it is accessed.
+
+        Args:
+            hgt_file:str >> file_name of hgt file
+
+        Returns:
+            elevations:np.memmap >> 2d numpy array with 3601x3601 values
+
+        '''
+        return self.tiles.get(hgt_file)
+
+    def _get_tile(self, hgt_file):
+        '''
+        Returns elevation array of given hgt file
+
+        If the tile cache is active, the tile is decoded to a native
+        endian array once and served from self.tile_cache afterwards,
+        otherwise the memory-mapped tile of self.tiles is returned.
+
         Args:
             hgt_file:str >> file_name of hgt file
 
         Returns:
             elevations:np.array >> 2d numpy array with 3601x3601 values
+        '''
+        if self.tile_cache.max_bytes == 0:
+            return self.tiles.get(hgt_file)
+        return self._get_halo_tile(hgt_file).core
 
+    def _get_halo_tile(self, hgt_file):
         '''
-        with open(os.path.join(self.data_dir, hgt_file), 'rb') as hgt_data:            
-            elevations = np.fromfile(
-                hgt_data,  # binary data
-                np.dtype('>i2'),  # data type
-                self.SAMPLES * self.SAMPLES  # length
-            ).reshape((self.SAMPLES, self.SAMPLES))
-            return elevations
+        Returns cached tile padded with a border of self.HALO cells,
+        decoded and added to self.tile_cache on first access. The
+        border is filled lazily, see self._interpolate_tile.
+
+        Args:
+            hgt_file:str >> file_name of hgt file
+
+        Returns:
+            tile:HaloTile >> padded tile, see tiles.HaloTile
+        '''
+        return self.tile_cache.get_or_load(
+            os.path.basename(hgt_file),
+            lambda: HaloTile(self.tiles.get(hgt_file), halo=self.HALO)
+            )
+
+    def _neighbour_tile(self, hgt_file, dlat, dlon):
+        '''
+        Returns memory-mapped neighbour of given tile, wraps around
+        the antimeridian
+
+        Args:
+            hgt_file:str >> file_name of hgt file
+            dlat:int     >> latitude offset of the neighbour (-1, 0, 1)
+            dlon:int     >> longitude offset of the neighbour (-1, 0, 1)
+
+        Returns:
+            elevations:np.memmap >> 2d numpy array with 3601x3601 values
+                OR
+            None
+        '''
+        lat, lon = TileIndex.tile_origin(hgt_file)
+        lat, lon = lat + dlat, (lon + dlon + 180) % 360 - 180
+        if not -90 <= lat < 90:
+            return None
+        neighbour = self.tile_index.path((lat + 90) * 360 + (lon + 180))
+        if neighbour:
+            try:
+                return self.tiles.get(neighbour)
+            except FileNotFoundError:
+                self._on_tile_evicted(neighbour)
+        return None
+
+    async def prewarm(self, tiles=None, workers=4):
+        '''
+        Warms the most accessed tiles of self.heatmap after a start,
+        so the first requests don't read every hot tile from disk
+
+        With the tile cache active, tiles are decoded into the cache
+        with their halos built, otherwise the memory-mapped files are
+        read once, so their pages are in the page cache. By default as
+        many tiles are warmed as fit into the tile cache, at most
+        self.prewarm_tiles. Progress is kept in self.warmup, see
+        self.readiness().
+
+        Args:
+            tiles:list  >> tile names to warm, None for the most accessed
+            workers:int >> tiles warmed at once
+
+        Returns:
+            warmup:dict >> see self.readiness()
+        '''
+        if tiles is None:
+            n = min(self.prewarm_tiles, self.tiles.max_open)
+            if self.tile_cache.max_bytes > 0:
+                n = min(n, self.tile_cache.max_bytes // ((self.SAMPLES + 2 * self.HALO) ** 2 * 2))
+            tiles = self.heatmap.top(n) if self.heatmap is not None and n > 0 else []
+        tiles = [i for i in tiles if self.tile_index.present[self.tile_index.tile_id(i)]]
+
+        start = time.time()
+        self.warmup = {"state":"warming", "tiles":0, "total":len(tiles), "seconds":None}
+        queue = list(tiles)
+
+        async def warm():
+            while queue:
+                hgt_file = queue.pop(0)
+                try:
+                    await self.executor.run_io(self._prewarm_tile, hgt_file)
+                except Exception as e:
+                    print(f"Warming {hgt_file} failed: {e}")
+                self.warmup["tiles"] += 1
+
+        await asyncio.gather(*(warm() for _ in range(workers)))
+        self.warmup["state"] = "ready"
+        self.warmup["seconds"] = time.time() - start
+        return self.readiness()
+
+    def _prewarm_tile(self, hgt_file):
+        '''
+        Loads a single tile into the tile cache or the page cache
+        '''
+        if self.tile_cache.max_bytes == 0:
+            # reading every value pages in the whole file
+            np.asarray(self.tiles.get(hgt_file)).max()
+            return
+        tile = self._get_halo_tile(hgt_file)
+        if not tile.halo_built:
+            tile.build_halo(
+                lambda dlat, dlon: self._neighbour_tile(hgt_file, dlat, dlon)
+                )
+
+    def prepare_workers(self, workers):
+        '''
+        Prepares this process to be forked into the workers of the
+        API, see prefork.py
+
+        The most accessed tiles are warmed first, so all workers share
+        them copy-on-write instead of decoding their own copies. The
+        rest of the tile and chunk cache budgets is split between the
+        workers, memory-mapped tiles are shared through the page cache
+        anyway. The pools are stopped, as threads don't survive a fork,
+        every worker starts its own on first use.
+
+        Args:
+            workers:int >> number of worker processes
+        '''
+        asyncio.run(self.prewarm())
+        self.executor.shutdown()
+        caches = [self.tile_cache] + [
+            store.cache for store in self.tiles.stores if isinstance(store, ChunkedStore)
+            ]
+        for cache in caches:
+            cache.max_bytes = cache.resident_bytes + (cache.max_bytes - cache.resident_bytes) // workers
+        if self.fetcher is not None:
+            self.fetcher.shutdown()
+            if self.fetcher.max_bytes is not None:
+                # a worker must not delete tiles the others are reading
+                print("Fetched tiles are not evicted with several workers, fetch_max_gb is ignored")
+                self.fetcher.max_bytes = None
+
+    def readiness(self):
+        '''
+        Returns the warmup progress
+
+        Returns:
+            readiness:dict >> ready (bool), state ("pending", "warming",
+                              "ready"), tiles warmed, total tiles to warm
+                              and seconds the warmup took
+        '''
+        return {"ready":self.warmup["state"] == "ready", **self.warmup}
+
+    def _fetch_missing(self, tile_ids):
+        '''
+        Starts fetch-through downloads of the missing tiles of given
+        locations, see self.fetcher. Present tiles are marked as
+        accessed, so tiles in use are not evicted.
+
+        Args:
+            tile_ids:np.array >> integer tile ids of the locations
+
+        Returns:
+            futures:list >> futures of the downloads, empty without
+                            self.fetcher
+        '''
+        if self.fetcher is None:
+            return []
+        tile_ids = np.atleast_1d(tile_ids)
+        futures, accessed = [], []
+        for tile_id in np.unique(tile_ids[tile_ids >= 0]):
+            lat, lon = self.tile_index.origin(int(tile_id))
+            name = TileIndex.tile_name(lat, lon)
+            if self.tile_index.present[tile_id]:
+                accessed.append(name)
+            elif not self.fetcher.is_missing(name):
+                futures.append(self.fetcher.fetch(name))
+        self.fetcher.touch(accessed)
+        return futures
+
+    async def _fetch_through(self, lats, lons):
+        '''
+        Resolves locations to tiles, missing tiles are fetched first
+        if fetch-through is active
+
+        Returns:
+            tile_ids:np.array >> see TileIndex.resolve()
+            present:np.array  >> see TileIndex.resolve()
+        '''
+        with STAGE_SECONDS.time(stage="resolve"):
+            tile_ids, present = self.tile_index.resolve(lats, lons)
+            futures = self._fetch_missing(tile_ids)
+        if futures:
+            with STAGE_SECONDS.time(stage="fetch"):
+                await asyncio.gather(*(asyncio.wrap_future(i) for i in futures))
+            tile_ids, present = self.tile_index.resolve(lats, lons)
+        return tile_ids, present
+
+    def _on_tile_fetched(self, hgt_file):
+        '''
+        Adds a fetched tile to the index, cached neighbours are dropped,
+        so their borders are copied again including the new tile
+        '''
+        self.tile_index.add(hgt_file)
+        lat, lon = TileIndex.tile_origin(hgt_file)
+        for dlat in (-1, 0, 1):
+            for dlon in (-1, 0, 1):
+                if (dlat or dlon) and -90 <= lat + dlat < 90:
+                    self.tile_cache.remove(TileIndex.tile_name(lat + dlat, (lon + dlon + 180) % 360 - 180))
+
+    def _on_tile_evicted(self, hgt_file):
+        '''
+        Removes a tile deleted by the fetcher from index, pool and cache
+        '''
+        self.tile_index.remove(hgt_file)
+        self.tiles.close(hgt_file)
+        self.tile_cache.remove(os.path.basename(hgt_file))
+
+    async def run_cpu(self, method, *args, **kwargs):
+        '''
+        Runs a method in the CPU pool, see Executor.run_cpu()
+
+        Worker processes build their tile index once at start and
+        don't fetch, so the index of this process is passed along with
+        every job: tiles fetched meanwhile are added to the index of
+        the worker, evicted ones removed, see self._run_synced().
+
+        Args:
+            method:str >> method name
+
+        Returns:
+            result:object >> return value of the method
+        '''
+        return await self.executor.run_cpu(
+            "_run_synced",
+            self.tile_index.snapshot(),
+            method,
+            args,
+            kwargs
+            )
+
+    def _run_synced(self, snapshot, method, args, kwargs):
+        '''
+        Applies a snapshot of the tile index of another process and
+        calls a method, see self.run_cpu()
+
+        Args:
+            snapshot:np.array >> see TileIndex.snapshot()
+            method:str        >> method name
+            args:tuple        >> positional arguments of the method
+            kwargs:dict       >> keyword arguments of the method
+        '''
+        added, removed = self.tile_index.changes(snapshot)
+        for hgt_file in added:
+            self._on_tile_fetched(hgt_file)
+        for hgt_file in removed:
+            self._on_tile_evicted(hgt_file)
+        return getattr(self, method)(*args, **kwargs)
+
+    def batch_stats(self):
+        '''
+        Returns batch counters of concurrent single point lookups
 
-    async def get_elevation(self, lat, lon, interpolation="cubic"):
+        Returns:
+            stats:dict >> see PointBatcher.stats(), None if batching
+                          is not active
+        '''
+        if self.batcher is not None:
+            return self.batcher.stats()
+
+    def fetch_stats(self):
+        '''
+        Returns download, miss and disk counters of fetch-through
+
+        Returns:
+            stats:dict >> see FetchThrough.stats(), None if fetch-through
+                          is not active
+        '''
+        if self.fetcher is not None:
+            return self.fetcher.stats()
+
+    def tile_cache_stats(self):
+        '''
+        Returns hit, miss, eviction and memory counters of
+        the in-process tile cache
+
+        Returns:
+            stats:dict >> see TileCache.stats()
+        '''
+        return self.tile_cache.stats()
+
+    def result_cache_stats(self):
+        '''
+        Returns hit, miss and error counters per tier of the
+        result cache
+
+        Returns:
+            stats:dict >> see ResultCache.stats(), None if the
+                          cache is not active
+        '''
+        if self.cache_active:
+            return self.result_cache.stats()
+
+    def cache_stats(self):
+        '''
+        Returns hit and miss counters of all in-process caches and
+        the Redis tier, e.g. for metrics.register_cache_metrics()
+
+        Returns:
+            stats:dict >> {cache name: stats dict}, caches are tile,
+                          result_l1, result_l2 and render
+        '''
+        stats = {
+            "tile":self.tile_cache.stats(),
+            "render":self.render_cache.stats()
+            }
+        if self.cache_active:
+            result = self.result_cache.stats()
+            stats["result_l1"] = result["l1"]
+            stats["result_l2"] = result["l2"]
+        return stats
+
+    async def get_elevation(self, lat, lon, interpolation="cubic", level=0):
         """
         Get elevation for given lat,lon and interpolation method
 
-        For locations between data points, interpolation is being used by
-        scipy package. Interpolation methods available are cubic, linear and
+        For locations between data points, the raster is interpolated with
+        the kernels of interpolation.py. Interpolation methods available are 
+        cubic (bicubic over the 4x4 surrounding grid points), linear (bilinear)
         and nearest_neighbor. However, the underlying dataset is very accurate 
         (30 meter resolution), so the greatest distance to a verified measurement 
         is maximum 15 meters. 
 
+        With batching active (batch_window_us), concurrent calls are
+        looked up together by self.batcher, calls for the same location
+        share one lookup.
+
         Args:
             lat:float >> latitude, number between -90 and 90
             lon:float >> longitude, number between -180 and 180
             interpolation:str >> interpolation_method in self.INTERPOLATION_METHODS
                                  ["none","linear","cubic","nearest"]
+            level:int >> resolution level in self.overview_levels(), 0 is
+                         the full resolution
         
         Returns:
             elevation:float >> elevation above sea level
@@ -317,58 +967,535 @@ class OpenElevator():
 
         if interpolation not in self.INTERPOLATION_METHODS:
             print(f"Interpolation method {interpolation} not available. Available methods: {self.INTERPOLATION_METHODS}")
+        elif self.batcher is not None:
+            return await self.batcher.get(float(lat), float(lon), interpolation=interpolation, level=level)
         else:
-            hgt_file = self._get_file_name(lat, lon)
-            if hgt_file:               
-
-                lat_row = int(round((lat - int(lat)) * (self.SAMPLES - 1), 0))
-                lon_row = int(round((lon - int(lon)) * (self.SAMPLES - 1), 0))
-                lat_row_raw = (lat - int(lat)) * (self.SAMPLES - 1)
-                lon_row_raw = (lon - int(lon)) * (self.SAMPLES - 1)   
-
-                if self.cache_active:
-                    cache_key = str(hgt_file) + "_" + str(lat_row_raw) + "_" + str(lon_row_raw) + "_" + interpolation
-                    cache_result = await self.cache.get(cache_key)
-                    if cache_result is not None:
-                        return float(cache_result)
-
-                elevations = self.get_data_from_hgt_file(hgt_file)                
-
-                if interpolation == "none":                    
-                    elevation = float(elevations[self.SAMPLES - 1 - lat_row, lon_row].astype(int))
-                # in case we are at the very edges of a tile file, we do
-                # not interpolate to avoid opening up to 4 tile files for
-                # a single elevation lookup
-                elif lat_row_raw == 0.0 or lon_row == 0.0:
-                    elevation = float(elevations[self.SAMPLES - 1 - lat_row, lon_row].astype(int))
+            elevations = await self.get_elevations([lat], [lon], interpolation=interpolation, level=level)
+            if elevations is not None:
+                return float(elevations[0])
+
+    async def get_elevations(self, lats, lons, interpolation="cubic", level=0):
+        '''
+        Get elevations for arrays of lats, lons and interpolation method
+
+        Batch version of self.get_elevation. Points are grouped by the
+        tile they are located on, so every distinct tile is read and
+        interpolated only once per call, no matter how many points
+        fall on it.
+
+        If the cache is active, positions are snapped to the key grid
+        of self.result_cache, all points are looked up in the in-process
+        L1 and the rest with a single MGET in redis, the missing ones
+        are stored with a single pipeline. Locations on missing tiles
+        are answered by self.tile_index without any cache lookup,
+        with fetch-through active the tiles are downloaded first.
+
+        Levels above 0 are looked up on the overviews of
+        self.build_overviews() without the cache.
+
+        Args:
+            lats:np.array >> latitudes, numbers between -90 and 90
+            lons:np.array >> longitudes, numbers between -180 and 180
+            interpolation:str >> interpolation_method in self.INTERPOLATION_METHODS
+                                 ["none","linear","cubic","nearest"]
+            level:int >> resolution level in self.overview_levels(), 0 is
+                         the full resolution
+
+        Returns:
+            elevations:np.array >> elevations above sea level in input order,
+                                   -32768 for locations without data
+        '''
+        if interpolation not in self.INTERPOLATION_METHODS:
+            print(f"Interpolation method {interpolation} not available. Available methods: {self.INTERPOLATION_METHODS}")
+            return None
+
+        if level not in self.overview_levels():
+            print(f"Level {level} not available. Available levels: {self.overview_levels()}")
+            return None
+
+        lats = np.atleast_1d(np.asarray(lats, dtype=np.float64))
+        lons = np.atleast_1d(np.asarray(lons, dtype=np.float64))
+        if level:
+            if level != self.GLOBAL_LEVEL:
+                await self._fetch_through(lats, lons)
+            return await self.executor.run_io(self._sample, lats, lons, interpolation, level)
+        # Treat it as data void as in SRTM documentation
+        # if file is absent
+        elevations = np.full(lats.shape, -32768.0)
+
+        tile_ids, present = await self._fetch_through(lats, lons)
+        members = np.nonzero(present)[0]
+        if members.size == 0:
+            return elevations
+        tile_ids = tile_ids[members]
+        if self.heatmap is not None:
+            self.heatmap.add(tile_ids)
+            if self.heatmap.due():
+                await self.executor.run_io(self.heatmap.save)
+
+        # fractional position on the tile, rows count from
+        # the northern edge of the tile
+        last = self.SAMPLES - 1
+        lat_origin, lon_origin = self.tile_index.origin(tile_ids)
+        rows = last - (lats[members] - lat_origin) * last
+        cols = (lons[members] - lon_origin) * last
+
+        if self.cache_active:
+            key_rows, key_cols, rows, cols = self.result_cache.quantize(rows, cols, interpolation)
+            keys = self.result_cache.keys(tile_ids, key_rows, key_cols, interpolation)
+            with STAGE_SECONDS.time(stage="cache_get"):
+                cached = await self.result_cache.get_many(keys)
+            hit = ~np.isnan(cached)
+            elevations[members[hit]] = cached[hit]
+            members, tile_ids, rows, cols = members[~hit], tile_ids[~hit], rows[~hit], cols[~hit]
+            keys = [key for key, is_hit in zip(keys, hit) if not is_hit]
+
+        # reads and interpolation run in the I/O pool, so cold
+        # tiles do not block the event loop
+        if members.size:
+            elevations[members] = await self.executor.run_io(
+                self._interpolate_groups,
+                tile_ids,
+                rows,
+                cols,
+                interpolation
+                )
+
+        if self.cache_active:
+            with STAGE_SECONDS.time(stage="cache_set"):
+                await self.result_cache.set_many(keys, elevations[members])
+        return elevations
+
+    def _interpolate_groups(self, tile_ids, rows, cols, interpolation):
+        '''
+        Interpolates points grouped by tile, every tile is read once
+
+        Args:
+            tile_ids:np.array   >> integer tile ids of the points
+            rows:np.array       >> fractional row positions on the tiles
+            cols:np.array       >> fractional col positions on the tiles
+            interpolation:str   >> interpolation method
+
+        Returns:
+            elevations:np.array >> elevations of given points
+        '''
+        elevations = np.empty(rows.shape)
+        for tile_id, group in self._group_by_tile(tile_ids):
+            elevations[group] = self._interpolate_tile(
+                self.tile_index.path(tile_id),
+                rows[group],
+                cols[group],
+                interpolation
+                )
+        return elevations
+
+    @staticmethod
+    def _group_by_tile(tile_ids):
+        '''
+        Groups points by tile
+
+        Args:
+            tile_ids:np.array >> integer tile ids of the points
+
+        Returns:
+            iterator of
+                tile_id:int     >> tile id
+                group:np.array  >> indices of the points on the tile
+        '''
+        order = np.argsort(tile_ids, kind="stable")
+        tiles, starts = np.unique(tile_ids[order], return_index=True)
+        return zip(tiles, np.split(order, starts[1:]))
+
+    def _sample(self, lats, lons, interpolation, level=0):
+        '''
+        Vectorized elevation lookup on any level without the result
+        cache, tiles without overview are looked up in full resolution
+
+        Args:
+            lats:np.array     >> latitudes
+            lons:np.array     >> longitudes
+            interpolation:str >> interpolation method
+            level:int         >> level in self.overview_levels()
+
+        Returns:
+            elevations:np.array >> elevations above sea level in input order,
+                                   -32768 for locations without data
+        '''
+        elevations = np.full(lats.shape, -32768.0)
+        if level == self.GLOBAL_LEVEL:
+            valid = (lats >= -90) & (lats <= 90) & (lons >= -180) & (lons <= 180)
+            samples_per_degree = (self.global_overview.shape[0] - 1) // 180
+            elevations[valid] = interpolate(
+                self.global_overview,
+                (90 - lats[valid]) * samples_per_degree,
+                (lons[valid] + 180) * samples_per_degree,
+                method=interpolation
+                )
+            return elevations
+
+        tile_ids, present = self.tile_index.resolve(lats, lons)
+        members  = np.nonzero(present)[0]
+        tile_ids = tile_ids[members]
+        lat_origin, lon_origin = self.tile_index.origin(tile_ids)
+        pool = self.overview_tiles.get(level)
+        for tile_id, group in self._group_by_tile(tile_ids):
+            hgt_file = self.tile_index.path(tile_id)
+            name = os.path.basename(hgt_file)
+            # full resolution or tiles added after the overviews were built
+            if pool is None or (name not in pool and not os.path.isfile(os.path.join(pool.data_dir, name))):
+                last = self.SAMPLES - 1
+                tile = None
+            else:
+                last = pool.samples - 1
+                tile = pool.get(name)
+            rows = last - (lats[members[group]] - lat_origin[group]) * last
+            cols = (lons[members[group]] - lon_origin[group]) * last
+            if tile is None:
+                elevations[members[group]] = self._interpolate_tile(hgt_file, rows, cols, interpolation)
+            else:
+                elevations[members[group]] = interpolate(tile, rows, cols, method=interpolation)
+        return elevations
+
+    def _interpolate_tile(self, hgt_file, rows, cols, interpolation):
+        '''
+        Vectorized elevation lookup for points located on one tile
+
+        Points are interpolated with the closed-form kernels of
+        interpolation.py.
+
+        With the tile cache active, tiles carry a border copied from
+        their neighbours, so points at the tile edges are interpolated
+        across tiles. The border is built once the first point close
+        to an edge is requested and kept in the tile cache. Without
+        the tile cache, points close to the edges are interpolated on
+        small bordered windows instead, see self._interpolate_edges().
+
+        Args:
+            hgt_file:str        >> file_name of hgt file
+            rows:np.array       >> fractional row positions on the tile,
+                                   counted from the northern edge
+            cols:np.array       >> fractional col positions on the tile,
+                                   counted from the western edge
+            interpolation:str   >> interpolation method
+
+        Returns:
+            elevations:np.array >> elevations of given points
+        '''
+        last = self.SAMPLES - 1
+        if self.tile_cache.max_bytes == 0:
+            with STAGE_SECONDS.time(stage="read"):
+                try:
+                    tile = self.tiles.get(hgt_file)
+                except FileNotFoundError:
+                    return self._tile_vanished(hgt_file, rows)
+            with STAGE_SECONDS.time(stage="interpolate"):
+                if interpolation not in ("linear", "cubic"):
+                    return interpolate(tile, rows, cols, method=interpolation)
+                edge = (rows < 1) | (rows >= last - 2) | (cols < 1) | (cols >= last - 2)
+                elevations = np.empty(rows.shape)
+                elevations[~edge] = interpolate(tile, rows[~edge], cols[~edge], method=interpolation)
+                if np.any(edge):
+                    elevations[edge] = self._interpolate_edges(hgt_file, tile, rows[edge], cols[edge], interpolation)
+                return elevations
+
+        with STAGE_SECONDS.time(stage="read"):
+            try:
+                tile = self._get_halo_tile(hgt_file)
+            except FileNotFoundError:
+                return self._tile_vanished(hgt_file, rows)
+            if not tile.halo_built and interpolation in ("linear", "cubic"):
+                # the 4x4 neighbourhood of the point crosses the tile edge
+                edge = (rows < 1) | (rows >= last - 2) | (cols < 1) | (cols >= last - 2)
+                if np.any(edge):
+                    tile.build_halo(
+                        lambda dlat, dlon: self._neighbour_tile(hgt_file, dlat, dlon)
+                        )
+        with STAGE_SECONDS.time(stage="interpolate"):
+            return interpolate(
+                tile.data,
+                rows + tile.halo,
+                cols + tile.halo,
+                method=interpolation
+                )
+
+    def _tile_vanished(self, hgt_file, rows):
+        '''
+        Removes a tile deleted since it was indexed, e.g. evicted by
+        the fetcher of another process, its points are data voids
+
+        Returns:
+            elevations:np.array >> -32768 for every point
+        '''
+        print(f"Tile {os.path.basename(hgt_file)} was removed, treated as void")
+        self._on_tile_evicted(hgt_file)
+        return np.full(rows.shape, -32768.0)
+
+    def _interpolate_edges(self, hgt_file, tile, rows, cols, interpolation):
+        '''
+        Interpolates points close to the tile edges without the tile
+        cache. The points are split into strips along the four edges,
+        every strip is interpolated on a small window of the padded
+        tile (see tiles.halo_window), so the results match the cached
+        HaloTile lookups.
+
+        Args:
+            hgt_file:str        >> file_name of hgt file
+            tile:np.array       >> memory-mapped tile
+            rows:np.array       >> fractional row positions on the tile
+            cols:np.array       >> fractional col positions on the tile
+            interpolation:str   >> interpolation method
+
+        Returns:
+            elevations:np.array >> elevations of given points
+        '''
+        last, h = self.SAMPLES - 1, self.HALO
+        padded = self.SAMPLES + 2 * h
+        north = rows < 1
+        south = ~north & (rows >= last - 2)
+        west  = ~north & ~south & (cols < 1)
+        east  = ~north & ~south & ~west
+        elevations = np.empty(rows.shape)
+        for strip in (north, south, west, east):
+            if not np.any(strip):
+                continue
+            # cells of the 4x4 neighbourhoods of the points
+            r = np.floor(rows[strip]).astype(np.intp) + h
+            c = np.floor(cols[strip]).astype(np.intp) + h
+            r0, r1 = max(r.min() - 1, 0), min(r.max() + 3, padded)
+            c0, c1 = max(c.min() - 1, 0), min(c.max() + 3, padded)
+            window = halo_window(
+                tile,
+                lambda dlat, dlon: self._neighbour_tile(hgt_file, dlat, dlon),
+                np.arange(r0, r1),
+                np.arange(c0, c1),
+                halo=h
+                )
+            elevations[strip] = interpolate(
+                window,
+                rows[strip] + h - r0,
+                cols[strip] + h - c0,
+                method=interpolation
+                )
+        return elevations
+
+    async def get_profile(self, line, spacing_m=30, interpolation="linear", max_samples=None):
+        '''
+        Get elevation profile along a GeoJSON LineString or MultiLineString
+
+        The line is sampled every spacing_m meters along its great
+        circle segments (see geo.densify), all samples are looked up
+        with a single call of self.get_elevations, so every tile the
+        line crosses is read only once. Parts of a MultiLineString
+        are joined, distances continue from the end of the previous
+        part, gaps between parts do not count as ascent or descent.
+
+        Args:
+            line:dict          >> GeoJSON LineString, MultiLineString or
+                                  Feature with one of them
+            spacing_m:float    >> distance between samples in meters
+            interpolation:str  >> interpolation_method in self.INTERPOLATION_METHODS
+            max_samples:int    >> max amount of samples, None for no limit
+
+        Returns:
+            profile:dict >> lons, lats, distances (meters from the start),
+                            elevations (-32768 for data voids) as np.array,
+                            length, ascent and descent in meters
+        '''
+        if interpolation not in self.INTERPOLATION_METHODS:
+            print(f"Interpolation method {interpolation} not available. Available methods: {self.INTERPOLATION_METHODS}")
+            return None
+        if not spacing_m > 0:
+            print("spacing_m must be greater than 0")
+            return None
+        parts = geo.line_parts(line)
+        if isinstance(parts, dict):
+            print(parts["error"])
+            return None
+
+        lons, lats, distances, part_ids = [], [], [], []
+        offset = 0.0
+        for i, part in enumerate(parts):
+            part_lons, part_lats, part_distances = geo.densify(part, spacing_m)
+            lons.append(part_lons)
+            lats.append(part_lats)
+            distances.append(part_distances + offset)
+            part_ids.append(np.full(part_distances.shape, i))
+            offset += part_distances[-1]
+            if max_samples and sum(len(i) for i in distances) > max_samples:
+                print(f"Profile exceeds {max_samples} samples, increase spacing_m")
+                return None
+        lons, lats = np.concatenate(lons), np.concatenate(lats)
+        distances, part_ids = np.concatenate(distances), np.concatenate(part_ids)
+
+        elevations = await self.get_elevations(lats, lons, interpolation=interpolation)
+
+        # ascent and descent between consecutive samples of one part
+        # with data on both ends
+        steps = np.diff(elevations)
+        valid = (part_ids[1:] == part_ids[:-1]) & (elevations[1:] != -32768) & (elevations[:-1] != -32768)
+        steps = steps[valid]
+        return {
+            "lons":lons,
+            "lats":lats,
+            "distances":distances,
+            "elevations":elevations,
+            "length":float(offset),
+            "ascent":float(steps[steps > 0].sum()),
+            "descent":float(abs(steps[steps < 0].sum()))
+            }
+
+    async def get_area_stats(self, area, percentiles=(5, 25, 50, 75, 95), max_tiles=None):
+        '''
+        Get elevation and slope statistics of an area, computed in
+        the I/O pool, see self._area_stats()
+
+        Args:
+            area:list|dict     >> bbox [min_lon, min_lat, max_lon, max_lat]
+                                  or GeoJSON Polygon, MultiPolygon or Feature
+            percentiles:tuple  >> percentiles of elevation and slope
+            max_tiles:int      >> max amount of tiles covered by the area,
+                                  None for no limit
+
+        Returns:
+            stats:dict >> see self._area_stats()
+        '''
+        return await self.executor.run_io(
+            self._area_stats,
+            area,
+            percentiles=percentiles,
+            max_tiles=max_tiles
+            )
+
+    def _area_stats(self, area, percentiles=(5, 25, 50, 75, 95), max_tiles=None):
+        '''
+        Elevation and slope statistics of an area
+
+        The area is processed tile by tile: the window of every tile
+        covering the area is read, masked by the polygon and added to
+        streaming histograms (see terrain.Histogram), so memory does not
+        grow with the size of the area. Tiles are read directly from
+        self.tiles and not kept in the tile cache. Every tile contributes
+        its cells without the southern row and eastern col, which are
+        shared with its neighbours, unless these neighbours are not read.
+
+        Slope is computed by central differences in meters (see
+        terrain.slope_aspect), aspect is the share of cells facing each
+        compass sector, flat cells are not counted.
+
+        Args:
+            area:list|dict     >> bbox [min_lon, min_lat, max_lon, max_lat]
+                                  or GeoJSON Polygon, MultiPolygon or Feature
+            percentiles:tuple  >> percentiles of elevation and slope
+            max_tiles:int      >> max amount of tiles covered by the area,
+                                  None for no limit
+
+        Returns:
+            stats:dict >> bbox, tiles (read), missing_tiles, voids (cells
+                          without data), elevation and slope (see
+                          terrain.Histogram.stats()) and aspect
+        '''
+        parsed = geo.area_polygons(area)
+        if isinstance(parsed, dict):
+            print(parsed["error"])
+            return None
+        polygons, (min_lon, min_lat, max_lon, max_lat) = parsed
+        min_lon, max_lon = max(min_lon, -180.0), min(max_lon, 180.0)
+        min_lat, max_lat = max(min_lat, -90.0), min(max_lat, 90.0)
+
+        # SW corners of the covering tiles
+        first_lat = min(int(np.floor(min_lat)), 89)
+        first_lon = min(int(np.floor(min_lon)), 179)
+        tile_lats = range(first_lat, max(min(int(np.ceil(max_lat)), 90), first_lat + 1))
+        tile_lons = range(first_lon, max(min(int(np.ceil(max_lon)), 180), first_lon + 1))
+        if max_tiles and len(tile_lats) * len(tile_lons) > max_tiles:
+            print(f"Area covers more than {max_tiles} tiles")
+            return None
+        fetches = self._fetch_missing(np.array([
+            (lat0 + 90) * 360 + (lon0 + 180) for lat0 in tile_lats for lon0 in tile_lons
+            ]))
+        for future in fetches:
+            future.result()
+
+        last = self.SAMPLES - 1
+        elevations = terrain.Histogram()
+        # slope in steps of 0.01 degrees
+        slopes  = terrain.Histogram(bins=9001, offset=0, scale=100)
+        aspects = np.zeros(len(terrain.ASPECTS), dtype=np.int64)
+        tiles, missing, voids = 0, 0, 0
+
+        for lat0 in tile_lats:
+            for lon0 in tile_lons:
+                tile_id = (lat0 + 90) * 360 + (lon0 + 180)
+                if not self.tile_index.present[tile_id]:
+                    missing += 1
+                    continue
+
+                # window of the area on the tile, rows count from the north
+                # (rounded, so borders on the grid are not lost to float errors)
+                row_start = max(int(np.ceil(round((lat0 + 1 - max_lat) * last, 6))), 0)
+                # the southern row and eastern col belong to the neighbour,
+                # unless it is not read, e.g. for min_lat on a full degree
+                south = lat0 > tile_lats[0] and self.tile_index.present[tile_id - 360]
+                east  = lon0 < tile_lons[-1] and self.tile_index.present[tile_id + 1]
+                row_end   = min(int(np.floor(round((lat0 + 1 - min_lat) * last, 6))), last - 1 if south else last)
+                col_start = max(int(np.ceil(round((min_lon - lon0) * last, 6))), 0)
+                col_end   = min(int(np.floor(round((max_lon - lon0) * last, 6))), last - 1 if east else last)
+                if row_start > row_end or col_start > col_end:
+                    continue
+                try:
+                    tile = self.tiles.get(self.tile_index.path(tile_id))
+                except FileNotFoundError:
+                    self._on_tile_evicted(self.tile_index.path(tile_id))
+                    missing += 1
+                    continue
+                tiles += 1
+
+                # one more cell on every side for the gradients
+                pad_row, pad_col = max(row_start - 1, 0), max(col_start - 1, 0)
+                data = np.asarray(tile[
+                    pad_row:min(row_end + 1, last) + 1,
+                    pad_col:min(col_end + 1, last) + 1
+                    ])
+                row_lats = lat0 + 1 - np.arange(pad_row, pad_row + data.shape[0]) / last
+                slope, aspect, valid = terrain.slope_aspect(data, row_lats, 1 / last)
+
+                inner = (
+                    slice(row_start - pad_row, row_end - pad_row + 1),
+                    slice(col_start - pad_col, col_end - pad_col + 1)
+                    )
+                data, slope, aspect, valid = data[inner], slope[inner], aspect[inner], valid[inner]
+                if polygons is None:
+                    mask = np.ones(data.shape, dtype=bool)
                 else:
-                    grid = [
-                        [int(lon_row_raw), int(lat_row_raw)+1],
-                        [int(lon_row_raw)+1, int(lat_row_raw)+1],
-                        [int(lon_row_raw)+1, int(lat_row_raw)],
-                        [int(lon_row_raw), int(lat_row_raw)]
-                        ]
-                    data = [
-                        elevations[self.SAMPLES - 1 - int(lat_row_raw)+1, int(lon_row_raw)].astype(int),
-                        elevations[self.SAMPLES - 1 - int(lat_row_raw)+1, int(lon_row_raw)+1].astype(int),
-                        elevations[self.SAMPLES - 1 - int(lat_row_raw), int(lon_row_raw)+1].astype(int),
-                        elevations[self.SAMPLES - 1 - int(lat_row_raw), int(lon_row_raw)].astype(int)
-                    ]                  
-                    elevation = float(griddata(
-                        grid, data,
-                        [lon_row_raw, lat_row_raw], 
-                        method=interpolation
-                        )[0])
-
-                if self.cache_active:
-                    await self.cache.set(cache_key, elevation)
-                
-                return elevation
-            # Treat it as data void as in SRTM documentation
-            # if file is absent
-            return -32768
-
-    def plot_elevation(self, lat, lon, colormap="terrain"):
+                    mask = geo.polygon_mask(
+                        polygons,
+                        row_lats[inner[0]],
+                        lon0 + np.arange(col_start, col_end + 1) / last
+                        )
+
+                void = data == terrain.VOID
+                voids += int(np.count_nonzero(mask & void))
+                elevations.add(data[mask & ~void])
+                slopes.add(slope[mask & valid])
+                sloped = mask & valid & (slope > 0)
+                sectors = ((aspect[sloped] + 22.5) // 45).astype(np.intp) % len(terrain.ASPECTS)
+                aspects += np.bincount(sectors, minlength=len(terrain.ASPECTS))
+
+        total = aspects.sum()
+        return {
+            "bbox":[min_lon, min_lat, max_lon, max_lat],
+            "tiles":tiles,
+            "missing_tiles":missing,
+            "voids":voids,
+            "elevation":elevations.stats(percentiles),
+            "slope":slopes.stats(percentiles),
+            "aspect":{
+                name:float(count / total) if total else 0.0
+                for name, count in zip(terrain.ASPECTS, aspects.tolist())
+                }
+            }
+
+    def plot_elevation(self, lat, lon, colormap="terrain", level=0):
         '''
         Plot elevation arround given coordinates and marks
         the coordinate location on the plot.
@@ -392,42 +1519,205 @@ class OpenElevator():
         Args:
             lat:float >> latitude, number between -90 and 90
             lon:float >> longitude, number between -180 and 180
+            level:int >> resolution level in self.overview_levels(),
+                         self.GLOBAL_LEVEL plots the whole earth
 
         Returns:
             img:BytesIO memory buffer >> vizualize with
                                          >>from PIL import Image
                                          >>with Image.open(img) as f_img:
                                          >>    f_img.show()
+                OR
+            None >> no tile or overview for the location
 
         '''
-        if colormap in self.COLORMAPS:
-            hgt_file = self._get_file_name(lat, lon)
-            if hgt_file:
-                memory_buffer = BytesIO()
-                data = self.get_data_from_hgt_file(hgt_file)
-                lat_row = int(round((lat - int(lat)) * (self.SAMPLES - 1), 0))
-                lon_row = int(round((lon - int(lon)) * (self.SAMPLES - 1), 0))
-
-                plt.imshow(data, cmap=colormap)
+        if level not in self.overview_levels():
+            print(f"Level {level} not available. Available levels: {self.overview_levels()}")
+        elif colormap in self.COLORMAPS:
+            if level == self.GLOBAL_LEVEL:
+                data = self.global_overview
+                samples_per_degree = (data.shape[0] - 1) // 180
+                lat_row = int(round((90 - lat) * samples_per_degree, 0))
+                lon_row = int(round((lon + 180) * samples_per_degree, 0))
+            else:
+                hgt_file = self._get_file_name(lat, lon)
+                if not hgt_file:
+                    return None
+                if level:
+                    try:
+                        data = self.overview_tiles[level].get(os.path.basename(hgt_file))
+                    except FileNotFoundError:
+                        data = None
+                    if data is None:
+                        print(f"No level {level} overview for {os.path.basename(hgt_file)}")
+                        return None
+                else:
+                    try:
+                        data = self._get_tile(hgt_file)
+                    except FileNotFoundError:
+                        self._tile_vanished(hgt_file, np.empty(0))
+                        return None
+                samples_per_degree = data.shape[0] - 1
+                lat_origin, lon_origin = TileIndex.tile_origin(hgt_file)
+                # rows count from the northern edge of the tile
+                lat_row = int(round((lat_origin + 1 - lat) * samples_per_degree, 0))
+                lon_row = int(round((lon - lon_origin) * samples_per_degree, 0))
+
+            memory_buffer = BytesIO()
+            arcseconds = 3600 // samples_per_degree
+            with _PLOT_LOCK:
+                plt.imshow(np.where(data == -32768, np.nan, data) if level else data, cmap=colormap)
                 plt.title(f"Elevation arround lat {lat}, lon {lon}")
-                plt.suptitle("Resolution: 1 arcsecond (30 meter)")
+                plt.suptitle(f"Resolution: {arcseconds} arcsecond{'s' if arcseconds > 1 else ''} ({30 * arcseconds} meter)")
                 plt.colorbar(label="meter above ground")
                 plt.scatter(lon_row, lat_row, s=50, c='red', marker='x')
 
                 plt.savefig(memory_buffer, format="png")            
-                memory_buffer.seek(0)
                 plt.clf()
-                return memory_buffer
+            memory_buffer.seek(0)
+            return memory_buffer
         else:
             print(f"colormap must be in {self.COLORMAPS}")
 
+    async def plot(self, lat, lon, colormap="terrain", level=0):
+        '''
+        Plots elevation arround given coordinates in the CPU pool, see
+        self.plot_elevation(). With fetch-through active, a missing
+        tile is downloaded first.
+
+        Returns:
+            img:BytesIO memory buffer >> see self.plot_elevation()
+        '''
+        if level != self.GLOBAL_LEVEL:
+            await self._fetch_through(np.array([lat], dtype=np.float64), np.array([lon], dtype=np.float64))
+        return await self.run_cpu("plot_elevation", lat, lon, colormap=colormap, level=level)
+
+    async def render_tile(self, z, x, y, colormap="terrain", hillshade=False, vmin=-100, vmax=4000):
+        '''
+        Renders a slippy map tile (web mercator, 256x256 pixels) as PNG,
+        served from self.render_cache or rendered in the CPU pool, see
+        self._render_tile()
+
+        Args:
+            z:int           >> zoom level, 0 to render.MAX_ZOOM
+            x:int           >> tile col
+            y:int           >> tile row
+            colormap:str    >> colormap in self.COLORMAPS
+            hillshade:bool  >> shade the terrain
+            vmin:float      >> elevation of the first color of the colormap
+            vmax:float      >> elevation of the last color of the colormap
+
+        Returns:
+            png:bytes >> PNG image, data voids are transparent
+        '''
+        key = (z, x, y, colormap, bool(hillshade), vmin, vmax)
+        png = self.render_cache.get(key)
+        if png is None:
+            await self._fetch_map_tile(z, x, y)
+            with STAGE_SECONDS.time(stage="render"):
+                png = await self.run_cpu(
+                    "_render_tile", z, x, y,
+                    colormap=colormap,
+                    hillshade=hillshade,
+                    vmin=vmin,
+                    vmax=vmax
+                    )
+            if png is not None:
+                self.render_cache.set(key, png)
+        return png
+
+    async def _fetch_map_tile(self, z, x, y):
+        '''
+        Fetches the missing tiles a map tile is rendered from, the
+        workers of the CPU pool don't fetch. Map tiles rendered from
+        overviews or covering more than self.RENDER_FETCH_TILES tiles
+        show the present tiles only, so zoomed out maps don't download
+        whole regions.
+
+        Args:
+            z:int >> zoom level, 0 to render.MAX_ZOOM
+            x:int >> tile col
+            y:int >> tile row
+        '''
+        if self.fetcher is None or not (0 <= z <= render.MAX_ZOOM and 0 <= x < 2 ** z and 0 <= y < 2 ** z):
+            return
+        lats, lons = render.tile_coordinates(z, x, y)
+        if self._render_level(z, lats) != 0:
+            return
+        lats, lons = np.meshgrid(lats, lons, indexing="ij")
+        tile_ids, _ = self.tile_index.resolve(lats.ravel(), lons.ravel())
+        if np.unique(tile_ids).size <= self.RENDER_FETCH_TILES:
+            await self._fetch_through(lats.ravel(), lons.ravel())
+
+    def _render_level(self, z, lats):
+        '''
+        Returns the coarsest level of self.overview_levels() that has
+        at least one sample per pixel of a map tile
+
+        Args:
+            z:int         >> zoom level
+            lats:np.array >> latitudes of the pixel rows
+        '''
+        spacing = render.pixel_size(z, lats)
+        resolution = lambda level: 30 * (
+            3600 // ((self.global_overview.shape[0] - 1) // 180)
+            if level == self.GLOBAL_LEVEL else 2 ** level
+            )
+        return max(
+            [i for i in self.overview_levels() if resolution(i) <= spacing.min()],
+            default=0
+            )
+
+    def _render_tile(self, z, x, y, colormap="terrain", hillshade=False, vmin=-100, vmax=4000):
+        '''
+        Renders a slippy map tile (web mercator, 256x256 pixels) as PNG
+
+        Elevations are sampled at the pixel centers on the coarsest
+        level of self.overview_levels() that is still finer than a
+        pixel, so low zoom levels read the overviews only. Colors come
+        from precomputed lookup tables of self.COLORMAPS, the PNG is
+        encoded without pyplot, see render.py.
+
+        Args:
+            z:int           >> zoom level, 0 to render.MAX_ZOOM
+            x:int           >> tile col
+            y:int           >> tile row
+            colormap:str    >> colormap in self.COLORMAPS
+            hillshade:bool  >> shade the terrain
+            vmin:float      >> elevation of the first color of the colormap
+            vmax:float      >> elevation of the last color of the colormap
+
+        Returns:
+            png:bytes >> PNG image, data voids are transparent
+        '''
+        if colormap not in self.COLORMAPS:
+            print(f"colormap must be in {self.COLORMAPS}")
+            return None
+        if not (0 <= z <= render.MAX_ZOOM and 0 <= x < 2 ** z and 0 <= y < 2 ** z):
+            print(f"Tile {z}/{x}/{y} does not exist")
+            return None
+
+        lats, lons = render.tile_coordinates(z, x, y)
+        spacing = render.pixel_size(z, lats)
+        level = self._render_level(z, lats)
+
+        grid_lats, grid_lons = np.meshgrid(lats, lons, indexing="ij")
+        elevations = self._sample(grid_lats.ravel(), grid_lons.ravel(), "linear", level)
+        elevations = elevations.reshape(grid_lats.shape)
+
+        image = render.colorize(elevations, render.colormap_lut(colormap), vmin, vmax)
+        if hillshade:
+            shade = render.hillshade(elevations, spacing)
+            image[..., :3] = (image[..., :3] * (0.3 + 0.7 * shade[..., None])).astype(np.uint8)
+        return render.encode_png(image)
+
     def _dev_test_read_speed(self, set_cache=True):
         '''
         Development function to test read speed of hgt files
         '''
         start = time.time()
         lat, lon = 0.44454, 12.34334
-        elevation = self.get_elevation(lat,lon)
+        elevation = asyncio.run(self.get_elevation(lat,lon))
         print(f"Height for lat {lat}, lon {lon} >> {elevation} << meter above ground")
         print("Took",(time.time()-start)*1000,"milliseconds")
 
@@ -0,0 +1,195 @@
+'''
+Downsampled overview levels of the SRTM tiles
+
+Level n keeps every 2**n-th sample of a tile after a 3x3 binomial
+low-pass filter, so a tile of 3601 samples shrinks to 1801, 901, 451
+and 226 samples at levels 1 to 4, and the tile edges stay on the
+same coordinates as in the full resolution tile. Overview tiles are
+written as hgt files, so they are read by a TilePool like the
+original tiles. The global overview is a single raster of the whole
+earth with a fixed amount of samples per degree.
+
+Layout in the overview directory:
+    level1/N50E008.hgt ... level4/N50E008.hgt
+    global.hgt
+    index.json (written last, an overview is complete if it exists)
+
+Copyright (C) Predly Technologies - All Rights Reserved
+Marvin Gabler <m.gabler@predly.com> 2021
+'''
+
+import os
+import json
+import numpy as np
+
+# data void as in SRTM documentation
+VOID = -32768
+INDEX = "index.json"
+GLOBAL = "global.hgt"
+HGT_DTYPE = np.dtype(">i2")
+
+
+def level_samples(samples, level):
+    '''
+    Returns the raster col/row size of a tile at given level
+    '''
+    return (samples - 1) // 2 ** level + 1
+
+
+def level_dir(overview_dir, level):
+    return os.path.join(overview_dir, f"level{level}")
+
+
+def decimate(data):
+    '''
+    Halves the resolution of a 2d elevation array
+
+    Every second sample is kept after a 3x3 binomial filter
+    ([1,2,1] x [1,2,1] / 16), data voids are left out of the
+    weighted mean. Samples without any data around stay void.
+
+    Args:
+        data:np.array >> 2d int16 elevation array with an odd
+                         amount of rows and cols
+
+    Returns:
+        data:np.array >> 2d int16 elevation array with
+                         (rows - 1) // 2 + 1 rows and cols
+    '''
+    data  = np.asarray(data)
+    valid = data != VOID
+    rows  = (data.shape[0] - 1) // 2 + 1
+    cols  = (data.shape[1] - 1) // 2 + 1
+
+    def smooth(a):
+        # samples 2i-1, 2i, 2i+1 of the edge padded array
+        a = np.pad(a, 1, mode="edge")
+        a = a[0:2 * rows - 1:2] + 2 * a[1:2 * rows:2] + a[2:2 * rows + 1:2]
+        return a[:, 0:2 * cols - 1:2] + 2 * a[:, 1:2 * cols:2] + a[:, 2:2 * cols + 1:2]
+
+    weights = smooth(valid.astype(np.float32))
+    values  = smooth(np.where(valid, data, 0).astype(np.float32))
+    with np.errstate(invalid="ignore", divide="ignore"):
+        return np.where(weights > 0, np.rint(values / weights), VOID).astype(np.int16)
+
+
+def box_sample(data, factor):
+    '''
+    Keeps every factor-th sample of a 2d elevation array after a
+    box filter of factor x factor samples (truncated at the edges),
+    data voids are left out of the mean
+
+    Args:
+        data:np.array >> 2d int16 elevation array, (rows - 1) and
+                         (cols - 1) divisible by factor
+        factor:int    >> odd sampling factor
+
+    Returns:
+        data:np.array >> 2d int16 elevation array
+    '''
+    data  = np.asarray(data)
+    valid = data != VOID
+    radius = factor // 2
+
+    def window_sums(a):
+        # summed area table with a leading zero row and col
+        a = np.pad(a, ((1, 0), (1, 0))).cumsum(axis=0).cumsum(axis=1)
+        rows = np.arange(0, data.shape[0], factor)
+        cols = np.arange(0, data.shape[1], factor)
+        r0, r1 = np.clip(rows - radius, 0, data.shape[0]), np.clip(rows + radius + 1, 0, data.shape[0])
+        c0, c1 = np.clip(cols - radius, 0, data.shape[1]), np.clip(cols + radius + 1, 0, data.shape[1])
+        return a[r1][:, c1] - a[r0][:, c1] - a[r1][:, c0] + a[r0][:, c0]
+
+    counts = window_sums(valid.astype(np.int64))
+    values = window_sums(np.where(valid, data, 0).astype(np.int64))
+    with np.errstate(invalid="ignore", divide="ignore"):
+        return np.where(counts > 0, np.rint(values / counts), VOID).astype(np.int16)
+
+
+def build_tile(tile, hgt_file, overview_dir, levels=4):
+    '''
+    Writes the overview levels of a single tile
+
+    Args:
+        tile:np.array      >> full resolution 2d elevation array
+        hgt_file:str       >> file name of the tile
+        overview_dir:str   >> directory of the overviews
+        levels:int         >> amount of levels
+
+    Returns:
+        data:np.array >> tile of the coarsest level
+    '''
+    name = os.path.basename(hgt_file)
+    data = np.asarray(tile)
+    for level in range(1, levels + 1):
+        data = decimate(data)
+        os.makedirs(level_dir(overview_dir, level), exist_ok=True)
+        path = os.path.join(level_dir(overview_dir, level), name)
+        data.astype(HGT_DTYPE).tofile(path + ".tmp")
+        os.replace(path + ".tmp", path)
+    return data
+
+
+def global_shape(samples_per_degree):
+    return 180 * samples_per_degree + 1, 360 * samples_per_degree + 1
+
+
+def global_block(tile, samples_per_degree):
+    '''
+    Samples a tile of any level down to the resolution of the
+    global raster, see box_sample
+
+    Args:
+        tile:np.array          >> 2d elevation array of the tile
+        samples_per_degree:int >> resolution of the global raster
+
+    Returns:
+        block:np.array >> 2d int16 elevation array with
+                          samples_per_degree + 1 rows and cols
+    '''
+    return box_sample(tile, (tile.shape[0] - 1) // samples_per_degree)
+
+
+def place_global(raster, block, lat, lon):
+    '''
+    Writes the block of a tile to its position in the global raster,
+    row 0 of the raster is at lat 90, col 0 at lon -180
+
+    Args:
+        raster:np.array >> global raster
+        block:np.array  >> block of the tile, see global_block
+        lat:int         >> latitude of the south west corner
+        lon:int         >> longitude of the south west corner
+    '''
+    samples_per_degree = block.shape[0] - 1
+    row = (89 - lat) * samples_per_degree
+    col = (lon + 180) * samples_per_degree
+    raster[row:row + block.shape[0], col:col + block.shape[1]] = block
+
+
+def write_index(overview_dir, samples, levels, samples_per_degree):
+    '''
+    Writes the index of complete overviews, last step of a build
+    '''
+    index = {
+        "levels":{str(level):level_samples(samples, level) for level in range(1, levels + 1)},
+        "global":{
+            "samples_per_degree":samples_per_degree,
+            "shape":list(global_shape(samples_per_degree))
+            } if samples_per_degree else None
+        }
+    path = os.path.join(overview_dir, INDEX)
+    with open(path + ".tmp", "w") as f:
+        json.dump(index, f)
+    os.replace(path + ".tmp", path)
+
+
+def read_index(overview_dir):
+    '''
+    Returns the index of the overviews or None if there are none
+    '''
+    try:
+        with open(os.path.join(overview_dir, INDEX)) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
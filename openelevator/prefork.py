@@ -0,0 +1,85 @@
+'''
+Pre-forking server, several worker processes accept connections
+of one listening socket
+
+Unlike the workers of uvicorn, which start fresh interpreters that
+import the app and build the tile index again each, the workers are
+forked from a process that has built the index and warmed the tiles
+already. Memory-mapped tiles and everything loaded before the fork
+is shared between the workers instead of being copied.
+
+Copyright (C) Predly Technologies - All Rights Reserved
+Marvin Gabler <m.gabler@predly.com> 2021
+'''
+
+import os
+import time
+import signal
+import uvicorn
+
+# min seconds between two restarts of a crashed worker
+RESTART_DELAY = 1
+
+
+def serve(config, workers, before_fork=None):
+    '''
+    Binds the socket, forks the workers and restarts crashed workers
+    until SIGINT or SIGTERM, which are passed on to the workers
+
+    No threads may run while forking, so before_fork must stop the
+    pools it started, see OpenElevator.prepare_workers().
+
+    Args:
+        config:uvicorn.Config >> config of the app served by every worker
+        workers:int           >> number of worker processes
+        before_fork:func      >> called once after binding the socket
+    '''
+    sock = config.bind_socket()
+    if before_fork is not None:
+        before_fork()
+
+    children = {}
+    stopping = []
+
+    def spawn():
+        pid = os.fork()
+        if pid == 0:
+            signal.signal(signal.SIGINT, signal.SIG_DFL)
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            code = 0
+            try:
+                uvicorn.Server(config).run(sockets=[sock])
+            except BaseException as e:
+                print(f"Worker {os.getpid()} failed: {e}")
+                code = 1
+            finally:
+                os._exit(code)
+        children[pid] = time.monotonic()
+
+    def stop(signum, frame):
+        stopping.append(signum)
+        for pid in children:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+    signal.signal(signal.SIGINT, stop)
+    signal.signal(signal.SIGTERM, stop)
+    for _ in range(workers):
+        spawn()
+    print(f"Started {workers} workers from process [{os.getpid()}]")
+
+    while children:
+        try:
+            pid, status = os.wait()
+        except ChildProcessError:
+            break
+        started = children.pop(pid, None)
+        if started is None or stopping:
+            continue
+        print(f"Worker [{pid}] exited with status {status}, restarting")
+        time.sleep(max(0, started + RESTART_DELAY - time.monotonic()))
+        if not stopping:
+            spawn()
+    sock.close()
@@ -0,0 +1,161 @@
+'''
+Rendering of elevation rasters to PNG map tiles
+
+Tiles follow the slippy map scheme (web mercator, z/x/y, 256x256
+pixels). Elevations are colorized with lookup tables sampled once
+from the matplotlib colormaps and encoded to PNG with zlib, so
+rendering needs neither pyplot nor its global state and is safe to
+call from multiple threads.
+
+Copyright (C) Predly Technologies - All Rights Reserved
+Marvin Gabler <m.gabler@predly.com> 2021
+'''
+
+import zlib
+import struct
+import threading
+import numpy as np
+import matplotlib
+
+from geo import EARTH_RADIUS
+
+# data void as in SRTM documentation
+VOID = -32768
+TILE_SIZE = 256
+MAX_ZOOM  = 20
+# latitude limit of web mercator
+MAX_LAT = 85.0511287798066
+
+_luts = {}
+_luts_lock = threading.Lock()
+
+
+def colormap_lut(colormap, n=256):
+    '''
+    Returns the lookup table of a matplotlib colormap, sampled
+    once and kept for all following calls
+
+    Args:
+        colormap:str >> name of a matplotlib colormap
+        n:int        >> amount of colors
+
+    Returns:
+        lut:np.array >> (n, 3) uint8 rgb colors
+    '''
+    with _luts_lock:
+        lut = _luts.get(colormap)
+        if lut is None:
+            colormaps = getattr(matplotlib, "colormaps", None)
+            cmap = colormaps[colormap] if colormaps is not None else matplotlib.cm.get_cmap(colormap)
+            lut = np.rint(cmap(np.linspace(0, 1, n))[:, :3] * 255).astype(np.uint8)
+            _luts[colormap] = lut
+    return lut
+
+
+def tile_coordinates(z, x, y, size=TILE_SIZE):
+    '''
+    Returns the coordinates of the pixel centers of a map tile
+
+    Args:
+        z:int    >> zoom level
+        x:int    >> tile col, 0 at lon -180
+        y:int    >> tile row, 0 at lat 85.05
+        size:int >> pixels per tile side
+
+    Returns:
+        lats:np.array >> latitudes of the pixel rows
+        lons:np.array >> longitudes of the pixel cols
+    '''
+    tiles = 2 ** z
+    pixels = (np.arange(size) + 0.5) / size
+    lons = (x + pixels) / tiles * 360.0 - 180.0
+    lats = np.degrees(np.arctan(np.sinh(np.pi * (1 - 2 * (y + pixels) / tiles))))
+    return lats, lons
+
+
+def pixel_size(z, lats, size=TILE_SIZE):
+    '''
+    Returns the ground size of a pixel in meters at given latitudes
+    '''
+    return 2 * np.pi * EARTH_RADIUS * np.cos(np.radians(lats)) / (size * 2 ** z)
+
+
+def colorize(elevations, lut, vmin, vmax):
+    '''
+    Maps elevations to colors of a lookup table, data voids
+    are transparent
+
+    Args:
+        elevations:np.array >> 2d elevations
+        lut:np.array        >> (n, 3) uint8 rgb colors
+        vmin:float          >> elevation of the first color
+        vmax:float          >> elevation of the last color
+
+    Returns:
+        image:np.array >> (rows, cols, 4) uint8 rgba image
+    '''
+    scaled = (np.asarray(elevations, dtype=np.float64) - vmin) / (vmax - vmin)
+    index  = np.clip((scaled * (len(lut) - 1)).astype(np.intp), 0, len(lut) - 1)
+    image  = np.empty(elevations.shape + (4,), dtype=np.uint8)
+    image[..., :3] = lut[index]
+    image[..., 3]  = np.where(elevations == VOID, 0, 255)
+    return image
+
+
+def hillshade(elevations, spacing, azimuth=315, altitude=45):
+    '''
+    Lambertian hillshade of an elevation grid
+
+    Args:
+        elevations:np.array >> 2d elevations, row 0 in the north
+        spacing:np.array    >> pixel size in meters per row
+        azimuth:float       >> direction of the light in degrees
+                               clockwise from north
+        altitude:float      >> height of the light in degrees
+
+    Returns:
+        shade:np.array >> 2d brightness between 0 and 1
+    '''
+    z = np.where(elevations == VOID, 0, elevations).astype(np.float64)
+    spacing = np.asarray(spacing, dtype=np.float64)[:, None]
+    dz_north = -np.gradient(z, axis=0) / spacing
+    dz_east  = np.gradient(z, axis=1) / spacing
+    slope  = np.arctan(np.hypot(dz_north, dz_east))
+    aspect = np.arctan2(-dz_east, -dz_north)
+    azimuth, altitude = np.radians(azimuth), np.radians(altitude)
+    shade = np.sin(altitude) * np.cos(slope) \
+        + np.cos(altitude) * np.sin(slope) * np.cos(azimuth - aspect)
+    return np.clip(shade, 0, 1)
+
+
+def encode_png(image, level=6):
+    '''
+    Encodes an rgba image to PNG
+
+    Rows are written with the Sub filter, which stores differences
+    to the pixel on the left and compresses smooth terrain well.
+
+    Args:
+        image:np.array >> (rows, cols, 4) uint8 rgba image
+        level:int      >> zlib compression level
+
+    Returns:
+        png:bytes >> PNG file
+    '''
+    rows, cols = image.shape[:2]
+    filtered = image.copy()
+    filtered[:, 1:] -= image[:, :-1]
+    raw = np.empty((rows, cols * 4 + 1), dtype=np.uint8)
+    raw[:, 0]  = 1 # filter type Sub
+    raw[:, 1:] = filtered.reshape(rows, cols * 4)
+
+    def chunk(kind, data):
+        return struct.pack(">I", len(data)) + kind + data \
+            + struct.pack(">I", zlib.crc32(kind + data) & 0xffffffff)
+
+    return b"".join([
+        b"\x89PNG\r\n\x1a\n",
+        chunk(b"IHDR", struct.pack(">IIBBBBB", cols, rows, 8, 6, 0, 0, 0)),
+        chunk(b"IDAT", zlib.compress(raw.tobytes(), level)),
+        chunk(b"IEND", b"")
+        ])
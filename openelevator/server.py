@@ -3,6 +3,9 @@ Copyright (C) Predly Technologies - All Rights Reserved
 Marvin Gabler <m.gabler@predly.com> 2021
 '''
 
+import shutil
+import asyncio
+import tempfile
 import aioredis
 import uvicorn
 from os import environ
@@ -11,14 +14,18 @@ from sys import argv
 from starlette.responses import RedirectResponse
 
 from fastapi import FastAPI
+from fastapi.responses import JSONResponse, PlainTextResponse
 from fastapi.staticfiles import StaticFiles
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.middleware.gzip import GZipMiddleware
-from fastapi_cache import FastAPICache
-from fastapi_cache.backends.redis import RedisBackend
 from fastapi_limiter import FastAPILimiter
 
 from api.routes import elevation
+from api.util import server_host, server_port, ssl_key, ssl_cert, workers
+from api.util import metrics_active, slow_request_ms, rate_limit_mode, rate_sync_interval
+from api.ratelimit import LocalLimiter
+from metrics import REGISTRY, MetricsMiddleware, SlowRequestProfiler, MultiProcessRegistry, register_cache_metrics
+import prefork
 from os import environ
 
 
@@ -28,6 +35,9 @@ if len(argv) > 1:
     if argv[1] == "--standalone":
         dev = True
 
+# metrics of all workers, set before forking them, see __main__
+multiprocess_metrics = None
+
 # init app
 app = FastAPI(
     title="Open Elevator API",
@@ -42,9 +52,14 @@ app.add_middleware(GZipMiddleware, minimum_size=1000)
 @app.on_event("startup")
 async def startup():
     '''
-    Initializes redis for caching of API requests
-    and rate limiting
+    Initializes redis for rate limiting, elevation
+    results are cached by the OpenElevator class.
+    The most accessed tiles are warmed in background,
+    see /ready
     '''
+    app.state.prewarm = asyncio.create_task(elevation.elevator.prewarm())
+    if multiprocess_metrics is not None:
+        multiprocess_metrics.start()
 
     if dev:
         redis = await aioredis.from_url(
@@ -58,11 +73,23 @@ async def startup():
             encoding="iso-8859-1", 
             decode_responses=True
             )
-    FastAPICache.init(
-        RedisBackend(redis), 
-        prefix="fastapi-cache"
-        )
     await FastAPILimiter.init(redis)
+    if rate_limit_mode == "local":
+        await LocalLimiter.init(redis, interval=rate_sync_interval)
+
+@app.on_event("shutdown")
+async def shutdown():
+    '''
+    Sends pending rate limit counts, stops the thread and
+    process pools of the elevator and persists its tile
+    access counts
+    '''
+    await LocalLimiter.close()
+    if multiprocess_metrics is not None:
+        multiprocess_metrics.stop()
+    elevation.elevator.executor.shutdown()
+    if elevation.elevator.heatmap is not None:
+        elevation.elevator.heatmap.save()
 
 # index entrypoint
 app.mount("/elevation/docs/", StaticFiles(directory="../site", html = True), name="docs")
@@ -74,6 +101,31 @@ async def index():
     resp = RedirectResponse(url='/elevation/docs/')
     return resp
 
+@app.get("/ready")
+async def ready():
+    ''' Readiness for load balancers, 503 until the
+    most accessed tiles are warmed
+    '''
+    readiness = elevation.elevator.readiness()
+    return JSONResponse(readiness, status_code=200 if readiness["ready"] else 503)
+
+if metrics_active:
+    register_cache_metrics(elevation.elevator.cache_stats)
+
+    @app.get("/metrics", include_in_schema=False)
+    async def metrics():
+        ''' Request, stage and cache metrics in the
+        Prometheus text format, of all workers
+        '''
+        if multiprocess_metrics is not None:
+            content = multiprocess_metrics.render()
+        else:
+            content = REGISTRY.render()
+        return PlainTextResponse(
+            content,
+            media_type="text/plain; version=0.0.4"
+            )
+
 # mount routes
 app.include_router(
     elevation.router,
@@ -91,10 +143,17 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+# outermost, so timings include all other middlewares
+if metrics_active:
+    app.add_middleware(
+        MetricsMiddleware,
+        profiler=SlowRequestProfiler(threshold_ms=slow_request_ms) if slow_request_ms else None
+        )
+
 if __name__ == "__main__":
 
     if dev:
-        uvicorn.run(
+        config = uvicorn.Config(
             app, 
             host=server_host, 
             port=server_port,
@@ -103,11 +162,26 @@ if __name__ == "__main__":
             log_config="log_config.yaml"
         )    
     else:
-        uvicorn.run(
+        config = uvicorn.Config(
             app, 
             host=environ["host"], 
             port=443,
             ssl_keyfile=environ["certkey"],
             ssl_certfile=environ["cert"],
             log_config="log_config.yaml"
-        )
\ No newline at end of file
+        )
+
+    if workers > 1:
+        if metrics_active:
+            multiprocess_metrics = MultiProcessRegistry(tempfile.mkdtemp(prefix="openelevator-metrics-"))
+        try:
+            prefork.serve(
+                config,
+                workers,
+                before_fork=lambda: elevation.elevator.prepare_workers(workers)
+                )
+        finally:
+            if multiprocess_metrics is not None:
+                shutil.rmtree(multiprocess_metrics.directory, ignore_errors=True)
+    else:
+        uvicorn.Server(config).run()
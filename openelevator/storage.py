@@ -0,0 +1,444 @@
+'''
+Optimized on-disk layouts for the elevation dataset
+
+Copyright (C) Predly Technologies - All Rights Reserved
+Marvin Gabler <m.gabler@predly.com> 2021
+'''
+
+import os
+import json
+import lzma
+import zlib
+import struct
+import threading
+import numpy as np
+from tqdm import tqdm
+
+from tiles import TileCache
+
+
+class PackedStore():
+    INDEX = "index.json"
+    ALIGNMENT = 4096 # tiles start at page boundaries within a shard
+
+    def __init__(self, packed_dir):
+        '''
+        Read access to tiles packed by PackedStore.pack()
+
+        The packed layout stores tiles as native endian int16 arrays,
+        concatenated into a few large shard files. An index maps every
+        tile name to its shard and byte offset. Every shard is memory-
+        mapped once and tiles are served as zero-copy views into it,
+        so neither a byteswap nor a file open is needed per tile.
+
+        Args:
+            packed_dir:str >> directory containing shards and index.json
+        '''
+        self.packed_dir = packed_dir
+        with open(os.path.join(packed_dir, self.INDEX)) as f:
+            index = json.load(f)
+        self.samples = index["samples"]
+        self.dtype   = np.dtype(index["dtype"])
+        self.shards  = index["shards"]
+        self.offsets = {name:tuple(location) for name, location in index["tiles"].items()}
+        self._maps   = {}
+        self._lock   = threading.Lock()
+
+    @classmethod
+    def exists(cls, packed_dir):
+        return os.path.isfile(os.path.join(packed_dir, cls.INDEX))
+
+    def __contains__(self, hgt_file):
+        return os.path.basename(hgt_file) in self.offsets
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def names(self):
+        return list(self.offsets)
+
+    def __getstate__(self):
+        # open handles and locks are not passed to worker processes
+        state = self.__dict__.copy()
+        state["_maps"] = {}
+        del state["_lock"]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+    def _shard(self, shard):
+        with self._lock:
+            shard_map = self._maps.get(shard)
+            if shard_map is None:
+                shard_map = np.memmap(
+                    os.path.join(self.packed_dir, self.shards[shard]),
+                    dtype=np.uint8,
+                    mode="r"
+                    )
+                self._maps[shard] = shard_map
+            return shard_map
+
+    def get(self, hgt_file):
+        '''
+        Returns tile as view into its memory-mapped shard
+
+        Args:
+            hgt_file:str >> file name or full path of hgt file
+
+        Returns:
+            tile:np.array >> read-only 2d int16 array
+                             with samples x samples values
+        '''
+        shard, offset = self.offsets[os.path.basename(hgt_file)]
+        size = self.samples * self.samples * self.dtype.itemsize
+        return self._shard(shard)[offset:offset + size] \
+            .view(self.dtype) \
+            .reshape((self.samples, self.samples))
+
+    @classmethod
+    def pack(cls, hgt_files, packed_dir, samples=3601, tiles_per_shard=64):
+        '''
+        Converts hgt files to the packed layout
+
+        Tiles are byteswapped to native endian int16 and appended to
+        shard files of tiles_per_shard tiles each. The index is written
+        last, so an interrupted run never leaves a readable but
+        incomplete layout behind.
+
+        Args:
+            hgt_files:list      >> full paths of hgt files to pack
+            packed_dir:str      >> output directory
+            samples:int         >> raster col/row size of a tile
+            tiles_per_shard:int >> tiles per shard file, 1 writes
+                                   one file per tile
+
+        Returns:
+            index:dict >> the written index
+        '''
+        os.makedirs(packed_dir, exist_ok=True)
+        dtype = np.dtype(np.int16).newbyteorder("=")
+        hgt_files = sorted(hgt_files)
+        index = {
+            "samples":samples,
+            "dtype":dtype.str,
+            "shards":[],
+            "tiles":{}
+            }
+
+        shard_file = None
+        for i, hgt_file in enumerate(tqdm(hgt_files)):
+            if i % tiles_per_shard == 0:
+                if shard_file:
+                    shard_file.close()
+                shard_name = "shard_%05d.bin" % len(index["shards"])
+                index["shards"].append(shard_name)
+                shard_file = open(os.path.join(packed_dir, shard_name), "wb")
+
+            elevations = np.fromfile(hgt_file, np.dtype(">i2"), samples * samples)
+            offset = shard_file.tell()
+            shard_file.write(elevations.astype(dtype).tobytes())
+            # pad to the next page boundary
+            shard_file.write(b"\0" * (-shard_file.tell() % cls.ALIGNMENT))
+            index["tiles"][os.path.basename(hgt_file)] = [len(index["shards"]) - 1, offset]
+        if shard_file:
+            shard_file.close()
+
+        index_path = os.path.join(packed_dir, cls.INDEX)
+        with open(index_path + ".tmp", "w") as f:
+            json.dump(index, f)
+        os.replace(index_path + ".tmp", index_path)
+        return index
+
+
+class ChunkedStore():
+    MAGIC     = b"OEZ1"
+    EXTENSION = ".hgtz"
+    CODECS    = ["zlib", "lzma"]
+    # magic, samples, chunk size, codec, delta filter, amount of chunks
+    HEADER    = struct.Struct("<4sIIBBI")
+    CHUNK_INDEX = np.dtype([("offset", "<u8"), ("length", "<u4")])
+
+    def __init__(self, chunked_dir, cache_mb=256):
+        '''
+        Read access to tiles compressed by ChunkedStore.compress()
+
+        Every tile is stored as independently compressed square chunks
+        with an index of their byte ranges in the file header. Lookups
+        only decompress the chunks they touch, decompressed chunks are
+        kept in a least-recently-used cache.
+
+        Args:
+            chunked_dir:str >> directory containing the .hgtz files
+            cache_mb:float  >> memory budget of the chunk cache in megabyte
+        '''
+        self.chunked_dir = chunked_dir
+        self.cache    = TileCache(max_mb=cache_mb)
+        self._names   = set(
+            i[:-len(self.EXTENSION)] + ".hgt" for i in os.listdir(chunked_dir)
+            if i.endswith(self.EXTENSION)
+            )
+        self._headers = {}
+        self._lock    = threading.Lock()
+
+    @classmethod
+    def exists(cls, chunked_dir):
+        return os.path.isdir(chunked_dir) and \
+            any(i.endswith(cls.EXTENSION) for i in os.listdir(chunked_dir))
+
+    def __contains__(self, hgt_file):
+        return os.path.basename(hgt_file) in self._names
+
+    def __len__(self):
+        return len(self._names)
+
+    def names(self):
+        return list(self._names)
+
+    def __getstate__(self):
+        # open handles and locks are not passed to worker processes
+        state = self.__dict__.copy()
+        state["_headers"] = {}
+        del state["_lock"]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+    def _path(self, name):
+        return os.path.join(self.chunked_dir, name[:-len(".hgt")] + self.EXTENSION)
+
+    def header(self, hgt_file):
+        '''
+        Returns header and chunk index of given tile, read once
+
+        Returns:
+            header:dict >> samples, chunk_size, codec, delta, chunks,
+                           index (structured array of offset, length)
+        '''
+        name = os.path.basename(hgt_file)
+        header = self._headers.get(name)
+        if header is None:
+            with open(self._path(name), "rb") as f:
+                magic, samples, chunk_size, codec, delta, chunks = \
+                    self.HEADER.unpack(f.read(self.HEADER.size))
+                if magic != self.MAGIC:
+                    raise ValueError(f"{self._path(name)} is not a chunked tile")
+                index = np.frombuffer(
+                    f.read(chunks * self.CHUNK_INDEX.itemsize),
+                    dtype=self.CHUNK_INDEX
+                    )
+            header = {
+                "samples":samples,
+                "chunk_size":chunk_size,
+                "codec":self.CODECS[codec],
+                "delta":bool(delta),
+                "chunks":-(-samples // chunk_size), # per row/col
+                "index":index
+                }
+            with self._lock:
+                self._headers[name] = header
+        return header
+
+    def read_chunk(self, hgt_file, chunk_row, chunk_col):
+        '''
+        Returns decompressed chunk of given tile, served from the
+        chunk cache if available
+
+        Args:
+            hgt_file:str  >> file name of hgt file
+            chunk_row:int >> row of the chunk within the tile
+            chunk_col:int >> col of the chunk within the tile
+
+        Returns:
+            chunk:np.array >> 2d int16 array of up to chunk_size x chunk_size
+        '''
+        name = os.path.basename(hgt_file)
+        key  = (name, chunk_row, chunk_col)
+        chunk = self.cache.get(key)
+        if chunk is None:
+            header = self.header(name)
+            size = header["chunk_size"]
+            offset, length = header["index"][chunk_row * header["chunks"] + chunk_col]
+            with open(self._path(name), "rb") as f:
+                f.seek(int(offset))
+                data = f.read(int(length))
+            if header["codec"] == "lzma":
+                data = lzma.decompress(data)
+            else:
+                data = zlib.decompress(data)
+            shape = (
+                min(size, header["samples"] - chunk_row * size),
+                min(size, header["samples"] - chunk_col * size)
+                )
+            chunk = np.frombuffer(data, dtype="<i2").reshape(shape)
+            if header["delta"]:
+                # differences wrap around in int16, so does the sum
+                chunk = np.cumsum(chunk, axis=1, dtype=np.int16)
+            else:
+                chunk = chunk.astype(np.int16)
+            self.cache.put(key, chunk)
+        return chunk
+
+    def get(self, hgt_file):
+        '''
+        Returns tile as array-like, decompressing chunks on access
+
+        Args:
+            hgt_file:str >> file name or full path of hgt file
+
+        Returns:
+            tile:ChunkedTile >> 2d int16 array-like with samples x
+                                samples values
+        '''
+        return ChunkedTile(self, os.path.basename(hgt_file))
+
+    @classmethod
+    def compress(cls, hgt_file, chunked_dir, samples=3601, chunk_size=256,
+                 codec="zlib", level=6, delta=True):
+        '''
+        Compresses a single hgt file to the chunked layout
+
+        Most of the dataset are ocean voids and flat terrain, with the
+        delta filter every chunk row is stored as differences between
+        neighbouring cells, which compress to almost nothing there.
+
+        Args:
+            hgt_file:str    >> full path of hgt file
+            chunked_dir:str >> output directory
+            samples:int     >> raster col/row size of the tile
+            chunk_size:int  >> col/row size of the chunks
+            codec:str       >> compression codec in self.CODECS
+                               ["zlib","lzma"]
+            level:int       >> compression level of the codec
+            delta:bool      >> apply the delta filter before compressing
+
+        Returns:
+            ratio:float >> compressed size / raw size
+        '''
+        elevations = np.fromfile(hgt_file, np.dtype(">i2"), samples * samples) \
+            .reshape((samples, samples)).astype("<i2")
+        chunks = -(-samples // chunk_size)
+        blobs  = []
+        for chunk_row in range(chunks):
+            for chunk_col in range(chunks):
+                chunk = elevations[
+                    chunk_row * chunk_size:(chunk_row + 1) * chunk_size,
+                    chunk_col * chunk_size:(chunk_col + 1) * chunk_size
+                    ]
+                if delta:
+                    chunk = np.diff(chunk, axis=1, prepend=np.int16(0)).astype("<i2")
+                data = np.ascontiguousarray(chunk).tobytes()
+                if codec == "lzma":
+                    blobs.append(lzma.compress(data, preset=level))
+                else:
+                    blobs.append(zlib.compress(data, level))
+
+        index = np.zeros(len(blobs), dtype=cls.CHUNK_INDEX)
+        index["length"] = [len(i) for i in blobs]
+        start = cls.HEADER.size + index.nbytes
+        index["offset"] = start + np.concatenate([[0], np.cumsum(index["length"])[:-1]])
+
+        os.makedirs(chunked_dir, exist_ok=True)
+        name = os.path.basename(hgt_file)
+        path = os.path.join(chunked_dir, name[:-len(".hgt")] + cls.EXTENSION)
+        with open(path + ".tmp", "wb") as f:
+            f.write(cls.HEADER.pack(
+                cls.MAGIC, samples, chunk_size,
+                cls.CODECS.index(codec), int(delta), len(blobs)
+                ))
+            f.write(index.tobytes())
+            for blob in blobs:
+                f.write(blob)
+        os.replace(path + ".tmp", path)
+        return os.path.getsize(path) / elevations.nbytes
+
+
+class ChunkedTile():
+    def __init__(self, store, name):
+        '''
+        Array-like view of a tile of a ChunkedStore
+
+        Supports integer (fancy) indexing and slicing along both axes,
+        only the chunks covering the requested cells are decompressed.
+
+        Args:
+            store:ChunkedStore >> store holding the tile
+            name:str           >> file name of the hgt file
+        '''
+        self.store = store
+        self.name  = name
+        header = store.header(name)
+        self.samples    = header["samples"]
+        self.chunk_size = header["chunk_size"]
+        self.shape = (self.samples, self.samples)
+        self.dtype = np.dtype(np.int16)
+        self.ndim  = 2
+
+    @property
+    def nbytes(self):
+        return self.samples * self.samples * self.dtype.itemsize
+
+    def __array__(self, dtype=None, copy=None):
+        data = self[:, :]
+        return data if dtype is None else data.astype(dtype)
+
+    def astype(self, dtype):
+        return np.asarray(self, dtype=dtype)
+
+    def _window(self, row_start, row_stop, col_start, col_stop):
+        '''
+        Assembles rows/cols [start, stop) from the covering chunks
+        '''
+        size = self.chunk_size
+        window = np.empty((row_stop - row_start, col_stop - col_start), dtype=np.int16)
+        for chunk_row in range(row_start // size, (row_stop - 1) // size + 1):
+            for chunk_col in range(col_start // size, (col_stop - 1) // size + 1):
+                chunk = self.store.read_chunk(self.name, chunk_row, chunk_col)
+                r0 = max(row_start, chunk_row * size)
+                r1 = min(row_stop, chunk_row * size + chunk.shape[0])
+                c0 = max(col_start, chunk_col * size)
+                c1 = min(col_stop, chunk_col * size + chunk.shape[1])
+                window[r0 - row_start:r1 - row_start, c0 - col_start:c1 - col_start] = \
+                    chunk[r0 - chunk_row * size:r1 - chunk_row * size,
+                          c0 - chunk_col * size:c1 - chunk_col * size]
+        return window
+
+    def __getitem__(self, key):
+        rows, cols = key
+        if isinstance(rows, slice) and isinstance(cols, slice):
+            row_range = range(*rows.indices(self.samples))
+            col_range = range(*cols.indices(self.samples))
+            if row_range.step < 0 or col_range.step < 0:
+                return np.asarray(self)[rows, cols]
+            if len(row_range) == 0 or len(col_range) == 0:
+                return np.empty((len(row_range), len(col_range)), dtype=np.int16)
+            window = self._window(
+                row_range.start, row_range[-1] + 1,
+                col_range.start, col_range[-1] + 1
+                )
+            return window[::row_range.step, ::col_range.step]
+
+        if isinstance(rows, slice):
+            rows = np.arange(self.samples)[rows][:, None]
+        if isinstance(cols, slice):
+            cols = np.arange(self.samples)[cols][None, :]
+        rows, cols = np.broadcast_arrays(
+            np.asarray(rows) % self.samples,
+            np.asarray(cols) % self.samples
+            )
+        size   = self.chunk_size
+        chunks = -(-self.samples // size)
+        chunk_ids = (rows // size) * chunks + cols // size
+        result = np.empty(rows.shape, dtype=np.int16)
+        for chunk_id in np.unique(chunk_ids):
+            chunk_row, chunk_col = divmod(int(chunk_id), chunks)
+            chunk = self.store.read_chunk(self.name, chunk_row, chunk_col)
+            members = chunk_ids == chunk_id
+            result[members] = chunk[
+                rows[members] - chunk_row * size,
+                cols[members] - chunk_col * size
+                ]
+        return result[()]
@@ -0,0 +1,120 @@
+'''
+Terrain statistics over gridded elevation data
+
+Statistics are accumulated in fixed-size histograms, so areas of
+any size are processed window by window with bounded memory and
+the exact min, max, mean and percentiles of the int16 elevations
+are known at the end.
+
+Copyright (C) Predly Technologies - All Rights Reserved
+Marvin Gabler <m.gabler@predly.com> 2021
+'''
+
+import numpy as np
+
+from geo import EARTH_RADIUS
+
+# data void as in SRTM documentation
+VOID = -32768
+# compass sectors of the aspect, clockwise from north
+ASPECTS = ["N", "NE", "E", "SE", "S", "SW", "W", "NW"]
+
+
+class Histogram():
+    def __init__(self, bins=65536, offset=32768, scale=1):
+        '''
+        Streaming histogram of values on a fixed grid
+
+        Values v are counted in bin rint(v * scale) + offset, so int16
+        elevations are exact with the defaults.
+
+        Args:
+            bins:int     >> amount of bins
+            offset:int   >> bin of value 0
+            scale:float  >> bins per unit of the values
+        '''
+        self.bins   = bins
+        self.offset = offset
+        self.scale  = scale
+        self.counts = np.zeros(bins, dtype=np.int64)
+        self.total  = 0.0
+
+    def add(self, values):
+        '''
+        Counts values, values outside of the bins are clipped
+        '''
+        values = np.ravel(values)
+        if values.size == 0:
+            return
+        index = np.clip(np.rint(values * self.scale).astype(np.int64) + self.offset, 0, self.bins - 1)
+        self.counts += np.bincount(index, minlength=self.bins)
+        self.total  += float(np.sum(values, dtype=np.float64))
+
+    def stats(self, percentiles=(5, 25, 50, 75, 95)):
+        '''
+        Returns statistics of all counted values
+
+        Args:
+            percentiles:tuple >> percentiles to compute, nearest rank
+
+        Returns:
+            stats:dict >> count, min, max, mean and percentiles,
+                          values are None if nothing was counted
+        '''
+        count = int(self.counts.sum())
+        if count == 0:
+            return {
+                "count":0, "min":None, "max":None, "mean":None,
+                "percentiles":{f"{p:g}":None for p in percentiles}
+                }
+        filled = np.nonzero(self.counts)[0]
+        cumulative = np.cumsum(self.counts)
+        value = lambda index: float((index - self.offset) / self.scale)
+        ranks = np.maximum(np.ceil(np.asarray(percentiles, dtype=np.float64) / 100 * count), 1)
+        return {
+            "count":count,
+            "min":value(filled[0]),
+            "max":value(filled[-1]),
+            "mean":self.total / count,
+            "percentiles":{
+                f"{p:g}":value(i) for p, i in zip(percentiles, np.searchsorted(cumulative, ranks))
+                }
+            }
+
+
+def slope_aspect(data, lats, resolution):
+    '''
+    Slope and aspect of a window of the raster, vectorized
+
+    Gradients are central differences (np.gradient) in meters, the
+    spacing of the cols shrinks with the cosine of the latitude.
+    Cells next to a data void have no slope.
+
+    Args:
+        data:np.array  >> 2d elevation window, row 0 in the north
+        lats:np.array  >> latitudes of the window rows
+        resolution:float >> grid spacing in degrees
+
+    Returns:
+        slope:np.array  >> slope in degrees
+        aspect:np.array >> downhill direction in degrees clockwise
+                           from north
+        valid:np.array  >> bool, False where the slope is unknown
+    '''
+    void = data == VOID
+    z  = data.astype(np.float32)
+    dy = np.radians(resolution) * EARTH_RADIUS
+    dx = dy * np.cos(np.radians(np.asarray(lats, dtype=np.float64)))[:, None]
+
+    # rows count southwards
+    dz_north = -np.gradient(z, axis=0) / dy if z.shape[0] > 1 else np.zeros_like(z)
+    dz_east  = np.gradient(z, axis=1) / dx if z.shape[1] > 1 else np.zeros_like(z)
+    slope  = np.degrees(np.arctan(np.hypot(dz_north, dz_east)))
+    aspect = np.degrees(np.arctan2(-dz_east, -dz_north)) % 360
+
+    invalid = void.copy()
+    invalid[1:]     |= void[:-1]
+    invalid[:-1]    |= void[1:]
+    invalid[:, 1:]  |= void[:, :-1]
+    invalid[:, :-1] |= void[:, 1:]
+    return slope, aspect, ~invalid
@@ -0,0 +1,708 @@
+'''
+Tile access layer for SRTM hgt DEM files
+
+Copyright (C) Predly Technologies - All Rights Reserved
+Marvin Gabler <m.gabler@predly.com> 2021
+'''
+
+import os
+import json
+import time
+import fcntl
+import threading
+import numpy as np
+from collections import OrderedDict
+
+
+class TilePool():
+    def __init__(self, data_dir, samples=3601, max_open=256):
+        '''
+        Bounded pool of memory-mapped hgt tiles
+
+        Instead of reading a whole tile (~26 MB) for every lookup,
+        tiles are opened once as read-only np.memmap and kept in a
+        least-recently-used pool keyed by tile name. Indexing into
+        a memory-map only pages in the parts of the file that are
+        actually touched, so a point query reads a few kilobytes.
+
+        Args:
+            data_dir:str >> directory containing the hgt files
+            samples:int  >> raster col/row size of a tile
+            max_open:int >> max amount of tiles kept open at once
+        '''
+        self.data_dir = data_dir
+        self.samples  = samples
+        self.max_open = max_open
+        # optimized tile stores of storage.py, tried in order
+        # before falling back to hgt files
+        self.stores   = []
+        self._handles = OrderedDict()
+        self._lock    = threading.Lock()
+
+    def __len__(self):
+        return len(self._handles)
+
+    def __contains__(self, hgt_file):
+        return os.path.basename(hgt_file) in self._handles
+
+    def __getstate__(self):
+        # open handles and locks are not passed to worker processes
+        state = self.__dict__.copy()
+        state["_handles"] = OrderedDict()
+        del state["_lock"]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+    def get(self, hgt_file):
+        '''
+        Returns the memory-mapped tile for given hgt file
+
+        Args:
+            hgt_file:str >> file name or full path of hgt file
+
+        Returns:
+            tile:np.memmap >> read-only 2d int16 array with samples x
+                              samples values, big endian for hgt files,
+                              native endian or array-like for tiles of
+                              self.stores
+        '''
+        name = os.path.basename(hgt_file)
+        with self._lock:
+            tile = self._handles.get(name)
+            if tile is not None:
+                self._handles.move_to_end(name)
+                return tile
+
+        store = next((i for i in self.stores if name in i), None)
+        if store is not None:
+            tile = store.get(name)
+        else:
+            tile = np.memmap(
+                os.path.join(self.data_dir, hgt_file),
+                dtype=np.dtype('>i2'),
+                mode="r",
+                shape=(self.samples, self.samples)
+                )
+
+        with self._lock:
+            # another thread might have opened the tile meanwhile
+            if name in self._handles:
+                self._handles.move_to_end(name)
+                return self._handles[name]
+            self._handles[name] = tile
+            while len(self._handles) > self.max_open:
+                # dropping the last reference unmaps the file
+                self._handles.popitem(last=False)
+        return tile
+
+    def close(self, hgt_file=None):
+        '''
+        Drops given tile or all tiles from the pool
+
+        Args:
+            hgt_file:str >> file name of tile to drop, None drops all
+        '''
+        with self._lock:
+            if hgt_file is None:
+                self._handles.clear()
+            else:
+                self._handles.pop(os.path.basename(hgt_file), None)
+
+
+class TileCache():
+    def __init__(self, max_mb=1024):
+        '''
+        In-process least-recently-used cache for decoded tile arrays
+
+        Entries are kept until their summed size exceeds the
+        memory budget, then the least recently used entries are
+        evicted. Hit, miss and eviction counters are kept for
+        monitoring, see self.stats().
+
+        Args:
+            max_mb:float >> memory budget in megabyte, 0 disables
+                            the cache
+        '''
+        self.max_bytes = int(max_mb * 1024 * 1024)
+        self.hits      = 0
+        self.misses    = 0
+        self.evictions = 0
+        self.resident_bytes = 0
+        self._entries = OrderedDict()
+        self._lock    = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    def __getstate__(self):
+        # open handles and locks are not passed to worker processes
+        state = self.__dict__.copy()
+        state["_entries"] = OrderedDict()
+        state["resident_bytes"] = 0
+        del state["_lock"]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        '''
+        Returns cached array for given key or None
+
+        Args:
+            key:str >> cache key, usually the tile name
+
+        Returns:
+            array:np.array >> cached array
+                OR
+            None
+        '''
+        with self._lock:
+            array = self._entries.get(key)
+            if array is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return array
+
+    def put(self, key, array):
+        '''
+        Adds array to the cache and evicts least recently used
+        entries until the memory budget is met. Arrays larger than
+        the whole budget are not cached.
+
+        Args:
+            key:str        >> cache key, usually the tile name
+            array:np.array >> array to cache
+        '''
+        if array.nbytes > self.max_bytes:
+            return
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self.resident_bytes -= old.nbytes
+            self._entries[key] = array
+            self.resident_bytes += array.nbytes
+            while self.resident_bytes > self.max_bytes:
+                _, evicted = self._entries.popitem(last=False)
+                self.resident_bytes -= evicted.nbytes
+                self.evictions += 1
+
+    def get_or_load(self, key, loader):
+        '''
+        Returns cached array for given key, calls loader() and
+        caches its result on a miss
+
+        Args:
+            key:str          >> cache key, usually the tile name
+            loader:callable  >> function without arguments returning
+                                the array to cache
+
+        Returns:
+            array:np.array >> cached or freshly loaded array
+        '''
+        array = self.get(key)
+        if array is None:
+            array = loader()
+            self.put(key, array)
+        return array
+
+    def remove(self, key):
+        '''
+        Removes the entry of given key if it is cached
+        '''
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self.resident_bytes -= old.nbytes
+
+    def clear(self):
+        '''
+        Removes all entries, counters are kept
+        '''
+        with self._lock:
+            self._entries.clear()
+            self.resident_bytes = 0
+
+    def stats(self):
+        '''
+        Returns cache counters
+
+        Returns:
+            stats:dict >> hits, misses, evictions, hit_ratio,
+                          entries, resident_bytes and max_bytes
+        '''
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "hits":self.hits,
+                "misses":self.misses,
+                "evictions":self.evictions,
+                "hit_ratio":self.hits / lookups if lookups else 0.0,
+                "entries":len(self._entries),
+                "resident_bytes":self.resident_bytes,
+                "max_bytes":self.max_bytes
+                }
+
+
+class HaloTile():
+    def __init__(self, core, halo=2):
+        '''
+        Tile array padded with a border copied from its neighbours
+
+        Adjacent hgt tiles share their outermost row/col, so the
+        border of `halo` cells is taken from the second outermost
+        rows/cols of the 8 neighbouring tiles. Until build_halo()
+        is called, the border replicates the tile edges.
+
+        Args:
+            core:np.array >> 2d tile array with samples x samples values
+            halo:int      >> width of the border in cells
+        '''
+        self.halo = halo
+        self.samples = core.shape[0]
+        self.data = np.pad(np.asarray(core, dtype=np.int16), halo, mode="edge")
+        self.halo_built = False
+
+    @property
+    def nbytes(self):
+        return self.data.nbytes
+
+    @property
+    def core(self):
+        '''
+        Returns the tile without border as view
+        '''
+        h = self.halo
+        return self.data[h:-h, h:-h]
+
+    def build_halo(self, neighbour):
+        '''
+        Copies the border cells from the neighbouring tiles, missing
+        neighbours keep the replicated tile edges
+
+        Args:
+            neighbour:callable >> function taking lat, lon offsets
+                                  (-1, 0, 1) of a neighbour, returns
+                                  its 2d array or None if absent
+        '''
+        h, n = self.halo, self.samples
+        # slices into the neighbour tile and into self.data
+        # by lat/lon offset, north is row 0
+        source_rows = {1:slice(n - 1 - h, n - 1), 0:slice(0, n), -1:slice(1, h + 1)}
+        target_rows = {1:slice(0, h), 0:slice(h, h + n), -1:slice(h + n, None)}
+        source_cols = {-1:slice(n - 1 - h, n - 1), 0:slice(0, n), 1:slice(1, h + 1)}
+        target_cols = {-1:slice(0, h), 0:slice(h, h + n), 1:slice(h + n, None)}
+
+        for dlat in (1, 0, -1):
+            for dlon in (-1, 0, 1):
+                if dlat == 0 and dlon == 0:
+                    continue
+                tile = neighbour(dlat, dlon)
+                if tile is not None:
+                    self.data[target_rows[dlat], target_cols[dlon]] = \
+                        tile[source_rows[dlat], source_cols[dlon]]
+        self.halo_built = True
+
+
+def halo_window(core, neighbour, rows, cols, halo=2):
+    '''
+    Returns cells of a tile padded like HaloTile.build_halo() without
+    padding the whole tile, so small windows at the tile edges can be
+    read from memory-mapped tiles directly
+
+    Args:
+        core:np.array      >> 2d tile array with samples x samples values
+        neighbour:callable >> see HaloTile.build_halo()
+        rows:np.array      >> ascending row indices on the padded tile,
+                              0 is the northernmost border row
+        cols:np.array      >> ascending col indices on the padded tile,
+                              0 is the westernmost border col
+        halo:int           >> width of the border in cells
+
+    Returns:
+        window:np.array >> int16 array of len(rows) x len(cols) cells
+    '''
+    n = core.shape[0]
+
+    def split(index, before, after):
+        # offset of the tile the cells are taken from, their index on
+        # it and the replicated edge used without that tile
+        offset = np.where(index < halo, before, np.where(index >= halo + n, after, 0))
+        source = np.where(index < halo, n - 1 - halo + index, np.where(index >= halo + n, index - halo - n + 1, index - halo))
+        return offset, source, np.clip(index - halo, 0, n - 1)
+
+    dlats, source_rows, edge_rows = split(rows, 1, -1)
+    dlons, source_cols, edge_cols = split(cols, -1, 1)
+    window = np.empty((len(rows), len(cols)), dtype=np.int16)
+    for dlat in np.unique(dlats):
+        row_mask = dlats == dlat
+        for dlon in np.unique(dlons):
+            col_mask = dlons == dlon
+            tile = core if dlat == 0 and dlon == 0 else neighbour(int(dlat), int(dlon))
+            if tile is None:
+                tile, r, c = core, edge_rows[row_mask], edge_cols[col_mask]
+            else:
+                r, c = source_rows[row_mask], source_cols[col_mask]
+            window[np.ix_(row_mask, col_mask)] = tile[np.ix_(r, c)]
+    return window
+
+
+class TileIndex():
+    def __init__(self, data_dir, manifest="tile_index.json"):
+        '''
+        Global index of the tiles present in data_dir
+
+        Tiles are identified by the integer id of their south west
+        corner, (lat + 90) * 360 + (lon + 180). A 180x360 presence
+        bitmap and a table of file names allow resolving locations
+        to tiles with array lookups instead of a filesystem call per
+        location. The index is built once from a listing of data_dir
+        and persisted to a manifest file in data_dir.
+
+        Args:
+            data_dir:str >> directory containing the hgt files
+            manifest:str >> file name of the persisted index in data_dir
+        '''
+        self.data_dir = data_dir
+        self.manifest = os.path.join(data_dir, manifest)
+        self.present  = np.zeros(180 * 360, dtype=bool)
+        self.names    = np.empty(180 * 360, dtype=object)
+
+    def __len__(self):
+        return int(self.present.sum())
+
+    @staticmethod
+    def tile_name(lat, lon):
+        '''
+        Returns file name of the tile with given south west corner
+
+        Args:
+            lat:int >> latitude of the southern tile edge
+            lon:int >> longitude of the western tile edge
+
+        Returns:
+            hgt_file:str >> name of hgt_file, e.g. N27E086.hgt
+        '''
+        return "%s%02d%s%03d.hgt" % (
+            "N" if lat >= 0 else "S", abs(lat),
+            "E" if lon >= 0 else "W", abs(lon)
+            )
+
+    @staticmethod
+    def tile_origin(hgt_file):
+        '''
+        Returns lat, lon of the south west corner of given tile
+
+        Args:
+            hgt_file:str >> file_name of hgt file, e.g. N27E086.hgt
+
+        Returns:
+            lat:int >> latitude of the southern tile edge
+            lon:int >> longitude of the western tile edge
+        '''
+        name = os.path.basename(hgt_file)
+        lat = int(name[1:3]) * (-1 if name[0] == "S" else 1)
+        lon = int(name[4:7]) * (-1 if name[3] == "W" else 1)
+        return lat, lon
+
+    def tile_id(self, hgt_file):
+        '''
+        Returns integer id of given tile
+        '''
+        lat, lon = self.tile_origin(hgt_file)
+        return (lat + 90) * 360 + (lon + 180)
+
+    def add(self, hgt_file):
+        '''
+        Marks given tile as present
+        '''
+        name = os.path.basename(hgt_file)
+        tile_id = self.tile_id(name)
+        self.present[tile_id] = True
+        self.names[tile_id] = name
+
+    def remove(self, hgt_file):
+        '''
+        Marks given tile as absent
+        '''
+        tile_id = self.tile_id(hgt_file)
+        self.present[tile_id] = False
+        self.names[tile_id] = None
+
+    def _listing(self):
+        '''
+        Lists the hgt files in data_dir
+
+        Returns:
+            names:list >> names of the hgt files
+            stamp:dict >> number of hgt files and their latest mtime,
+                          changes when tiles are added, replaced or
+                          removed, unlike the mtime of data_dir, which
+                          other files written to data_dir bump as well
+        '''
+        names, mtime = [], 0
+        if os.path.isdir(self.data_dir):
+            for entry in os.scandir(self.data_dir):
+                if entry.name.endswith(".hgt") and len(entry.name) == 11:
+                    names.append(entry.name)
+                    mtime = max(mtime, entry.stat().st_mtime)
+        return names, {"count":len(names), "mtime":mtime}
+
+    def build(self, names=None):
+        '''
+        Builds the index from a single listing of data_dir
+
+        Args:
+            names:list >> names of the hgt files, None lists data_dir
+        '''
+        if names is None:
+            names, _ = self._listing()
+        self.present[:] = False
+        self.names[:] = None
+        for name in names:
+            self.add(name)
+
+    def save(self, stamp=None):
+        '''
+        Persists the index as manifest in data_dir
+
+        Args:
+            stamp:dict >> stamp of the listing, see self._listing()
+        '''
+        if stamp is None:
+            _, stamp = self._listing()
+        with open(self.manifest, "w") as f:
+            json.dump({"tiles":sorted(self.names[self.present].tolist()), "stamp":stamp}, f)
+
+    def load(self, stamp=None):
+        '''
+        Loads the index from the manifest in data_dir
+
+        Args:
+            stamp:dict >> stamp of the current listing, the manifest is
+                          only loaded if it was saved with the same one
+
+        Returns:
+            loaded:bool >> False if there is no (matching) manifest
+        '''
+        if not os.path.isfile(self.manifest):
+            return False
+        try:
+            with open(self.manifest) as f:
+                manifest = json.load(f)
+        except ValueError:
+            return False
+        if stamp is not None and manifest.get("stamp") != stamp:
+            return False
+        self.present[:] = False
+        self.names[:] = None
+        for name in manifest["tiles"]:
+            self.add(name)
+        return True
+
+    def load_or_build(self):
+        '''
+        Loads the manifest if the hgt files in data_dir did not change
+        since it was saved, otherwise rebuilds the index and persists it
+        '''
+        names, stamp = self._listing()
+        if not self.load(stamp):
+            self.build(names)
+            if os.path.isdir(self.data_dir):
+                self.save(stamp)
+
+    def resolve(self, lats, lons):
+        '''
+        Resolves locations to tiles, vectorized
+
+        Locations on the northern/eastern border of the grid (lat 90,
+        lon 180) belong to the tiles below/left of them.
+
+        Args:
+            lats:np.array >> latitudes, numbers between -90 and 90
+            lons:np.array >> longitudes, numbers between -180 and 180
+
+        Returns:
+            tile_ids:np.array >> integer tile ids, -1 for invalid locations
+            present:np.array  >> bool, True if the tile is available
+        '''
+        lats = np.asarray(lats, dtype=np.float64)
+        lons = np.asarray(lons, dtype=np.float64)
+        valid = (lats >= -90) & (lats <= 90) & (lons >= -180) & (lons <= 180)
+        lat_idx = np.clip(np.floor(np.where(valid, lats, 0)) + 90, 0, 179).astype(np.intp)
+        lon_idx = np.clip(np.floor(np.where(valid, lons, 0)) + 180, 0, 359).astype(np.intp)
+        tile_ids = np.where(valid, lat_idx * 360 + lon_idx, -1)
+        present  = valid & self.present[np.maximum(tile_ids, 0)]
+        return tile_ids, present
+
+    def origin(self, tile_ids):
+        '''
+        Returns lat, lon of the south west corner of given tile ids
+        '''
+        lat_idx, lon_idx = np.divmod(tile_ids, 360)
+        return lat_idx - 90, lon_idx - 180
+
+    def path(self, tile_id):
+        '''
+        Returns full path of given tile id or None if absent
+        '''
+        if tile_id < 0 or not self.present[tile_id]:
+            return None
+        return os.path.join(self.data_dir, self.names[tile_id])
+
+    def snapshot(self):
+        '''
+        Returns the presence bitmap packed into 8100 bytes, to be
+        passed to processes holding another index of the same data_dir,
+        see self.changes()
+        '''
+        return np.packbits(self.present)
+
+    def changes(self, snapshot):
+        '''
+        Returns the differences of this index to a snapshot of another
+
+        Args:
+            snapshot:np.array >> see self.snapshot()
+
+        Returns:
+            added:list   >> names of tiles present in the snapshot only
+            removed:list >> names of tiles present in this index only
+        '''
+        present = np.unpackbits(snapshot, count=self.present.size).astype(bool)
+        names = lambda tile_ids: [self.tile_name(*self.origin(int(i))) for i in tile_ids]
+        return (
+            names(np.nonzero(present & ~self.present)[0]),
+            names(np.nonzero(self.present & ~present)[0])
+            )
+
+
+class TileHeatmap():
+    def __init__(self, data_dir, file_name="tile_heatmap.json", interval=300):
+        '''
+        Access counts per tile, persisted to data_dir, so the tiles
+        hot before a restart are known at startup
+
+        A tile is counted once per lookup call it is read by, no matter
+        how many locations fall on it, so a single large bulk request
+        does not outweigh steady traffic. Several processes (workers of
+        the API) share the file, every save adds the counts since the
+        last save to the persisted ones.
+
+        Args:
+            data_dir:str  >> directory containing the hgt files
+            file_name:str >> file name of the persisted counts in data_dir
+            interval:int  >> min seconds between two saves, see self.due()
+        '''
+        self.path     = os.path.join(data_dir, file_name)
+        self.interval = interval
+        self.counts   = np.zeros(180 * 360, dtype=np.int64)
+        self._saved   = np.zeros(180 * 360, dtype=np.int64)
+        self._saved_at = time.monotonic()
+        self._lock    = threading.Lock()
+
+    def __getstate__(self):
+        # locks are not passed to worker processes
+        state = self.__dict__.copy()
+        del state["_lock"]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+    def add(self, tile_ids):
+        '''
+        Counts an access of every distinct tile of given tile ids
+        '''
+        tile_ids = np.unique(tile_ids[tile_ids >= 0])
+        with self._lock:
+            self.counts[tile_ids] += 1
+
+    def top(self, n):
+        '''
+        Returns the names of the n most accessed tiles
+
+        Returns:
+            tiles:list >> tile names, most accessed first
+        '''
+        tile_ids = np.argsort(self.counts, kind="stable")[::-1][:n]
+        tile_ids = tile_ids[self.counts[tile_ids] > 0]
+        lat_idx, lon_idx = np.divmod(tile_ids, 360)
+        return [TileIndex.tile_name(int(lat) - 90, int(lon) - 180) for lat, lon in zip(lat_idx, lon_idx)]
+
+    def due(self):
+        '''
+        Returns True once every interval, the caller saves then
+        '''
+        with self._lock:
+            if self.interval <= 0 or time.monotonic() - self._saved_at < self.interval:
+                return False
+            self._saved_at = time.monotonic()
+            return True
+
+    def save(self):
+        '''
+        Persists the counts of all accessed tiles
+        '''
+        # lookups only wait for the copies of the counts, not the file
+        with open(self.path + ".lock", "w") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            with self._lock:
+                snapshot = self.counts.copy()
+            counts = snapshot.copy()
+            persisted = self._read()
+            if persisted is not None:
+                counts += persisted - self._saved
+            tile_ids = np.nonzero(counts)[0]
+            lat_idx, lon_idx = np.divmod(tile_ids, 360)
+            tmp = f"{self.path}.{os.getpid()}.tmp"
+            with open(tmp, "w") as f:
+                json.dump({"tiles":{
+                    TileIndex.tile_name(int(lat) - 90, int(lon) - 180):int(counts[i])
+                    for i, lat, lon in zip(tile_ids, lat_idx, lon_idx)
+                    }}, f)
+            os.replace(tmp, self.path)
+            # counts of other processes are included from now on
+            with self._lock:
+                self.counts += counts - snapshot
+            self._saved[:] = counts
+
+    def _read(self):
+        '''
+        Returns the persisted counts, None if there are none
+        '''
+        try:
+            with open(self.path) as f:
+                persisted = json.load(f)["tiles"]
+        except (OSError, ValueError, KeyError):
+            return None
+        counts = np.zeros(180 * 360, dtype=np.int64)
+        for name, count in persisted.items():
+            lat, lon = TileIndex.tile_origin(name)
+            counts[(lat + 90) * 360 + (lon + 180)] = count
+        return counts
+
+    def load(self):
+        '''
+        Loads the persisted counts
+
+        Returns:
+            loaded:bool >> False if there are none
+        '''
+        counts = self._read()
+        if counts is None:
+            return False
+        with self._lock:
+            self.counts[:] = counts
+        self._saved[:] = counts
+        return True
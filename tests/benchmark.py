@@ -0,0 +1,623 @@
+'''
+Self-contained benchmark suite of the elevation lookups
+
+Synthetic hgt tiles are generated in a temporary directory, so
+neither the dataset nor a network connection is needed. They are
+cut from one mosaic, before the benchmarks run, lookups across the
+tile edges are checked against the mosaic (check_edges()) and errors
+of failing micro-batches (check_batch_failure()). Benchmark groups:
+    micro >> tile resolution, tile reads, halo builds and every
+             interpolation method on raw arrays
+    batch >> OpenElevator lookups of single points and batches
+    cache >> result cache miss, L1 hit and L2 hit paths
+    http  >> the elevation routes through the ASGI app in-process
+             (needs httpx), rate limiting included unless disabled
+             with --no-ratelimit
+
+Redis is replaced by an in-process stand-in (MemoryRedis), so the
+cache and rate limiter paths are measured without the network hop
+of a real server.
+
+Results are printed as JSON. With a thresholds file, every metric
+is compared to its limit and the exit code is 1 on a regression:
+    {"micro.resolve": {"median_ms": 5.0}, "http.get_json": {"min_items_per_s": 200}}
+Metrics ending on _ms are upper limits, metrics prefixed with min_
+lower limits.
+
+Usage:
+    python benchmark.py
+    python benchmark.py --only micro batch --output results.json
+    python benchmark.py --thresholds benchmark_thresholds.json
+
+Copyright (C) Predly Technologies - All Rights Reserved
+Marvin Gabler <m.gabler@predly.com> 2021
+'''
+
+import gc
+import os
+import sys
+import json
+import time
+import asyncio
+import hashlib
+import argparse
+import platform
+import tempfile
+import numpy as np
+
+# modules of openelevator import each other flat, as in server.py
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "openelevator"))
+
+from tiles import TilePool, TileIndex, HaloTile
+from interpolation import interpolate
+
+try:
+    import httpx
+except ImportError:
+    httpx = None
+
+SAMPLES = 3601
+# south west corners of the synthetic tiles
+TILES = [(50, 8), (50, 9), (51, 8), (51, 9)]
+# north west corner of the mosaic the tiles are cut from, data void
+# rows and cols on the mosaic (on the first tile)
+MOSAIC_NORTH = max(lat for lat, _ in TILES) + 1
+MOSAIC_WEST  = min(lon for _, lon in TILES)
+VOIDS = ((4600, 4800), (1000, 1200))
+GROUPS = ["micro", "batch", "cache", "http"]
+
+
+class MemoryRedis():
+    '''
+    In-process stand-in of the redis commands used by the result
+    cache and the rate limiter, keys expire like in redis
+    '''
+    def __init__(self):
+        self.data = {}
+        self.expiry = {}
+        self.scripts = {}
+
+    def _get(self, key):
+        expiry = self.expiry.get(key)
+        if expiry is not None and expiry <= time.monotonic():
+            self.data.pop(key, None)
+            self.expiry.pop(key, None)
+        return self.data.get(key)
+
+    def _set(self, key, value, ex=None, px=None):
+        self.data[key] = str(value)
+        self.expiry.pop(key, None)
+        if ex or px:
+            self.expiry[key] = time.monotonic() + (ex or px / 1000)
+
+    async def get(self, key):
+        return self._get(key)
+
+    async def set(self, key, value, ex=None, px=None):
+        self._set(key, value, ex, px)
+        return True
+
+    async def mget(self, keys, *args):
+        keys = list(keys) if isinstance(keys, (list, tuple)) else [keys, *args]
+        return [self._get(key) for key in keys]
+
+    async def mset(self, mapping):
+        for key, value in mapping.items():
+            self._set(key, value)
+        return True
+
+    async def incrby(self, key, amount=1):
+        value = int(self._get(key) or 0) + amount
+        self.data[key] = str(value)
+        return value
+
+    async def expire(self, key, seconds):
+        if key in self.data:
+            self.expiry[key] = time.monotonic() + seconds
+        return True
+
+    async def pttl(self, key):
+        if self._get(key) is None:
+            return -2
+        expiry = self.expiry.get(key)
+        return -1 if expiry is None else int((expiry - time.monotonic()) * 1000)
+
+    async def config_set(self, name, value):
+        return True
+
+    async def script_load(self, script):
+        sha = hashlib.sha1(script.encode()).hexdigest()
+        self.scripts[sha] = script
+        return sha
+
+    async def evalsha(self, sha, numkeys, key, limit, expire_ms):
+        # the fixed window script of fastapi_limiter
+        current = int(self._get(key) or 0)
+        if current > 0:
+            if current + 1 > int(limit):
+                return await self.pttl(key)
+            self.data[key] = str(current + 1)
+            return 0
+        self._set(key, 1, px=int(expire_ms))
+        return 0
+
+    def pipeline(self, transaction=True):
+        return MemoryPipeline(self)
+
+
+class MemoryPipeline():
+    def __init__(self, redis):
+        self.redis = redis
+        self.commands = []
+
+    def __getattr__(self, name):
+        def queue(*args, **kwargs):
+            self.commands.append((name, args, kwargs))
+            return self
+        return queue
+
+    async def execute(self):
+        results = []
+        for name, args, kwargs in self.commands:
+            results.append(await getattr(self.redis, name)(*args, **kwargs))
+        self.commands = []
+        return results
+
+
+def synthetic(rows, cols, seed=42):
+    '''
+    Returns the elevations of the synthetic mosaic covering all TILES:
+    smooth hills with noise, a sea of zeros and a block of data voids.
+    Every sample is a function of its position on the mosaic only, so
+    neighbouring tiles share their edges as SRTM tiles do.
+
+    Args:
+        rows:np.array >> integer rows of the mosaic, 0 in the north
+        cols:np.array >> integer cols of the mosaic, 0 in the west
+        seed:int      >> seed of the noise
+
+    Returns:
+        elevations:np.array >> int16 elevations, broadcast of rows and cols
+    '''
+    rows = np.asarray(rows, dtype=np.int64)
+    cols = np.asarray(cols, dtype=np.int64)
+    lats = MOSAIC_NORTH - rows / (SAMPLES - 1)
+    lons = MOSAIC_WEST + cols / (SAMPLES - 1)
+    data = 400 + 300 * np.sin(lats * 7.0) * np.cos(lons * 5.0) + 150 * np.sin(lons * 23.0 + lats * 11.0)
+    # hashed noise, about the spread of normal noise with sigma 2
+    noise = (rows * 73856093 + cols * 19349663 + seed * 83492791) & 0xFFFFFFFF
+    noise = ((noise >> 16) ^ noise) * 0x45D9F3B & 0xFFFFFFFF
+    noise = ((noise >> 16) ^ noise) / 2 ** 32
+    data = np.rint(np.clip(data + (noise - 0.5) * 7, 0, None)).astype(np.int16)
+    data[(rows >= VOIDS[0][0]) & (rows < VOIDS[0][1]) & (cols >= VOIDS[1][0]) & (cols < VOIDS[1][1])] = -32768
+    return data
+
+
+def write_tiles(data_dir, tiles=TILES, seed=42):
+    '''
+    Writes the synthetic hgt tiles, cut from the mosaic of synthetic()
+
+    Args:
+        data_dir:str >> directory of the tiles
+        tiles:list   >> (lat, lon) south west corners
+        seed:int     >> seed of the noise
+    '''
+    os.makedirs(data_dir, exist_ok=True)
+    for lat, lon in tiles:
+        path = os.path.join(data_dir, TileIndex.tile_name(lat, lon))
+        row = (MOSAIC_NORTH - lat - 1) * (SAMPLES - 1)
+        col = (lon - MOSAIC_WEST) * (SAMPLES - 1)
+        data = synthetic(
+            np.arange(row, row + SAMPLES)[:, None],
+            np.arange(col, col + SAMPLES)[None, :],
+            seed
+            )
+        if os.path.isfile(path) and os.path.getsize(path) == data.nbytes and \
+                np.array_equal(np.fromfile(path, dtype=">i2").reshape(data.shape), data):
+            continue
+        data.astype(">i2").tofile(path)
+
+
+def check_edges(ctx):
+    '''
+    Checks that lookups across tile edges, with and without the tile
+    cache, equal the interpolation on the mosaic the tiles are cut from
+
+    Raises:
+        AssertionError >> if a lookup differs from the mosaic
+    '''
+    loop = ctx["loop"]
+    rng = np.random.default_rng(5)
+    n = 2000
+    last = SAMPLES - 1
+    # points within 10 samples of the inner edge of the mosaic at
+    # lat 51 (row last) and lon 9 (col last)
+    offsets = (rng.random(n) - 0.5) * 20 / last
+    along = 0.01 + rng.random(n) * 1.98
+    lats = np.concatenate([51 + offsets, 50 + along])
+    lons = np.concatenate([8 + along, 9 + offsets])
+    rows = (MOSAIC_NORTH - lats) * last
+    cols = (lons - MOSAIC_WEST) * last
+
+    # reference on bands of the mosaic along both edges
+    band = np.arange(last - 16, last + 17)
+    full = np.arange(2 * last + 1)
+    across_lat = synthetic(band[:, None], full[None, :])
+    across_lon = synthetic(full[:, None], band[None, :])
+    for method in ("linear", "cubic"):
+        expected = np.concatenate([
+            interpolate(across_lat, rows[:n] - band[0], cols[:n], method=method),
+            interpolate(across_lon, rows[n:], cols[n:] - band[0], method=method)
+            ])
+        for tile_cache_mb in (1024, 0):
+            elevator = make_elevator(ctx, tile_cache_mb=tile_cache_mb)
+            elevations = loop.run_until_complete(elevator.get_elevations(lats, lons, method))
+            elevator.executor.shutdown()
+            mismatch = np.abs(elevations - expected) > 1e-6
+            assert not mismatch.any(), (
+                f"{method} lookups with tile_cache_mb={tile_cache_mb} differ from the mosaic at "
+                f"{np.count_nonzero(mismatch)} points, e.g. lat {lats[mismatch][0]}, lon {lons[mismatch][0]}: "
+                f"{elevations[mismatch][0]} instead of {expected[mismatch][0]}"
+                )
+
+
+def check_batch_failure(ctx):
+    '''
+    Checks that a failing batch of PointBatcher passes the error to
+    every waiting lookup, also to coalesced ones, without errors left
+    unretrieved for cancelled lookups, and that the next batch works
+
+    Raises:
+        AssertionError >> if the error is not passed on as expected
+    '''
+    from batching import PointBatcher
+
+    loop = ctx["loop"]
+    failing = {"batches":1}
+
+    async def lookup(lats, lons, interpolation="cubic", level=0):
+        await asyncio.sleep(0.01)
+        if failing["batches"]:
+            failing["batches"] -= 1
+            raise RuntimeError("lookup failed")
+        return lats + lons
+
+    async def run():
+        batcher = PointBatcher(lookup, window_us=0)
+        waiters = [asyncio.ensure_future(batcher.get(50.0 + i, 8.0)) for i in range(4)]
+        waiters.append(asyncio.ensure_future(batcher.get(50.0, 8.0)))
+        await asyncio.sleep(0)
+        # the only lookup of a location cancelled while its batch runs
+        waiters[3].cancel()
+        results = await asyncio.gather(*waiters, return_exceptions=True)
+        return results, batcher.coalesced, await batcher.get(1.0, 2.0)
+
+    unhandled = []
+    handler = loop.get_exception_handler()
+    loop.set_exception_handler(lambda loop, context: unhandled.append(context))
+    try:
+        results, coalesced, after = loop.run_until_complete(run())
+        assert coalesced == 1, f"{coalesced} lookups coalesced instead of 1"
+        for i in (0, 1, 2, 4):
+            assert isinstance(results[i], RuntimeError), f"lookup {i} returned {results[i]!r} instead of the error"
+        assert isinstance(results[3], asyncio.CancelledError), f"cancelled lookup returned {results[3]!r}"
+        assert after == 3.0, f"lookup after the failed batch returned {after!r}"
+        # unretrieved errors are reported when their future is collected,
+        # the tracebacks of the results refer to the futures
+        del results
+        gc.collect()
+    finally:
+        loop.set_exception_handler(handler)
+    assert not unhandled, f"errors of the failed batch were not retrieved: {unhandled[0]['message']}"
+
+
+def measure(func, items=1, repeat=20, warmup=2, setup=None):
+    '''
+    Times repeated calls of func
+
+    Args:
+        func:callable  >> benchmarked function without arguments
+        items:int      >> items (points, requests) processed per call
+        repeat:int     >> timed calls
+        warmup:int     >> untimed calls before
+        setup:callable >> called untimed before every call
+
+    Returns:
+        result:dict >> median_ms, p95_ms, min_ms, items and
+                       items_per_s at the median
+    '''
+    for _ in range(warmup):
+        if setup is not None:
+            setup()
+        func()
+    times = []
+    for _ in range(repeat):
+        if setup is not None:
+            setup()
+        start = time.perf_counter()
+        func()
+        times.append((time.perf_counter() - start) * 1000)
+    median = float(np.median(times))
+    return {
+        "median_ms":median,
+        "p95_ms":float(np.percentile(times, 95)),
+        "min_ms":float(np.min(times)),
+        "items":items,
+        "items_per_s":items / median * 1000 if median > 0 else None
+        }
+
+
+def random_points(rng, n, tiles=TILES):
+    '''
+    Returns n random lats, lons on the synthetic tiles
+    '''
+    corners = np.asarray(tiles)[rng.integers(0, len(tiles), n)]
+    return corners[:, 0] + rng.random(n), corners[:, 1] + rng.random(n)
+
+
+def bench_micro(ctx):
+    results = {}
+    rng = np.random.default_rng(1)
+    index = TileIndex(ctx["data_dir"])
+    index.build()
+    lats, lons = random_points(rng, 100000)
+    results["micro.resolve"] = measure(lambda: index.resolve(lats, lons), items=lats.size)
+
+    pool = TilePool(ctx["data_dir"], samples=SAMPLES)
+    name = TileIndex.tile_name(*TILES[0])
+    rows = rng.integers(0, SAMPLES, 10000)
+    cols = rng.integers(0, SAMPLES, 10000)
+    results["micro.read_open"] = measure(
+        lambda: pool.get(name)[rows[0], cols[0]], setup=pool.close, repeat=50
+        )
+    pool.get(name)
+    results["micro.read_points"] = measure(lambda: pool.get(name)[rows, cols], items=rows.size)
+    results["micro.read_tile"] = measure(lambda: np.asarray(pool.get(name), dtype=np.int16), repeat=5)
+
+    neighbour = lambda dlat, dlon: pool.get(TileIndex.tile_name(TILES[0][0] + dlat, TILES[0][1] + dlon)) \
+        if (TILES[0][0] + dlat, TILES[0][1] + dlon) in TILES else None
+    results["micro.halo_build"] = measure(
+        lambda: HaloTile(pool.get(name)).build_halo(neighbour), repeat=5
+        )
+
+    tile = np.asarray(pool.get(name), dtype=np.int16)
+    frows = rng.random(100000) * (SAMPLES - 1)
+    fcols = rng.random(100000) * (SAMPLES - 1)
+    for method in ("nearest", "linear", "cubic"):
+        results[f"micro.interpolate.{method}"] = measure(
+            lambda: interpolate(tile, frows, fcols, method=method), items=frows.size
+            )
+    return results
+
+
+def make_elevator(ctx, cache=False, **kwargs):
+    from openelevator import OpenElevator
+
+    elevator = OpenElevator(
+        initialized=True,
+        cache=cache,
+        data_dir=ctx["data_dir"],
+        heatmap_interval=0,
+        **kwargs
+        )
+    if cache:
+        elevator.cache = MemoryRedis()
+        elevator.result_cache.redis = elevator.cache
+    return elevator
+
+
+def bench_batch(ctx):
+    results = {}
+    loop = ctx["loop"]
+    rng = np.random.default_rng(2)
+    elevator = make_elevator(ctx)
+    lats, lons = random_points(rng, 1000)
+    points = iter(zip(lats.tolist() * 1000, lons.tolist() * 1000))
+
+    async def single():
+        lat, lon = next(points)
+        await elevator.get_elevation(lat, lon, "cubic")
+
+    results["batch.get_elevation"] = measure(lambda: loop.run_until_complete(single()), repeat=200)
+
+    lats, lons = random_points(rng, 10000)
+    for method in ("nearest", "linear", "cubic"):
+        results[f"batch.get_elevations.{method}"] = measure(
+            lambda: loop.run_until_complete(elevator.get_elevations(lats, lons, method)),
+            items=lats.size
+            )
+
+    # concurrent single point lookups, one by one and micro-batched
+    lats, lons = random_points(rng, 1000)
+    batched = make_elevator(ctx, batch_window_us=300)
+    for name, target in (("unbatched", elevator), ("batched", batched)):
+        results[f"batch.get_elevation_concurrent.{name}"] = measure(
+            lambda: loop.run_until_complete(asyncio.gather(*(
+                target.get_elevation(lat, lon, "cubic") for lat, lon in zip(lats.tolist(), lons.tolist())
+                ))),
+            items=lats.size, repeat=10
+            )
+    batched.executor.shutdown()
+    elevator.executor.shutdown()
+    return results
+
+
+def bench_cache(ctx):
+    results = {}
+    loop = ctx["loop"]
+    rng = np.random.default_rng(3)
+    elevator = make_elevator(ctx, cache=True)
+    n = 10000
+    batch = {}
+
+    def fresh():
+        batch["points"] = random_points(rng, n)
+
+    results["cache.miss"] = measure(
+        lambda: loop.run_until_complete(elevator.get_elevations(*batch["points"], "cubic")),
+        items=n, setup=fresh
+        )
+
+    fresh()
+    loop.run_until_complete(elevator.get_elevations(*batch["points"], "cubic"))
+    results["cache.hit_l1"] = measure(
+        lambda: loop.run_until_complete(elevator.get_elevations(*batch["points"], "cubic")),
+        items=n
+        )
+    results["cache.hit_l2"] = measure(
+        lambda: loop.run_until_complete(elevator.get_elevations(*batch["points"], "cubic")),
+        items=n, setup=elevator.result_cache.l1.clear
+        )
+    elevator.executor.shutdown()
+    return results
+
+
+def bench_http(ctx):
+    if httpx is None:
+        print("httpx is not installed, skipping the http benchmarks", file=sys.stderr)
+        return {}
+    from fastapi import FastAPI
+    from fastapi.middleware.gzip import GZipMiddleware
+    from fastapi_limiter import FastAPILimiter
+    from api.routes import elevation
+    from api.ratelimit import LocalLimiter
+
+    results = {}
+    loop = ctx["loop"]
+    rng = np.random.default_rng(4)
+    elevation.elevator = make_elevator(ctx, cache=True)
+
+    app = FastAPI()
+    app.add_middleware(GZipMiddleware, minimum_size=1000)
+    app.include_router(elevation.router, prefix="/v1/elevation")
+
+    if ctx["ratelimit"]:
+        # every request is its own client, so limits are checked
+        # against redis but never hit
+        clients = iter(range(10 ** 9))
+
+        async def identifier(request):
+            return f"bench-{next(clients)}:{request.scope['path']}"
+
+        redis = MemoryRedis()
+        loop.run_until_complete(FastAPILimiter.init(redis, identifier=identifier))
+        loop.run_until_complete(LocalLimiter.init(redis, identifier=identifier))
+    else:
+        for route in elevation.router.routes:
+            for dependency in getattr(route, "dependencies", []):
+                app.dependency_overrides[dependency.dependency] = lambda: None
+    client = httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url="http://bench")
+
+    lats, lons = random_points(rng, 100000)
+    points = iter(zip(lats.tolist(), lons.tolist()))
+
+    async def get_json(n=1):
+        async def one():
+            lat, lon = next(points)
+            response = await client.get("/v1/elevation/json", params={"lat":lat, "lon":lon})
+            assert response.status_code == 200, response.text
+        await asyncio.gather(*(one() for _ in range(n)))
+
+    async def post_json():
+        locations = [[lon, lat] for lat, lon in (next(points) for _ in range(100))]
+        response = await client.post("/v1/elevation/json", json={"locations":locations})
+        assert response.status_code == 200, response.text
+
+    results["http.get_json"] = measure(lambda: loop.run_until_complete(get_json()), repeat=200)
+    results["http.get_json_concurrent"] = measure(
+        lambda: loop.run_until_complete(get_json(100)), items=100, repeat=10
+        )
+    results["http.post_json"] = measure(lambda: loop.run_until_complete(post_json()), items=100, repeat=50)
+    loop.run_until_complete(client.aclose())
+    loop.run_until_complete(LocalLimiter.close())
+    elevation.elevator.executor.shutdown()
+    return results
+
+
+def check_thresholds(results, thresholds):
+    '''
+    Compares results to their thresholds
+
+    Args:
+        results:dict    >> benchmark results by name
+        thresholds:dict >> limits by benchmark name and metric, *_ms are
+                           upper limits, min_* lower limits
+
+    Returns:
+        regressions:list >> benchmark, metric, value and limit of
+                            every exceeded threshold
+    '''
+    regressions = []
+    for name, limits in thresholds.items():
+        if name not in results:
+            continue
+        for metric, limit in limits.items():
+            if metric.startswith("min_"):
+                value = results[name].get(metric[4:])
+                exceeded = value is not None and value < limit
+            else:
+                value = results[name].get(metric)
+                exceeded = value is not None and value > limit
+            if exceeded:
+                regressions.append({"benchmark":name, "metric":metric, "value":value, "limit":limit})
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmarks of the elevation lookups")
+    parser.add_argument("--only", nargs="+", choices=GROUPS, default=GROUPS, help="groups to run")
+    parser.add_argument("--data-dir", help="directory of the synthetic tiles, kept for reuse")
+    parser.add_argument("--output", help="write the results to this file")
+    parser.add_argument("--thresholds", help="json file of regression thresholds")
+    parser.add_argument("--no-ratelimit", action="store_true", help="http benchmarks without rate limiting")
+    args = parser.parse_args()
+
+    tmp = None
+    data_dir = args.data_dir
+    if data_dir is None:
+        tmp = tempfile.TemporaryDirectory(prefix="openelevator-bench-")
+        data_dir = tmp.name
+    print("Writing synthetic tiles to", data_dir, file=sys.stderr)
+    write_tiles(data_dir)
+
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    ctx = {"data_dir":data_dir, "loop":loop, "ratelimit":not args.no_ratelimit}
+    print("Checking lookups across tile edges and failing batches", file=sys.stderr)
+    check_edges(ctx)
+    check_batch_failure(ctx)
+    results = {}
+    for group in GROUPS:
+        if group in args.only:
+            print("Running", group, "benchmarks", file=sys.stderr)
+            results.update(globals()[f"bench_{group}"](ctx))
+    loop.close()
+
+    report = {
+        "meta":{
+            "timestamp":time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "python":platform.python_version(),
+            "numpy":np.__version__,
+            "machine":platform.machine(),
+            "cpus":os.cpu_count()
+            },
+        "results":results
+        }
+    if args.thresholds:
+        with open(args.thresholds) as f:
+            report["regressions"] = check_thresholds(results, json.load(f))
+
+    output = json.dumps(report, indent=2)
+    print(output)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output)
+    if tmp is not None:
+        tmp.cleanup()
+    if report.get("regressions"):
+        print(len(report["regressions"]), "thresholds exceeded", file=sys.stderr)
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
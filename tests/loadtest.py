@@ -6,27 +6,26 @@ Marvin Gabler <m.gabler@predly.com> 2021
 import os
 import sys
 import json
+import argparse
 import requests
 import numpy as np
 import time
+from functools import partial
 from multiprocessing import Pool
 
-def make_single_requests(coords):
+def make_single_requests(coords, host):
     lat,lon = coords[1], coords[0]
-    url = f"http://code.predly.com:8080/v1/data?lat={lat}&lon={lon}&interpolation=cubic"
+    url = f"{host}/v1/elevation/json?lat={lat}&lon={lon}&interpolation=cubic"
     resp = requests.get(url)
     if resp.status_code == 200:
         sys.stderr.write("OK\n")
     else:
         sys.stderr.write("ERROR\n")
 
-def make_big_request(coords):
-    url = f"http://code.predly.com:8080/v1/data"
-    data = {
-        "locations": coords,
-        "interpolation": "none"
-        }
-    resp = requests.post(url,data=json.dumps(data))
+def make_big_request(coords, host):
+    url = f"{host}/v1/elevation/bulk?interpolation=none"
+    data = "\n".join(json.dumps(i) for i in coords)
+    resp = requests.post(url, data=data, headers={"Content-Type":"application/x-ndjson"})
     if resp.status_code == 200:
         sys.stderr.write("OK\n")
         print(resp.text)
@@ -41,22 +40,31 @@ def generate_coords():
         coords.append([lons[i],lats[i]])
     return coords
 
-def make_load_test_single():
-    processes = os.cpu_count()   
+def make_load_test_single(host):
+    processes = os.cpu_count()
     coords = generate_coords()
     p = Pool(processes=processes)
 
     start = time.time()
-    p.map(make_single_requests, coords)
+    p.map(partial(make_single_requests, host=host), coords)
     print("Took", (time.time() - start)*1000, "milliseconds for", len(coords), "requests")
     p.close()
 
-def make_load_test_multi():
+def make_load_test_multi(host):
 
     coords = generate_coords()
     start = time.time()
-    make_big_request(coords)
+    make_big_request(coords, host)
     print("Took", (time.time() - start)*1000, "milliseconds")
 
 
-make_load_test_single()
\ No newline at end of file
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Load test of a running API")
+    parser.add_argument("--host", default="http://localhost:8080", help="url of the API")
+    parser.add_argument("--multi", action="store_true", help="send all locations in a single bulk request")
+    args = parser.parse_args()
+
+    if args.multi:
+        make_load_test_multi(args.host)
+    else:
+        make_load_test_single(args.host)